@@ -3,7 +3,10 @@ import streamlit as st
 from textwrap import dedent
 from datetime import datetime
 import pandas as pd
+import os
 import re
+import time
+import uuid
 from functools import lru_cache
 
 
@@ -14,29 +17,56 @@ from config import (
     DEFAULT_MAX_COMPLETION_TOKENS,
     HIDE_SQL_IN_UI,
     PERSIST_TURNS,
+    DASH_ROUTING_ENABLED,
+    PROJECTION_REWRITE_ENABLED,
+    QUERY_PREVIEW_MAX_COLUMNS,
+    PROJECTION_LOG_PLAN,
+    QUERY_COST_GUARD_ENABLED,
     DEFAULT_HISTORY_TOKEN_BUDGET,
-    PII_COLUMN_HINTS,
     REGRAS_GERAIS,
     POS_FILE,
     NEG_FILE,
+    FEEDBACK_TEXT_EXPORT,
     AZURE_OAI_ENDPOINT,
     AZURE_OAI_DEPLOYMENT,
     AZURE_OAI_API_VERSION,
-    AZURE_OAI_API_KEY
+    AZURE_OAI_API_KEY,
+    QUESTION_CACHE_ENABLED,
+    LLM_STREAMING,
+    DEBUG_SHOW_MODEL_RAW,
+    SPECULATIVE_SQL,
+    QUERY_FIRST_PAGE_ROWS,
+    RESULT_STORE_MEM_ITEMS,
+    RESULT_STORE_MEM_BYTES,
+    RESULT_STORE_DIR,
+    RESULT_STORE_MAX_AGE_SECONDS,
 )
 
 from db import (
-    try_connect, 
+    pooled_connection, 
     odbc_conn_str_windows, 
     #fetch_tables_and_columns_cached,
     #schema_to_text, 
-    run_query, ensure_chat_table, insert_chat_turn
+    run_query, query_cache_stats, guard_query_cost, estimate_plan, estimated_bytes,
+    cancel_queries, QueryTimeout, QueryLockTimeout, QueryCancelled,
 )
 from llm import montar_prompt, call_azure_openai_completion, extract_sql, metric_hints_for_question, classify_intent, call_azure_openai_general, clear_intent_cache
+from turn_writer import get_turn_writer
+from llm import needs_llm_classification, start_sql_completion, llm_admission_stats
 from sql_utils import sql_sanity_rewrite, validate_sql, validate_known_tables, enforce_new_plants_sql, validate_blocked_tables
+from sql_utils import route_dash_tables, dash_table_for, project_star_columns
 from feedback_utils import _append_feedback_txt
+from feedback_store import get_feedback_store
+from example_pool import get_example_pool
 from ui_utils import narrate_result
-from rules import SCHEMA_INFO, METRIC_RULES, EXEMPLOS_SQL
+from rules import SCHEMA_INFO, metric_rules, EXEMPLOS_SQL
+from question_cache import get_question_cache, rules_version
+from result_store import ResultStore, prune_spill_dirs
+from chat_context import ChatContext
+from token_count import count_tokens
+
+METRIC_RULES = metric_rules()  # recalculado a cada rerun: o mês corrente entra nas regras
+RULES_VERSION = rules_version(SCHEMA_INFO, METRIC_RULES, REGRAS_GERAIS, EXEMPLOS_SQL)
 
 import logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -122,7 +152,8 @@ if not st.session_state.connected:
         from config import DEFAULT_SQL_SERVER, DEFAULT_DRIVER
         conn_str = odbc_conn_str_windows(DEFAULT_SQL_SERVER, DEFAULT_DATABASE, DEFAULT_DRIVER)
         st.session_state.conn_str = conn_str
-        conn = try_connect(st.session_state.conn_str); conn.close()
+        with pooled_connection(st.session_state.conn_str):  # valida e já deixa a conexão no pool
+            pass
         st.session_state.connected = True
 
 
@@ -135,7 +166,32 @@ if not st.session_state.connected:
 st.session_state.setdefault('history_token_budget', DEFAULT_HISTORY_TOKEN_BUDGET)
 # session_id único por sessão
 if 'session_id' not in st.session_state:
-    st.session_state.session_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    st.session_state.session_id = uuid.uuid4().hex
+# Nova execução do script (rerun): cancela consulta da execução anterior ainda no servidor
+cancel_queries(st.session_state.session_id)
+# Resultados das respostas: as mensagens guardam só a chave no result_store da sessão
+if "result_store" not in st.session_state:
+    prune_spill_dirs(RESULT_STORE_DIR, RESULT_STORE_MAX_AGE_SECONDS)
+    st.session_state.result_store = ResultStore(
+        os.path.join(RESULT_STORE_DIR, f"{st.session_state.session_id}-{uuid.uuid4().hex[:8]}"),
+        max_items=RESULT_STORE_MEM_ITEMS, max_bytes=RESULT_STORE_MEM_BYTES, fallback_rows=QUERY_FIRST_PAGE_ROWS,
+    )
+
+
+def dataframe_message(df: pd.DataFrame, summary: str) -> dict:
+    """Mensagem de resultado: o DataFrame vai para o result_store e a mensagem fica com a chave."""
+    key = st.session_state.result_store.put(df) if df is not None else None
+    rows = len(df) if df is not None else 0
+    return {"role": "assistant", "type": "dataframe", "content": key, "rows": rows, "summary": summary}
+
+
+def message_frame(m: dict):
+    """DataFrame de uma mensagem 'dataframe' (mensagens antigas ainda guardam o próprio DataFrame)."""
+    ref = m.get("content")
+    if ref is None or isinstance(ref, pd.DataFrame):
+        return ref
+    return st.session_state.result_store.get(ref)
+
 
 # Render histórico (somente a verdade oficial da UI)
 MAX_MSGS = 40
@@ -168,10 +224,22 @@ for idx, m in enumerate(msgs):
                 # usa classe já existente no seu CSS
                 st.markdown(f"<div class='assistant-summary'>{summary}</div>", unsafe_allow_html=True)
 
-            df = m.get("content")
-            if df is not None:
-                # Expande apenas o último dataframe por padrão
-                st.expander("Ver tabela", expanded=(idx == last_df_idx)).dataframe(df, use_container_width=True)
+            ref = m.get("content")
+            if ref is not None:
+                # Só o último dataframe vem aberto; os anteriores só são carregados quando abertos
+                if idx == last_df_idx:
+                    df = message_frame(m)
+                    box = st.expander("Ver tabela", expanded=True)
+                elif st.toggle(f"Ver tabela ({m.get('rows', 0):,} linhas)".replace(",", "."),
+                               key=f"show_df_{ref if isinstance(ref, str) else idx}"):
+                    df, box = message_frame(m), st.container()
+                else:
+                    df, box = None, None
+                if box is not None:
+                    if df is None:
+                        box.caption("Resultado não está mais disponível.")
+                    else:
+                        box.dataframe(df, use_container_width=True)
 
         else:
             # Texto normal (pergunta do usuário ou resposta em markdown)
@@ -237,52 +305,95 @@ def tool_carteira_mes(user_q: str, args: Dict[str, Any]) -> ToolResult:
         return {"type":"text", "text":"Parâmetro 'mes' deve estar no formato YYYY-MM."}
 
     year, month = map(int, mes.split("-"))
-    start = f"{year:04d}-{month:02d}-01 00:00:00"
-    if month == 12:
-        end = f"{year+1:04d}-01-01 00:00:00"
-    else:
-        end = f"{year:04d}-{month+1:02d}-01 00:00:00"
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    table = dash_table_for(start.date(), end.date())  # um mês nunca atravessa as duas bases
 
+    # Data_Entrega já é datetime: intervalo direto na coluna e datas como parâmetros (um só plano);
+    # hints de leitura ficam a cargo do SQL_READ_POLICY no executor
     sql = f"""
         SELECT
           COUNT(DISTINCT RecordID) AS QTD_REGISTROS,
           COALESCE(SUM(M2_Bruto),0) AS M2_BRUTO_CARTEIRA
-        FROM dbo.DASH_ATUAL WITH (NOLOCK)
-        WHERE TRY_CONVERT(datetime, Data_Entrega) >= '{start}'
-          AND TRY_CONVERT(datetime, Data_Entrega) <  '{end}';
+        FROM dbo.{table}
+        WHERE Data_Entrega >= ?
+          AND Data_Entrega <  ?;
     """
-    df = run_query(st.session_state.conn_str, sql)
-    return {"type":"dataframe", "df": df, "summary": f"Carteira de {mes} (DASH_ATUAL)."}
+    df = run_query(st.session_state.conn_str, sql, params=(start, end), query_class="tool")
+    return {"type":"dataframe", "df": df, "summary": f"Carteira de {mes} ({table})."}
 
 
 
 
 
 # === Utilitários de contexto/máscara ===
-def _approx_tokens(s: str) -> int:
-    if not s:
-        return 0
-    # aproximação (~4 chars por token)
-    return max(1, int(len(s) / 4))
-
-def _mask_pii_column(colname: str) -> bool:
-    name_up = (colname or "").upper()
-    return any(h in name_up for h in PII_COLUMN_HINTS)
-
-def _mask_cell(colname: str, val) -> str:
-    s = "" if val is None else str(val)
-    if _mask_pii_column(colname):
-        # hash curta mantendo padrão estável para repetição
-        import hashlib
-        h = hashlib.sha1(s.encode("utf-8", errors="ignore")).hexdigest()[:6]
-        return f"{colname}_***{h}"
-    # truncagem leve por célula no contexto
-    s = s.replace("\n", " ").strip()
-    return (s[:24] + "…") if len(s) > 25 else s
+def chat_context() -> ChatContext:
+    """Contexto incremental da sessão (montado a partir das mensagens existentes na 1ª vez)."""
+    ctx = st.session_state.get("chat_context")
+    if ctx is None:
+        ctx = ChatContext(count_tokens)
+        for m in st.session_state.messages:
+            ctx.add(m, message_frame(m) if m.get("type") == "dataframe" else None)
+        st.session_state.chat_context = ctx
+    return ctx
+
+def post_message(m: dict, df: pd.DataFrame = None):
+    """Acrescenta a mensagem ao chat e já deixa pronto o bloco dela no contexto do prompt."""
+    st.session_state.messages.append(m)
+    chat_context().add(m, df)
 
 # COLE em app.py (logo após o TOOL_REGISTRY e run_tool)
 
-def handle_intent(q: str, intent: dict):
+def build_sql_prompt(q: str, hist_blocks: list, prompt_stats: dict = None) -> str:
+    prompt_stats = {} if prompt_stats is None else prompt_stats
+    prompt = montar_prompt(
+        pergunta_usuario=q,
+        schema_info=SCHEMA_INFO,
+        regras_metricas=METRIC_RULES + "\n\n" + "\n".join(f"- {r}" for r in REGRAS_GERAIS),
+        exemplos_pool=get_example_pool(),
+        dbname=DEFAULT_DATABASE,
+        k_exemplos=st.session_state.k_exemplos,
+        historico_blocks=hist_blocks,
+        stats=prompt_stats,
+        prefix_version=RULES_VERSION,
+    )
+    log.info("prompt tokens (%s, orçamento %s): %s cortes=%s", prompt_stats.get("tokenizer"),
+             prompt_stats.get("prompt_budget"), prompt_stats.get("prompt_tokens"), prompt_stats.get("prompt_trimmed"))
+    return prompt
+
+def start_speculative_sql(q: str):
+    """
+    Quando a heurística não decide a rota (classify_intent vai chamar o LLM), já dispara
+    a geração de SQL em paralelo. Retorna None se não houver o que especular.
+    """
+    if not (SPECULATIVE_SQL and needs_llm_classification(q)):
+        return None
+    hist_blocks = chat_context_blocks(max_tokens=st.session_state.history_token_budget)
+    hist = "\n\n".join(hist_blocks)
+    if QUESTION_CACHE_ENABLED and get_question_cache().lookup(q, hist, RULES_VERSION, record=False)[0]:
+        return None
+    prompt_stats = {}
+    prompt = build_sql_prompt(q, hist_blocks, prompt_stats)
+    future = start_sql_completion(
+        prompt, temperature=DEFAULT_TEMP, top_p=DEFAULT_TOP_P,
+        max_completion_tokens=DEFAULT_MAX_COMPLETION_TOKENS,
+    )
+    return {"future": future, "hist_blocks": hist_blocks, "prompt": prompt, "prompt_stats": prompt_stats,
+            "started": time.perf_counter(), "t_classify": 0.0}
+
+def discard_speculation(spec: dict, route: str):
+    """Cancela a geração especulativa e registra os tokens gastos à toa."""
+    fut = spec["future"]
+    if fut.done() and not fut.cancelled() and fut.exception() is None:
+        _, usage, _ = fut.result()
+        wasted = (usage or {}).get("total_tokens") or 0
+    else:
+        fut.cancel()
+        wasted = count_tokens(spec["prompt"])  # prompt já enviado
+    log.info("especulação descartada: rota=%s classificação=%.2fs tokens desperdiçados≈%s",
+             route, spec["t_classify"], wasted)
+
+def handle_intent(q: str, intent: dict, spec: dict = None):
     route = (intent or {}).get("route", "sql")
     try:
         if route == "gpt":
@@ -291,44 +402,71 @@ def handle_intent(q: str, intent: dict):
                 max_completion_tokens=DEFAULT_MAX_COMPLETION_TOKENS
             )
             st.session_state.last_usage = usage
-            st.session_state.messages.append({"role":"assistant","content":answer})
+            post_message({"role":"assistant","content":answer})
+            persist_turn("assistant", "text", answer)
             return
 
         if route == "tool":
             tool_name = (intent or {}).get("tool")
             args = (intent or {}).get("args") or {}
             if not tool_name or tool_name not in TOOL_REGISTRY:
-                st.session_state.messages.append({"role":"assistant","content":"Ferramenta não encontrada. Tente: carteira_mes."})
+                post_message({"role":"assistant","content":"Ferramenta não encontrada. Tente: carteira_mes."})
                 return
             result = run_tool(tool_name, q, args)
             if result.get("type") == "dataframe":
                 df = result.get("df")
                 summary_text = result.get("summary") or make_user_friendly_summary(df)
-                st.session_state.messages.append({"role":"assistant","type":"dataframe","content":df,"summary":summary_text})
+                post_message(dataframe_message(df, summary_text), df)
             else:
-                st.session_state.messages.append({"role":"assistant","content":result.get("text") or "Ok."})
+                post_message({"role":"assistant","content":result.get("text") or "Ok."})
             return
 
         # --- route == "sql" ---
-        hist = build_chat_context(max_tokens=st.session_state.history_token_budget)
-        safe_examples = EXEMPLOS_SQL
-
-        prompt = montar_prompt(
-            pergunta_usuario=q,
-            schema_info=SCHEMA_INFO,
-            regras_metricas=METRIC_RULES + "\n\n" + "\n".join(f"- {r}" for r in REGRAS_GERAIS),
-            exemplos_pool=safe_examples,
-            dbname=DEFAULT_DATABASE,
-            k_exemplos=st.session_state.k_exemplos,
-            historico_text=hist,
-        )
-        raw_text, usage = call_azure_openai_completion(
-            prompt,
-            temperature=DEFAULT_TEMP,
-            top_p=DEFAULT_TOP_P,
-            max_completion_tokens=DEFAULT_MAX_COMPLETION_TOKENS
-        )
+        if spec is not None:
+            hist_blocks = spec["hist_blocks"]
+        else:
+            hist_blocks = chat_context_blocks(max_tokens=st.session_state.history_token_budget)
+        hist = "\n\n".join(hist_blocks)
+
+        # Pergunta repetida (mesmo contexto e mesma versão de regras): pula o LLM
+        cached_sql, cache_key = (None, None)
+        if QUESTION_CACHE_ENABLED:
+            cached_sql, cache_key = get_question_cache().lookup(q, hist, RULES_VERSION)
+        if cached_sql:
+            log.info("question cache hit: %s", cache_key)
+            if spec is not None:
+                discard_speculation(spec, "sql (cache)")
+            st.session_state.last_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            run_validated_sql(q, cached_sql, cache_key=cache_key, from_cache=True, hist=hist)
+            return
+
+        if spec is not None:
+            # SQL já gerada em paralelo à classificação (execução especulativa)
+            raw_text, usage, t_gen = spec["future"].result()
+            prompt_stats = spec["prompt_stats"]
+            saved = min(spec["t_classify"], t_gen)
+            log.info("especulação aproveitada: classificação=%.2fs geração=%.2fs economia≈%.2fs",
+                     spec["t_classify"], t_gen, saved)
+            usage = {**(usage or {}), "speculative_saved_s": round(saved, 3)}
+        else:
+            prompt_stats = {}
+            prompt = build_sql_prompt(q, hist_blocks, prompt_stats)
+            # Streaming: para de ler no '--END'; mostra a SQL parcial quando ela não está oculta
+            live = st.empty()
+            show_partial = LLM_STREAMING and (not HIDE_SQL_IN_UI or DEBUG_SHOW_MODEL_RAW)
+            raw_text, usage = call_azure_openai_completion(
+                prompt,
+                temperature=DEFAULT_TEMP,
+                top_p=DEFAULT_TOP_P,
+                max_completion_tokens=DEFAULT_MAX_COMPLETION_TOKENS,
+                stream=LLM_STREAMING,
+                on_delta=(lambda txt: live.code(extract_sql(txt) or txt, language="sql")) if show_partial else None,
+            )
+            live.empty()
+        usage = {**(usage or {}), **prompt_stats}
         st.session_state.last_usage = usage
+        log.info("llm usage: %s", usage)
+        log.info("llm admission: %s", llm_admission_stats())
 
         sql1 = extract_sql(raw_text)
         if not sql1:
@@ -345,129 +483,154 @@ def handle_intent(q: str, intent: dict):
 
         sql1 = sql_sanity_rewrite(sql1)
         sql1 = enforce_new_plants_sql(sql1, q)
-        st.session_state.messages.append({"role":"assistant","type":"sql","content":sql1})
-
-        ok1, msg1 = validate_sql(sql1)
-        ok2, msg2 = (True,"ok") if not SCHEMA_INFO else validate_known_tables(sql1, SCHEMA_INFO)
-        ok3, msg3 = validate_blocked_tables(sql1)
-        if not ok1:
-            st.error(f"SQL inválido: {msg1}")
-        if not ok2:
-            st.warning(msg2)
-        if not ok3:
-            st.error(msg3)
-            return
-
-        df = run_query(st.session_state.conn_str, sql1)
-        st.session_state.last_question_sql = {"q": q, "sql": sql1}
-        try:
-            summary_text = narrate_result(q, sql1, df)
-        except Exception:
-            summary_text = make_user_friendly_summary(df)
-
-        st.session_state.messages.append({"role":"assistant","type":"dataframe","content":df,"summary":summary_text})
+        run_validated_sql(q, sql1, cache_key=cache_key, from_cache=False, hist=hist)
 
     except Exception as e:
         log.exception("Falha no handle_intent")
         st.error(f"Erro geral: {e}")
-        st.session_state.messages.append({"role": "assistant", "content": "Opa, algo deu errado ao processar sua solicitação. Tente reformular ou informar o período/tabela desejada."})
+        post_message({"role": "assistant", "content": "Opa, algo deu errado ao processar sua solicitação. Tente reformular ou informar o período/tabela desejada."})
 
 
-def build_chat_context(max_tokens: int = None) -> str:
-    """
-    Constrói o contexto baseado em orçamento de tokens.
-    Inclui: últimos 2 turnos (user/assistant), APENAS a última SQL válida,
-    e mini-CSV mascarado (2 linhas x 5 colunas).
-    """
-    budget = max_tokens or DEFAULT_HISTORY_TOKEN_BUDGET
-    used = 0
-    blocks = []
-
-    # 1) mensagens mais recentes
-    messages = list(reversed(st.session_state.messages))
-
-    # 2) última SQL
-    last_sql = None
-    for m in messages:
-        if m.get("type") == "sql":
-            content = (m.get("content") or "").strip()
-            if content:
-                last_sql = content
-                break
-
-    # 3) últimos 2 turnos (user/assistant)
-    turns = []
-    user_count = 0
-    for m in messages:
-        role = m.get("role")
-        mtype = m.get("type")
-        if role == "user":
-            turns.append(("user", (m.get("content") or "").strip()))
-            user_count += 1
-            if user_count >= 2:
-                break
+def persist_turn(role: str, type_: str, content: str = None, summary: str = None):
+    """Enfileira o registro no chat_turns; a gravação é em background e nunca bloqueia o turno."""
+    if PERSIST_TURNS and st.session_state.conn_str:
+        get_turn_writer().enqueue(
+            st.session_state.conn_str, st.session_state.session_id, role, type_, content, summary
+        )
+
+
+def run_validated_sql(q: str, sql1: str, *, cache_key: str = None, from_cache: bool = False, hist: str = ""):
+    """Valida, executa e publica o resultado; guarda a SQL no cache de perguntas se deu certo."""
+    generated_sql = sql1  # o cache guarda a SQL sem roteamento: a tabela DASH é escolhida a cada execução
+    if DASH_ROUTING_ENABLED:
+        sql1 = route_dash_tables(sql1)
+    projection = None
+    if PROJECTION_REWRITE_ENABLED:
+        projection = project_star_columns(sql1, SCHEMA_INFO, q, QUERY_PREVIEW_MAX_COLUMNS)
+        if projection["columns_after"]:
+            projection["original_sql"], sql1 = sql1, projection["sql"]
         else:
-            if mtype == "dataframe":
-                df = m.get("content")
-                summary = (m.get("summary") or "").strip()
-                mini_csv = ""
-                if df is not None:
-                    try:
-                        import pandas as pd
-                        if isinstance(df, pd.DataFrame):
-                            df2 = df.copy()
-                            cols = list(df2.columns)[:5]
-                            df2 = df2[cols].head(2)
-                            for c in cols:
-                                df2[c] = df2[c].map(lambda v: _mask_cell(c, v))
-                            mini_csv = df2.to_csv(index=False)
-                    except Exception:
-                        mini_csv = ""
-                bloco = "Assistente:"
-                if summary:
-                    bloco += f"\nresumo={summary}"
-                if mini_csv:
-                    bloco += f"\nAmostra CSV (até 2 linhas):\n{mini_csv}"
-                turns.append(("assistant", bloco.strip()))
-            elif mtype == "sql":
-                # ignorar aqui; a última SQL entra uma única vez no final
-                pass
-            else:
-                content = (m.get("content") or "").strip()
-                if content:
-                    turns.append(("assistant", content))
+            projection = None
+    post_message({"role":"assistant","type":"sql","content":sql1})
+    persist_turn("assistant", "sql", sql1)
+
+    ok1, msg1 = validate_sql(sql1)
+    ok2, msg2 = (True,"ok") if not SCHEMA_INFO else validate_known_tables(sql1, SCHEMA_INFO)
+    ok3, msg3 = validate_blocked_tables(sql1)
+    if not ok1:
+        st.error(f"SQL inválido: {msg1}")
+    if not ok2:
+        st.warning(msg2)
+    if not ok3:
+        st.error(msg3)
+        return
+
+    guard = guard_query_cost(st.session_state.conn_str, sql1)
+    if guard["action"] != "ok":
+        log.info("cost guard: %s cost=%s rows=%s sql=%s", guard["action"], guard["cost"], guard["est_rows"], sql1)
+    if guard["action"] == "reject":
+        st.error(guard["message"])
+        return
+    if guard["action"] == "warn":
+        st.warning(guard["message"])
+    elif guard["action"] == "cap":
+        st.info(guard["message"])
+        sql1 = guard["sql"]
+
+    preview = st.empty()
+
+    def _show_progress(batch, stream):
+        # primeira página aparece enquanto o restante ainda está chegando
+        if stream.rows == len(batch):
+            preview.dataframe(batch.head(QUERY_FIRST_PAGE_ROWS), use_container_width=True)
+        else:
+            preview.caption(f"Carregando… {stream.rows:,} linhas".replace(",", "."))
 
-    def try_add(text: str) -> bool:
-        nonlocal used, budget, blocks
-        t = _approx_tokens(text)
-        if used + t <= budget:
-            blocks.append(text)
-            used += t
-            return True
-        return False
+    try:
+        df = run_query(st.session_state.conn_str, sql1, on_batch=_show_progress, tag=st.session_state.session_id)
+    except QueryLockTimeout as e:
+        preview.empty()
+        st.warning(str(e))
+        return
+    except (QueryTimeout, QueryCancelled) as e:
+        preview.empty()
+        st.warning(f"{e} Tente restringir o período ou os filtros.")
+        return
+    preview.empty()
+    log.info("query cache: %s", query_cache_stats())
+    if projection is not None:
+        _log_projection(projection, df)
+    if QUESTION_CACHE_ENABLED and not from_cache and ok1 and ok2 and df is not None and not df.empty:
+        cache_key = get_question_cache().store(q, hist, RULES_VERSION, generated_sql)
+    # feedback e exemplos aprendem a SQL gerada (como o cache de perguntas); a executada é só exibição
+    st.session_state.last_question_sql = {
+        "q": q, "sql": generated_sql, "executed_sql": sql1, "cache_key": cache_key, "route": "sql",
+    }
+    try:
+        summary_text = narrate_result(q, sql1, df)
+    except Exception:
+        summary_text = make_user_friendly_summary(df)
+    if df is not None and df.attrs.get("truncated"):
+        summary_text = (summary_text or "") + (
+            f"\n\n_Resultado limitado às primeiras {len(df):,} linhas; refine os filtros para ver tudo._".replace(",", ".")
+        )
+    if projection is not None:
+        summary_text = (summary_text or "") + (
+            f"\n\n_Mostrando {projection['columns_after']} de {projection['columns_before']} colunas; "
+            "peça \"todas as colunas\" para ver o restante._"
+        )
 
-    # adiciona turnos (do mais antigo ao mais recente)
-    for who, text in reversed(turns[:4]):
-        try_add(f"{'Usuário' if who=='user' else 'Assistente'}: {text}")
+    post_message(dataframe_message(df, summary_text), df)
+    persist_turn("assistant", "dataframe", f"{len(df)} linhas" if df is not None else None, summary_text)
 
-    # adiciona última SQL se couber
-    if last_sql:
-        try_add("Assistente (SQL anterior):\n```sql\n" + last_sql + "\n```")
 
-    return "\n\n".join(blocks)
+def _log_projection(projection: dict, df: pd.DataFrame):
+    """Colunas antes/depois da troca do SELECT * e bytes lidos; o plano só com PROJECTION_LOG_PLAN."""
+    parts = [f"projection: {projection['columns_before']} -> {projection['columns_after']} colunas"]
+    if PROJECTION_LOG_PLAN and QUERY_COST_GUARD_ENABLED:
+        before = estimated_bytes(estimate_plan(st.session_state.conn_str, projection["original_sql"]))
+        after = estimated_bytes(estimate_plan(st.session_state.conn_str, projection["sql"]))
+        if before is not None and after is not None:
+            parts.append(f"bytes estimados {before:,.0f} -> {after:,.0f}")
+    if df is not None and "bytes_fetched" in df.attrs:
+        parts.append(f"lidos {df.attrs['bytes_fetched']:,}")
+    log.info("; ".join(parts))
+
+
+def chat_context_blocks(max_tokens: int = None) -> list:
+    """
+    Constrói o contexto baseado em orçamento de tokens, em blocos inteiros.
+    Inclui: últimos 2 turnos (user/assistant), APENAS a última SQL válida,
+    e mini-CSV mascarado (2 linhas x 5 colunas), pré-calculados em post_message.
+    """
+    return chat_context().blocks(max_tokens or DEFAULT_HISTORY_TOKEN_BUDGET)
+
+def record_feedback(payload: dict, positive: bool):
+    """Grava o 👍/👎 no registro estruturado (e nos .txt, se a exportação estiver ligada)."""
+    get_feedback_store().record(
+        payload["q"], payload["sql"], positive,
+        route=payload.get("route", "sql"),
+        latency_ms=payload.get("latency_ms"),
+        usage=payload.get("usage"),
+        session_id=st.session_state.session_id,
+        cache_key=payload.get("cache_key"),
+        rules_version=RULES_VERSION,
+    )
+    if FEEDBACK_TEXT_EXPORT:
+        _append_feedback_txt(POS_FILE if positive else NEG_FILE, payload["q"], payload["sql"])
+    # o pool de exemplos aprende na hora (índice incremental, sem reindexar tudo)
+    pool = get_example_pool()
+    changed = pool.add_positive(payload["q"], payload["sql"]) if positive else pool.add_negative(payload["q"], payload["sql"])
+    if changed:
+        log.info("example pool: %d exemplos (versão %d)", len(pool), pool.version)
 
 # Processamento do turno pendente
 pending = st.session_state.pending_turn
 if pending and pending["id"] > st.session_state.last_processed_turn_id:
     q = pending["question"]
     with st.chat_message("user", avatar=None): st.markdown(q)
-    st.session_state.messages.append({"role": "user", "content": q})
-    if PERSIST_TURNS and st.session_state.conn_str:
-        try:
-            ensure_chat_table(st.session_state.conn_str)
-            insert_chat_turn(st.session_state.conn_str, st.session_state.session_id, "user", "text", q, None)
-        except Exception:
-            pass
+    post_message({"role": "user", "content": q})
+    persist_turn("user", "text", q)
 
     with st.chat_message("assistant", avatar=None):
         if not st.session_state.conn_str:
@@ -484,17 +647,31 @@ if pending and pending["id"] > st.session_state.last_processed_turn_id:
                     except Exception:
                         st.session_state.schema_text = ""
                     """
+                t_turn = time.perf_counter()
+                payload_before = st.session_state.get("last_question_sql")
                 with st.spinner("Analisando dados..."):
                     # 1) Classificar intenção
                     
+                    spec = start_speculative_sql(q)  # SQL em paralelo se a rota depender do LLM
                     intent = classify_intent(q)  # {"route": "sql"|"gpt"|"tool", "tool":..., "args":...}
+                    if spec is not None:
+                        spec["t_classify"] = time.perf_counter() - spec["started"]
+                        if (intent or {}).get("route", "sql") != "sql":
+                            discard_speculation(spec, intent.get("route"))
+                            spec = None
                     # 2) Roteamento LEAN
                   
-                    handle_intent(q, intent)
+                    handle_intent(q, intent, spec=spec)
+
+                # latência e uso do turno acompanham a SQL para o registro de feedback
+                payload_after = st.session_state.get("last_question_sql")
+                if payload_after is not None and payload_after is not payload_before:
+                    payload_after["latency_ms"] = round((time.perf_counter() - t_turn) * 1000)
+                    payload_after["usage"] = st.session_state.last_usage
 
             except Exception as e:
                 st.error(f"Erro geral: {e}")
-                st.session_state.messages.append({"role": "assistant", "content": f"Erro geral: {e}"})
+                post_message({"role": "assistant", "content": f"Erro geral: {e}"})
 
     st.session_state.last_processed_turn_id = pending["id"]
     st.session_state.pending_turn = None
@@ -515,7 +692,8 @@ if payload and isinstance(payload, dict) and payload.get("q") and payload.get("s
             if st.button("👍", key=f"fb_up_{current_hash}"):
                 if st.session_state.last_feedback_hash != ("up", current_hash):
                     try:
-                        _append_feedback_txt(POS_FILE, payload["q"], payload["sql"])
+                        record_feedback(payload, positive=True)
+                        get_question_cache().mark_feedback(payload.get("cache_key"), positive=True)
                         st.session_state.last_feedback_hash = ("up", current_hash)
                         st.success("Obrigado pelo feedback!")
                     except Exception as e: st.error(f"Falha ao salvar feedback: {e}")
@@ -523,7 +701,8 @@ if payload and isinstance(payload, dict) and payload.get("q") and payload.get("s
             if st.button("👎", key=f"fb_down_{current_hash}"):
                 if st.session_state.last_feedback_hash != ("down", current_hash):
                     try:
-                        _append_feedback_txt(NEG_FILE, payload["q"], payload["sql"])
+                        record_feedback(payload, positive=False)
+                        get_question_cache().mark_feedback(payload.get("cache_key"), positive=False)
                         st.session_state.last_feedback_hash = ("down", current_hash)
                         st.warning("Obrigado pelo feedback!")
                     except Exception as e: st.error(f"Falha ao salvar feedback: {e}")
@@ -533,5 +712,7 @@ if payload and isinstance(payload, dict) and payload.get("q") and payload.get("s
 if "last_usage" in st.session_state and st.session_state.last_usage:
     u = st.session_state.last_usage
     total_tokens = u.get("total_tokens", 0)
-    st.markdown(f"<div class='token-counter'>Tokens usados: {total_tokens}</div>", unsafe_allow_html=True)
+    cached_tokens = u.get("cached_tokens") or 0
+    cached_txt = f" (cache: {cached_tokens})" if cached_tokens else ""
+    st.markdown(f"<div class='token-counter'>Tokens usados: {total_tokens}{cached_txt}</div>", unsafe_allow_html=True)
 
@@ -0,0 +1,92 @@
+# benchmarks/bench_autoparam.py — SQL com literais (antigo) vs literais ligados como parâmetros
+#
+# Uso:
+#   python benchmarks/bench_autoparam.py        # formatos distintos de statement e custo da parametrização
+#   python benchmarks/bench_autoparam.py --db   # + tempo de compilação no SQL Server (SET STATISTICS TIME)
+# Gera variações de mesmo formato (planta x mês) a partir do exemplo de volume por planta.
+# Com --db usa SQL_SERVER/SQL_DATABASE/SQL_DRIVER do config (ou a connection string em BENCH_CONN_STR).
+
+import os
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import PLANTAS
+from sql_utils import parameterize_sql, sql_sanity_rewrite
+
+TEMPLATE = """
+SELECT CIDADE, SUM(AREA) AS AREA_TOTAL_LIQUIDA
+FROM VW_DEVOLUCAO_LAB WITH (NOLOCK)
+WHERE CIDADE COLLATE Latin1_General_CI_AI = '{planta}'
+  AND MONTH(DATA_EMISSAO) = {mes}
+  AND YEAR(DATA_EMISSAO) = 2025
+  AND GRUPO_PRODUTO NOT IN ('PAPEL','BOBINA')
+  AND TIPO IN ('VENDA','DEVOLUCAO')
+GROUP BY CIDADE
+"""
+_COMPILE = re.compile(r"parse and compile time:\s*CPU time = (\d+) ms, elapsed time = (\d+) ms", re.IGNORECASE)
+
+
+def variants() -> list[str]:
+    return [sql_sanity_rewrite(TEMPLATE.format(planta=p, mes=m)) for p in PLANTAS for m in range(1, 13)]
+
+
+def compile_ms(cur) -> float:
+    """Soma o tempo de compilação reportado pelo SET STATISTICS TIME (pyodbc >= 4.0.31: cursor.messages)."""
+    total = 0.0
+    while True:
+        for _, msg in getattr(cur, "messages", None) or []:
+            for _, elapsed in _COMPILE.findall(str(msg)):
+                total += float(elapsed)
+        if not cur.nextset():
+            return total
+
+
+def compare_on_db(sqls):
+    import db
+    from config import DEFAULT_SQL_SERVER, DEFAULT_DATABASE, DEFAULT_DRIVER
+    conn_str = os.getenv("BENCH_CONN_STR") or db.odbc_conn_str_windows(DEFAULT_SQL_SERVER, DEFAULT_DATABASE, DEFAULT_DRIVER)
+    run = uuid.uuid4().hex[:8]  # texto novo a cada execução: nenhuma das variantes começa com plano em cache
+    totals = {}
+    with db.pooled_connection(conn_str) as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SET STATISTICS TIME ON;")
+        for mode in ("literal", "param"):
+            ms, t0 = 0.0, time.perf_counter()
+            for sql in sqls:
+                text = f"/* bench {run} {mode} */ " + sql
+                if mode == "literal":
+                    db._execute(cur, text)
+                else:
+                    db._execute(cur, *parameterize_sql(text))
+                cur.fetchall()
+                ms += compile_ms(cur)
+            totals[mode] = (ms, time.perf_counter() - t0)
+        cur.execute("SET STATISTICS TIME OFF;")
+        cur.close()
+    print(f"\n{'modo':>8} {'compilação ms':>14} {'total s':>8}")
+    for mode, (ms, secs) in totals.items():
+        print(f"{mode:>8} {ms:>14.0f} {secs:>8.2f}")
+    saved = totals["literal"][0] - totals["param"][0]
+    print(f"compilação economizada: {saved:.0f} ms em {len(sqls)} consultas")
+
+
+def main():
+    sqls = variants()
+    t0 = time.perf_counter()
+    lifted = [parameterize_sql(s) for s in sqls]
+    us = (time.perf_counter() - t0) * 1e6 / len(sqls)
+    print(f"{len(sqls)} consultas ({len(PLANTAS)} plantas x 12 meses)")
+    print(f"statements distintos com literais:   {len(set(sqls))}")
+    print(f"statements distintos parametrizados: {len({s for s, _ in lifted})}")
+    print(f"parametrização: {us:.1f} us/consulta")
+    if "--db" in sys.argv:
+        compare_on_db(sqls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# benchmarks/bench_chat_context.py — contexto reconstruído a cada turno (antigo) vs blocos pré-calculados
+#
+# Uso: python benchmarks/bench_chat_context.py
+# Sessões de 10/100/1000 turnos (pergunta + SQL + resultado); mede o custo de montar o
+# contexto do próximo prompt. No novo caminho, add() roda uma vez por mensagem na resposta.
+
+import hashlib
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_context import ChatContext
+from config import PII_COLUMN_HINTS, DEFAULT_HISTORY_TOKEN_BUDGET
+
+
+def approx_tokens(s: str) -> int:
+    return max(1, int(len(s) / 4)) if s else 0
+
+
+# --- implementação antiga (referência) ---
+def legacy_mask_cell(colname, val):
+    s = "" if val is None else str(val)
+    if any(h in (colname or "").upper() for h in PII_COLUMN_HINTS):
+        h = hashlib.sha1(s.encode("utf-8", errors="ignore")).hexdigest()[:6]
+        return f"{colname}_***{h}"
+    s = s.replace("\n", " ").strip()
+    return (s[:24] + "…") if len(s) > 25 else s
+
+
+def legacy_build(all_messages, budget):
+    used, blocks = 0, []
+    messages = list(reversed(all_messages))
+    last_sql = None
+    for m in messages:
+        if m.get("type") == "sql":
+            content = (m.get("content") or "").strip()
+            if content:
+                last_sql = content
+                break
+    turns, user_count = [], 0
+    for m in messages:
+        if m.get("role") == "user":
+            turns.append(("user", (m.get("content") or "").strip()))
+            user_count += 1
+            if user_count >= 2:
+                break
+        elif m.get("type") == "dataframe":
+            df, summary, sample = m.get("content"), (m.get("summary") or "").strip(), ""
+            if df is not None:
+                df2 = df.copy()
+                cols = list(df2.columns)[:5]
+                df2 = df2[cols].head(2)
+                for c in cols:
+                    df2[c] = df2[c].map(lambda v: legacy_mask_cell(c, v))
+                sample = df2.to_csv(index=False)
+            bloco = "Assistente:"
+            if summary:
+                bloco += f"\nresumo={summary}"
+            if sample:
+                bloco += f"\nAmostra CSV (até 2 linhas):\n{sample}"
+            turns.append(("assistant", bloco.strip()))
+        elif m.get("type") != "sql":
+            content = (m.get("content") or "").strip()
+            if content:
+                turns.append(("assistant", content))
+
+    def try_add(text):
+        nonlocal used
+        t = approx_tokens(text)
+        if used + t <= budget:
+            blocks.append(text)
+            used += t
+
+    for who, text in reversed(turns[:4]):
+        try_add(f"{'Usuário' if who == 'user' else 'Assistente'}: {text}")
+    if last_sql:
+        try_add("Assistente (SQL anterior):\n```sql\n" + last_sql + "\n```")
+    return "\n\n".join(blocks)
+
+
+def result_frame(rows: int = 20000) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "NOME_CLI": [f"CLIENTE {i % 700}" for i in range(rows)],
+        "CIDADE": rng.choice(["BENTO", "MARANGUAPE", "PIRAPETINGA"], rows),
+        "EMISSAO": pd.date_range("2025-01-01", periods=rows, freq="h"),
+        **{f"M{k}": rng.random(rows) * 1000 for k in range(9)},
+    })
+
+
+def session(turns: int, df: pd.DataFrame) -> list[dict]:
+    msgs = []
+    for i in range(turns):
+        msgs.append({"role": "user", "content": f"volume por planta em {i % 12 + 1}/2025"})
+        msgs.append({"role": "assistant", "type": "sql",
+                     "content": f"SELECT CIDADE, SUM(AREA) FROM VW_DEVOLUCAO_LAB WHERE MONTH(DATA_EMISSAO) = {i % 12 + 1} GROUP BY CIDADE"})
+        msgs.append({"role": "assistant", "type": "dataframe", "content": df, "summary": f"{len(df)} linhas no mês {i % 12 + 1}."})
+    return msgs
+
+
+def main():
+    df = result_frame()
+    print(f"{'turnos':>7} {'antigo us/turno':>16} {'add us/msg':>11} {'build us':>9} {'igual':>6}")
+    for turns in (10, 100, 1000):
+        msgs = session(turns, df)
+        reps = 50
+
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            old = legacy_build(msgs, DEFAULT_HISTORY_TOKEN_BUDGET)
+        legacy_us = (time.perf_counter() - t0) * 1e6 / reps
+
+        ctx = ChatContext(approx_tokens)
+        t0 = time.perf_counter()
+        for m in msgs:
+            ctx.add(m, m["content"] if m.get("type") == "dataframe" else None)
+        add_us = (time.perf_counter() - t0) * 1e6 / len(msgs)
+
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            new = ctx.build(DEFAULT_HISTORY_TOKEN_BUDGET)
+        build_us = (time.perf_counter() - t0) * 1e6 / reps
+        print(f"{turns:>7} {legacy_us:>16.1f} {add_us:>11.1f} {build_us:>9.1f} {str(new == old):>6}")
+
+
+if __name__ == "__main__":
+    main()
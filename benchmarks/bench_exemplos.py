@@ -0,0 +1,73 @@
+# benchmarks/bench_exemplos.py — SequenceMatcher (antigo) vs índice TF-IDF na seleção de exemplos
+#
+# Uso: python benchmarks/bench_exemplos.py
+# Gera pools sintéticos (variações de EXEMPLOS_SQL por planta/mês) com 100, 1k e 10k exemplos.
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import EXEMPLOS_SQL, PLANTAS
+from llm import _sim, _normalize_text
+from example_index import ExampleIndex
+
+MESES = ["janeiro", "fevereiro", "março", "abril", "maio", "junho",
+         "julho", "agosto", "setembro", "outubro", "novembro", "dezembro"]
+PERGUNTAS = [
+    "volume em maranguape em agosto",
+    "carteira de setembro por unidade",
+    "top 20 clientes por area saldo em bento",
+    "otif final de uberaba em julho de 2025",
+]
+
+
+def synthetic_pool(n: int, seed: int = 7) -> list[dict]:
+    rnd = random.Random(seed)
+    pool = []
+    while len(pool) < n:
+        base = EXEMPLOS_SQL[len(pool) % len(EXEMPLOS_SQL)]
+        planta, mes = rnd.choice(PLANTAS), rnd.randrange(12)
+        pool.append({
+            "pergunta": f"{base['pergunta']} — {planta.title()} em {MESES[mes]}",
+            "sql": base["sql"].replace("MARANGUAPE", planta).replace("= 8", f"= {mes + 1}"),
+        })
+    return pool
+
+
+def legacy_top_k(pergunta: str, pool: list[dict], k: int) -> list[dict]:
+    pnorm = _normalize_text(pergunta)
+    scored = [(max(_sim(pnorm, ex["pergunta"]), _sim(pnorm, ex["sql"])), ex) for ex in pool]
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [ex for _, ex in scored[:k]]
+
+
+def main():
+    print(f"{'pool':>7} {'legacy ms/q':>12} {'build ms':>9} {'index ms/q':>11} {'speedup':>8}")
+    for n in (100, 1_000, 10_000):
+        pool = synthetic_pool(n)
+        perguntas = PERGUNTAS if n <= 1_000 else PERGUNTAS[:1]
+
+        t0 = time.perf_counter()
+        for q in perguntas:
+            legacy_top_k(q, pool, 12)
+        legacy = (time.perf_counter() - t0) * 1000 / len(perguntas)
+
+        t0 = time.perf_counter()
+        index = ExampleIndex(pool)
+        build = (time.perf_counter() - t0) * 1000
+
+        reps = 20
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            for q in PERGUNTAS:
+                index.top_k(q, 12)
+        fast = (time.perf_counter() - t0) * 1000 / (reps * len(PERGUNTAS))
+
+        print(f"{n:>7} {legacy:>12.1f} {build:>9.1f} {fast:>11.2f} {legacy / fast:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# benchmarks/bench_sargable_dates.py — predicados de data com função (antigo) vs intervalos na coluna nua
+#
+# Uso:
+#   python benchmarks/bench_sargable_dates.py            # só reescrita (mostra antes/depois e custo da reescrita)
+#   python benchmarks/bench_sargable_dates.py --db       # + plano estimado e tempo de execução no SQL Server
+# Com --db usa SQL_SERVER/SQL_DATABASE/SQL_DRIVER do config (ou a connection string em BENCH_CONN_STR).
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sql_utils
+from rules import EXEMPLOS_SQL, SCHEMA_INFO
+
+EXTRA = [
+    "SELECT CIDADE, SUM(AREA) AS AREA FROM VW_DEVOLUCAO_LAB WITH (NOLOCK) "
+    "WHERE YEAR(DATA_EMISSAO) = 2025 AND GRUPO_PRODUTO NOT IN ('PAPEL','BOBINA') GROUP BY CIDADE",
+    "SELECT COUNT(*) FROM dbo.DASH_HISTORICO WITH (NOLOCK) "
+    "WHERE CAST(Data_Entrega AS date) = '2025-09-15'",
+    "SELECT Unit, SUM(M2_Bruto) FROM dbo.DASH_HISTORICO WITH (NOLOCK) "
+    "WHERE MONTH(Data_Embarque) = 3 AND YEAR(Data_Embarque) = 2025 GROUP BY Unit",
+]
+
+
+def query_set() -> list[str]:
+    sqls = [ex["sql"] for ex in EXEMPLOS_SQL if any(f in ex["sql"].upper() for f in ("YEAR(", "MONTH(", "TRY_CONVERT("))]
+    return sqls + EXTRA
+
+
+def legacy(sql: str) -> str:
+    return sql_utils._year_month_rewrite(sql)
+
+
+def sargable(sql: str) -> str:
+    return sql_utils.sargable_date_rewrite(legacy(sql), SCHEMA_INFO)
+
+
+def rewrite_overhead(queries, reps=200) -> float:
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        sql_utils.tokenize.cache_clear()
+        for q in queries:
+            sargable(q)
+    return (time.perf_counter() - t0) * 1e6 / (reps * len(queries))
+
+
+def best_of(fn, n=3) -> float:
+    best = float("inf")
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def compare_on_db(pairs):
+    import db
+    from config import DEFAULT_SQL_SERVER, DEFAULT_DATABASE, DEFAULT_DRIVER
+    conn_str = os.getenv("BENCH_CONN_STR") or db.odbc_conn_str_windows(DEFAULT_SQL_SERVER, DEFAULT_DATABASE, DEFAULT_DRIVER)
+    print(f"\n{'#':>3} {'custo antes':>12} {'custo depois':>13} {'ms antes':>9} {'ms depois':>10}")
+    for n, (before, after) in enumerate(pairs, 1):
+        est_b, est_a = db.estimate_plan(conn_str, before), db.estimate_plan(conn_str, after)
+        t_b = best_of(lambda: db.run_query(conn_str, before, use_cache=False))
+        t_a = best_of(lambda: db.run_query(conn_str, after, use_cache=False))
+        cost_b = f"{est_b['cost']:.3f}" if est_b else "-"
+        cost_a = f"{est_a['cost']:.3f}" if est_a else "-"
+        print(f"{n:>3} {cost_b:>12} {cost_a:>13} {t_b * 1e3:>9.1f} {t_a * 1e3:>10.1f}")
+
+
+def main():
+    queries = query_set()
+    pairs = [(legacy(q), sargable(q)) for q in queries]
+    changed = sum(b != a for b, a in pairs)
+    for n, (before, after) in enumerate(pairs, 1):
+        if before == after:
+            continue
+        print(f"--- #{n} antes\n{before}\n--- #{n} depois\n{after}\n")
+    print(f"{changed}/{len(pairs)} consultas reescritas; reescrita completa {rewrite_overhead(queries):.1f} us/consulta")
+    if "--db" in sys.argv:
+        compare_on_db(pairs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# benchmarks/bench_sql_lexer.py — validação/reescrita por regex (antigo) vs lexer de uma passada
+#
+# Uso: python benchmarks/bench_sql_lexer.py
+# Mede o pipeline do app (validate_sql + validate_known_tables + validate_blocked_tables +
+# sql_sanity_rewrite + normalize_sql_key) sobre EXEMPLOS_SQL e CTEs grandes geradas.
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sql_utils
+from config import DEFAULT_YEAR_IF_MISSING
+from rules import EXEMPLOS_SQL, SCHEMA_INFO
+
+# --- implementação antiga (referência) ---
+_LEGACY_BLOCKED = [
+    r"\bdrop\b", r"\balter\b", r"\btruncate\b", r"\bcreate\b", r"\bgrant\b", r"\brevoke\b",
+    r"\bxp_", r"\bsp_", r"\bexec\b", r"\binsert\b", r"\bupdate\b", r"\bdelete\b", r"\bmerge\b"
+]
+
+
+def legacy_validate_sql(sql_text):
+    lowered = f" {sql_text.lower()} "
+    if not re.match(r"^\s*(select|with)\b", sql_text, flags=re.IGNORECASE):
+        return False
+    return not any(re.search(tok, lowered) for tok in _LEGACY_BLOCKED)
+
+
+def legacy_referenced_tables(sql_text, table_names):
+    return [t for t in table_names if re.search(rf"(?i)\b{re.escape(t)}\b", sql_text)]
+
+
+def legacy_sanity_rewrite(sql):
+    s = re.sub(r"--.*?$", "", sql, flags=re.MULTILINE).strip()
+    pat = re.compile(r"YEAR\(\s*(?P<c>[^)]+?)\s*\)\s*=\s*MONTH\(\s*(?P=c)\s*\)\s*=\s*(?P<m>\d{1,2})", re.IGNORECASE)
+    if pat.search(s):
+        s = pat.sub(lambda m: f"YEAR({m.group('c')}) = {DEFAULT_YEAR_IF_MISSING} AND MONTH({m.group('c')}) = {int(m.group('m'))}", s)
+    for col in ["EMISSAO", "DT_ENTREGA1", "DT_ENTREGA", "DATA", "DATA_EMISSAO", "Data_Entrega"]:
+        if re.search(rf"YEAR\(\s*{col}\s*\)", s, flags=re.IGNORECASE):
+            continue
+        mm = re.search(rf"(MONTH\(\s*{col}\s*\)\s*=\s*(\d{{1,2}}))", s, flags=re.IGNORECASE)
+        if mm and 1 <= int(mm.group(2)) <= 12:
+            s = s.replace(mm.group(1), f"{mm.group(1)} AND YEAR({col}) = {DEFAULT_YEAR_IF_MISSING}")
+    return s
+
+
+def legacy_normalize_key(sql):
+    out, sep, i, n = [], False, 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch == "'":
+            if sep and out:
+                out.append(" ")
+            sep = False
+            j = i + 1
+            while j < n:
+                if sql[j] == "'":
+                    if j + 1 < n and sql[j + 1] == "'":
+                        j += 2
+                        continue
+                    break
+                j += 1
+            out.append(sql[i:j + 1])
+            i = j + 1
+        elif sql.startswith("--", i):
+            j = sql.find("\n", i)
+            i = n if j < 0 else j
+            sep = True
+        elif sql.startswith("/*", i):
+            j = sql.find("*/", i + 2)
+            i = n if j < 0 else j + 2
+            sep = True
+        elif ch.isspace():
+            i += 1
+            sep = True
+        else:
+            if sep and out:
+                out.append(" ")
+            sep = False
+            out.append(ch.lower())
+            i += 1
+    return "".join(out).rstrip(";").rstrip()
+
+
+def legacy_pipeline(sql):
+    legacy_validate_sql(sql)
+    legacy_referenced_tables(sql, list(SCHEMA_INFO))
+    legacy_sanity_rewrite(sql)
+    legacy_normalize_key(sql)
+
+
+def lexer_pipeline(sql):
+    sql_utils.tokenize.cache_clear()  # mede o custo real de lexar (sem reaproveitar entre iterações)
+    sql_utils.validate_sql(sql)
+    sql_utils.validate_known_tables(sql, SCHEMA_INFO)
+    sql_utils.validate_blocked_tables(sql)
+    sql_utils._year_month_rewrite(sql)  # mesma reescrita do legado (sem a passada sargable)
+    sql_utils.normalize_sql_key(sql)
+
+
+def big_cte(n_ctes: int) -> str:
+    parts = []
+    for i in range(n_ctes):
+        src = "DASH_HISTORICO" if i == 0 else f"c{i - 1}"
+        parts.append(
+            f"c{i} AS (\n  SELECT EMISSAO, CIDADE, SUM(M2_BRUTO) AS M2 -- etapa {i}\n"
+            f"  FROM {src} WITH (NOLOCK)\n  WHERE MONTH(EMISSAO) = {i % 12 + 1} AND CIDADE <> 'PORTO FELIZ'\n"
+            f"  GROUP BY EMISSAO, CIDADE\n)"
+        )
+    return "WITH " + ",\n".join(parts) + f"\nSELECT * FROM c{n_ctes - 1};"
+
+
+def timeit(fn, queries, reps):
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        for q in queries:
+            fn(q)
+    return (time.perf_counter() - t0) * 1e6 / (reps * len(queries))
+
+
+def main():
+    cases = [
+        ("EXEMPLOS_SQL", [ex["sql"] for ex in EXEMPLOS_SQL], 200),
+        ("CTE x10", [big_cte(10)], 100),
+        ("CTE x100", [big_cte(100)], 20),
+        ("CTE x500", [big_cte(500)], 5),
+    ]
+    print(f"{'caso':>13} {'chars':>8} {'regex us/q':>11} {'lexer us/q':>11} {'speedup':>8}")
+    for name, queries, reps in cases:
+        chars = sum(map(len, queries)) // len(queries)
+        old = timeit(legacy_pipeline, queries, reps)
+        new = timeit(lexer_pipeline, queries, reps)
+        print(f"{name:>13} {chars:>8} {old:>11.1f} {new:>11.1f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
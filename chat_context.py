@@ -0,0 +1,108 @@
+# chat_context.py — contexto da conversa para o prompt, mantido turno a turno
+#
+# Cada mensagem vira um bloco de texto pronto (resumo, mini-CSV mascarado, última SQL) com a
+# contagem de tokens no momento em que é produzida; montar o contexto é só concatenar os
+# blocos mais recentes dentro do orçamento, sem revisitar mensagens nem DataFrames.
+
+import hashlib
+from collections import deque
+
+import pandas as pd
+
+from config import PII_COLUMN_HINTS
+
+
+def mask_pii_column(colname: str) -> bool:
+    name_up = (colname or "").upper()
+    return any(h in name_up for h in PII_COLUMN_HINTS)
+
+
+def mask_cell(colname: str, val) -> str:
+    s = "" if val is None else str(val)
+    if mask_pii_column(colname):
+        # hash curta mantendo padrão estável para repetição
+        h = hashlib.sha1(s.encode("utf-8", errors="ignore")).hexdigest()[:6]
+        return f"{colname}_***{h}"
+    # truncagem leve por célula no contexto
+    s = s.replace("\n", " ").strip()
+    return (s[:24] + "…") if len(s) > 25 else s
+
+
+def mini_csv(df: pd.DataFrame, rows: int = 2, cols: int = 5) -> str:
+    """Amostra mascarada (rows x cols) em CSV; só as células da amostra são tocadas."""
+    if not isinstance(df, pd.DataFrame):
+        return ""
+    try:
+        head = df.iloc[:rows, :cols]
+        masked = pd.DataFrame(
+            {i: head.iloc[:, i].map(lambda v, c=c: mask_cell(c, v)) for i, c in enumerate(head.columns)}
+        )
+        masked.columns = head.columns
+        return masked.to_csv(index=False)
+    except Exception:
+        return ""
+
+
+def dataframe_block(summary: str, df: pd.DataFrame = None) -> str:
+    bloco = "Assistente:"
+    summary = (summary or "").strip()
+    if summary:
+        bloco += f"\nresumo={summary}"
+    sample = mini_csv(df) if df is not None else ""
+    if sample:
+        bloco += f"\nAmostra CSV (até 2 linhas):\n{sample}"
+    return bloco.strip()
+
+
+class ChatContext:
+    """
+    Janela dos últimos turnos (até 'max_turns' blocos, cortando no 'max_users'-ésimo turno
+    do usuário) + última SQL. add() recebe cada mensagem uma vez; build()/blocks() só somam tokens.
+    """
+
+    def __init__(self, count_tokens, *, max_turns: int = 4, max_users: int = 2):
+        self.count_tokens = count_tokens
+        self.max_users = int(max_users)
+        self._turns = deque(maxlen=max(1, int(max_turns)))  # (quem, texto, tokens)
+        self._last_sql = None  # (texto, tokens)
+
+    def add(self, message: dict, df: pd.DataFrame = None):
+        """Registra uma mensagem do chat; df é o resultado de uma mensagem 'dataframe'."""
+        role, mtype = message.get("role"), message.get("type")
+        if mtype == "sql":
+            sql = (message.get("content") or "").strip()
+            if sql:
+                text = "Assistente (SQL anterior):\n```sql\n" + sql + "\n```"
+                self._last_sql = (text, self.count_tokens(text))
+            return
+        if role == "user":
+            who, body = "user", (message.get("content") or "").strip()
+        elif mtype == "dataframe":
+            who, body = "assistant", dataframe_block(message.get("summary"), df)
+        else:
+            who, body = "assistant", (message.get("content") or "").strip()
+            if not body:
+                return
+        text = f"{'Usuário' if who == 'user' else 'Assistente'}: {body}"
+        self._turns.append((who, text, self.count_tokens(text)))
+
+    def build(self, max_tokens: int) -> str:
+        return "\n\n".join(self.blocks(max_tokens))
+
+    def blocks(self, max_tokens: int) -> list:
+        """Blocos que cabem em max_tokens, do mais antigo ao mais recente (a última SQL no fim)."""
+        picked, users = [], 0
+        for who, text, tokens in reversed(self._turns):
+            picked.append((text, tokens))
+            if who == "user":
+                users += 1
+                if users >= self.max_users:
+                    break
+        blocks, used = [], 0
+        for text, tokens in reversed(picked):  # do mais antigo ao mais recente
+            if used + tokens <= max_tokens:
+                blocks.append(text)
+                used += tokens
+        if self._last_sql is not None and used + self._last_sql[1] <= max_tokens:
+            blocks.append(self._last_sql[0])
+        return blocks
@@ -2,7 +2,6 @@
 
 import os
 from datetime import datetime
-from openai import AzureOpenAI
 from pathlib import Path
 
 try:
@@ -25,6 +24,13 @@ DEFAULT_DRIVER     = os.getenv("SQL_DRIVER", "ODBC Driver 18 for SQL Server")
 DEFAULT_MAX_COMPLETION_TOKENS = int(os.getenv("DEFAULT_MAX_COMPLETION_TOKENS", "1200"))
 DEFAULT_TEMP = float(os.getenv("DEFAULT_TEMP", "0.15"))
 DEFAULT_TOP_P = float(os.getenv("DEFAULT_TOP_P", "0.9"))
+# Orçamento do prompt inteiro (tokens de entrada); 0 desliga. Corta primeiro os exemplos além
+# do mínimo, depois o histórico mais antigo, depois colunas do schema e por fim os exemplos restantes
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_MIN_EXAMPLES = int(os.getenv("PROMPT_MIN_EXAMPLES", "3"))
+# Contagem local de tokens (tiktoken, se instalado; senão estimativa)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+TOKEN_COUNT_CACHE_ITEMS = int(os.getenv("TOKEN_COUNT_CACHE_ITEMS", "4096"))
 
 # Azure OpenAI (NUNCA deixe chave hardcoded no código)
 AZURE_OAI_ENDPOINT = os.getenv("AZURE_OAI_ENDPOINT")
@@ -35,6 +41,10 @@ AZURE_OAI_API_KEY = os.getenv("AZURE_OAI_API_KEY")  # sem fallback
 # Persistência/Histórico
 PERSIST_TURNS = os.getenv("PERSIST_TURNS", "false").lower() in ("1","true","yes","on")
 DEFAULT_HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Gravação em background do chat_turns (lote por tamanho/tempo)
+TURN_WRITER_BATCH_SIZE = int(os.getenv("TURN_WRITER_BATCH_SIZE", "50"))
+TURN_WRITER_FLUSH_SECONDS = float(os.getenv("TURN_WRITER_FLUSH_SECONDS", "2"))
+TURN_WRITER_MAX_QUEUE = int(os.getenv("TURN_WRITER_MAX_QUEUE", "10000"))
 
 # Colunas PII para mascaramento no mini-CSV do prompt
 PII_COLUMN_HINTS = [
@@ -45,11 +55,113 @@ PII_COLUMN_HINTS = [
 HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "60"))
 LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
 LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.7"))
+# Execução especulativa: gera a SQL em paralelo à classificação por LLM (descarta se a rota não for sql)
+SPECULATIVE_SQL = os.getenv("SPECULATIVE_SQL", "false").lower() in ("1","true","yes","on")
+# Gateway LLM: pool HTTP keep-alive compartilhado e limite de chamadas simultâneas
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+# Controle de admissão (cota do deployment no Azure). 0 = sem limite local
+LLM_QUOTA_TPM = int(os.getenv("LLM_QUOTA_TPM", "0"))
+LLM_QUOTA_RPM = int(os.getenv("LLM_QUOTA_RPM", "0"))
+LLM_ADMISSION_MAX_WAIT = float(os.getenv("LLM_ADMISSION_MAX_WAIT", "60"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+# Streaming da geração de SQL (para no '--END'); intervalo mínimo entre renders parciais
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() in ("1","true","yes","on")
+LLM_STREAM_RENDER_INTERVAL = float(os.getenv("LLM_STREAM_RENDER_INTERVAL", "0.08"))
 
 # Query guard (server-side)
 SQL_COMMAND_TIMEOUT_SECONDS = int(os.getenv("SQL_COMMAND_TIMEOUT_SECONDS", "60"))
 
+# Leitura em lotes do resultado: orçamento de linhas/bytes (o excedente é truncado)
+QUERY_FETCH_BATCH_ROWS = int(os.getenv("QUERY_FETCH_BATCH_ROWS", "5000"))
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "200000"))
+QUERY_MAX_BYTES = int(os.getenv("QUERY_MAX_MB", "256")) * 1024 * 1024
+QUERY_FIRST_PAGE_ROWS = int(os.getenv("QUERY_FIRST_PAGE_ROWS", "200"))
+
+# Guarda de custo pré-execução (plano estimado SHOWPLAN_XML)
+QUERY_COST_GUARD_ENABLED = os.getenv("QUERY_COST_GUARD_ENABLED", "true").lower() in ("1","true","yes","on")
+QUERY_COST_WARN = float(os.getenv("QUERY_COST_WARN", "50"))      # custo de subárvore estimado
+QUERY_COST_REJECT = float(os.getenv("QUERY_COST_REJECT", "1000"))
+QUERY_COST_CAP_ROWS = int(os.getenv("QUERY_COST_CAP_ROWS", "200000"))  # acima disso força TOP
+QUERY_PLAN_CACHE_ITEMS = int(os.getenv("QUERY_PLAN_CACHE_ITEMS", "256"))
+
+# Pool de conexões pyodbc (fallback do run_query, persistência e ferramentas)
+SQL_POOL_MAX_SIZE = int(os.getenv("SQL_POOL_MAX_SIZE", "5"))
+SQL_POOL_CHECKOUT_TIMEOUT = float(os.getenv("SQL_POOL_CHECKOUT_TIMEOUT", "10"))
+SQL_POOL_MAX_LIFETIME_SECONDS = float(os.getenv("SQL_POOL_MAX_LIFETIME_SECONDS", "1800"))
+SQL_POOL_PING_AFTER_SECONDS = float(os.getenv("SQL_POOL_PING_AFTER_SECONDS", "30"))
+
 DEFAULT_YEAR_IF_MISSING = int(os.getenv("DEFAULT_YEAR_IF_MISSING", "2025"))
+# Reescreve YEAR/MONTH/TRY_CONVERT(date, ...) sobre colunas datetime em intervalos na coluna nua
+SQL_SARGABLE_DATES = os.getenv("SQL_SARGABLE_DATES", "true").lower() in ("1","true","yes","on")
+# Literais dos predicados viram parâmetros ligados pelo driver (reuso de plano no SQL Server)
+SQL_AUTO_PARAMETERIZE = os.getenv("SQL_AUTO_PARAMETERIZE", "true").lower() in ("1","true","yes","on")
+SQL_AUTO_PARAM_MAX = int(os.getenv("SQL_AUTO_PARAM_MAX", "2000"))  # limite do SQL Server: 2100
+# Escolhe DASH_ATUAL/DASH_HISTORICO pelo intervalo de Data_Entrega da SQL gerada (mês corrente calculado na hora)
+DASH_ROUTING_ENABLED = os.getenv("DASH_ROUTING_ENABLED", "true").lower() in ("1","true","yes","on")
+# SELECT * final em tabelas largas vira colunas explícitas (citadas na pergunta/SQL, até o limite)
+PROJECTION_REWRITE_ENABLED = os.getenv("PROJECTION_REWRITE_ENABLED", "true").lower() in ("1","true","yes","on")
+QUERY_PREVIEW_MAX_COLUMNS = int(os.getenv("QUERY_PREVIEW_MAX_COLUMNS", "12"))
+# Debug: compara no log os bytes estimados pelo plano antes/depois (2 SHOWPLAN extras por consulta)
+PROJECTION_LOG_PLAN = os.getenv("PROJECTION_LOG_PLAN", "false").lower() in ("1","true","yes","on")
+
+def _env_table_map(name: str, default: str, cast=float) -> dict:
+    """Lê 'TABELA=valor,TABELA2=valor' de uma variável de ambiente (chaves em maiúsculas)."""
+    out = {}
+    for item in (os.getenv(name, default) or "").split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            out[k.strip().upper()] = cast(v.strip())
+        except ValueError:
+            pass
+    return out
+
+# Cache de resultados do run_query (memória LRU + Parquet em disco)
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "true").lower() in ("1","true","yes","on")
+QUERY_CACHE_MAX_ITEMS = int(os.getenv("QUERY_CACHE_MAX_ITEMS", "128"))
+QUERY_CACHE_MAX_ROWS = int(os.getenv("QUERY_CACHE_MAX_ROWS", "50000"))  # resultados maiores não são cacheados
+QUERY_CACHE_DISK_ENABLED = os.getenv("QUERY_CACHE_DISK_ENABLED", "true").lower() in ("1","true","yes","on")
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", os.path.join(os.getcwd(), "cache", "query_results"))
+QUERY_CACHE_DISK_MAX_FILES = int(os.getenv("QUERY_CACHE_DISK_MAX_FILES", "512"))
+QUERY_CACHE_DEFAULT_TTL_SECONDS = float(os.getenv("QUERY_CACHE_DEFAULT_TTL_SECONDS", "600"))
+# TTL por tabela: histórico muda pouco; DASH_ATUAL recebe cargas ao longo do dia
+QUERY_CACHE_TABLE_TTLS = _env_table_map(
+    "QUERY_CACHE_TABLE_TTLS",
+    "DASH_HISTORICO=21600,DASH_ATUAL=120,VW_DEVOLUCAO_LAB=900,BI_OTIF=3600",
+)
+# Invalidação por alteração da tabela (sys.dm_db_index_usage_stats / modify_date)
+QUERY_CACHE_CHECK_MODIFIED = os.getenv("QUERY_CACHE_CHECK_MODIFIED", "false").lower() in ("1","true","yes","on")
+QUERY_CACHE_STAMP_REFRESH_SECONDS = float(os.getenv("QUERY_CACHE_STAMP_REFRESH_SECONDS", "30"))
+
+# Política de leitura por tabela (nolock | snapshot | default) aplicada pelo executor;
+# tabelas fora do mapa ficam como o modelo escreveu. NOLOCK é opt-in por tabela
+# (leitura suja: avaliar consistência antes de habilitar), ex.: "DASH_HISTORICO=nolock"
+SQL_READ_POLICY = _env_table_map("SQL_READ_POLICY", "", cast=str.lower)
+# LOCK_TIMEOUT (ms) por classe de consulta; sem entrada usa o timeout de comando
+SQL_LOCK_TIMEOUT_MS = _env_table_map(
+    "SQL_LOCK_TIMEOUT_MS", "INTERACTIVE=5000,TOOL=5000,EXPORT=30000,BACKGROUND=30000", cast=int,
+)
+
+# Resultados das respostas por sessão: últimos em memória (compactados), demais em Parquet
+RESULT_STORE_MEM_ITEMS = int(os.getenv("RESULT_STORE_MEM_ITEMS", "3"))
+RESULT_STORE_MEM_BYTES = int(os.getenv("RESULT_STORE_MEM_MB", "64")) * 1024 * 1024
+RESULT_STORE_DIR = os.getenv("RESULT_STORE_DIR", os.path.join(os.getcwd(), "cache", "session_results"))
+RESULT_STORE_MAX_AGE_SECONDS = float(os.getenv("RESULT_STORE_MAX_AGE_SECONDS", str(24 * 3600)))
+
+# Poda do schema por pergunta no prompt (fallback: schema completo quando não há sinal)
+SCHEMA_PRUNE_ENABLED = os.getenv("SCHEMA_PRUNE_ENABLED", "true").lower() in ("1","true","yes","on")
+SCHEMA_PRUNE_COLUMNS = os.getenv("SCHEMA_PRUNE_COLUMNS", "false").lower() in ("1","true","yes","on")
+
+# Cache pergunta -> SQL validada (pula o LLM em perguntas repetidas)
+QUESTION_CACHE_ENABLED = os.getenv("QUESTION_CACHE_ENABLED", "true").lower() in ("1","true","yes","on")
+QUESTION_CACHE_PATH = os.getenv("QUESTION_CACHE_PATH", os.path.join(os.getcwd(), "cache", "question_sql.sqlite3"))
+QUESTION_CACHE_TTL_SECONDS = float(os.getenv("QUESTION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Se true, só reaproveita SQL que recebeu 👍; caso contrário basta ter executado com sucesso
+QUESTION_CACHE_REQUIRE_APPROVAL = os.getenv("QUESTION_CACHE_REQUIRE_APPROVAL", "true").lower() in ("1","true","yes","on")
 
 HIDE_SQL_IN_UI = os.getenv("HIDE_SQL_IN_UI", "true").lower() in ("1","true","yes","on")
 DEBUG_SHOW_MODEL_RAW = os.getenv("DEBUG_SHOW_MODEL_RAW", "false").lower() in ("1","true","yes","on")
@@ -58,6 +170,14 @@ DEBUG_SHOW_MODEL_RAW = os.getenv("DEBUG_SHOW_MODEL_RAW", "false").lower() in ("1
 FEEDBACK_DIR = os.path.join(os.getcwd(), "feedback")
 POS_FILE = os.path.join(FEEDBACK_DIR, "positives.txt")
 NEG_FILE = os.path.join(FEEDBACK_DIR, "negatives.txt")
+# Registro estruturado (SQLite); os .txt continuam como exportação opcional
+FEEDBACK_DB_PATH = os.getenv("FEEDBACK_DB_PATH", os.path.join(FEEDBACK_DIR, "feedback.sqlite3"))
+FEEDBACK_TEXT_EXPORT = os.getenv("FEEDBACK_TEXT_EXPORT", "true").lower() in ("1","true","yes","on")
+FEEDBACK_FLUSH_ITEMS = int(os.getenv("FEEDBACK_FLUSH_ITEMS", "20"))
+FEEDBACK_FLUSH_SECONDS = float(os.getenv("FEEDBACK_FLUSH_SECONDS", "30"))
+# Pool de exemplos do prompt: sementes do rules.py + pares com 👍 (👎 posterior remove o par)
+EXAMPLE_POOL_FROM_FEEDBACK = os.getenv("EXAMPLE_POOL_FROM_FEEDBACK", "true").lower() in ("1","true","yes","on")
+EXAMPLE_POOL_MAX_FEEDBACK = int(os.getenv("EXAMPLE_POOL_MAX_FEEDBACK", "5000"))
 os.makedirs(FEEDBACK_DIR, exist_ok=True)
 for _path in (POS_FILE, NEG_FILE):
     if not os.path.exists(_path):
@@ -78,37 +198,3 @@ REGRAS_GERAIS = [
     "Quando a pergunta envolver clientes, use a coluna NOME_CLI.",
     "Quando houver 'excluir/sem/excepto', filtre com NOME_CLI NOT LIKE '%<nome>%' (collate CI_AI).",
 ]
-
-# ===========================
-# Azure OpenAI - Cliente
-# ===========================
-# cache do cliente para não recriar a cada chamada
-try:
-    import streamlit as st
-
-    @st.cache_resource(show_spinner=False)
-    def get_azure_oai_client() -> AzureOpenAI:
-        if not AZURE_OAI_API_KEY:
-            raise RuntimeError("AZURE_OAI_API_KEY não definido. Configure a variável de ambiente.")
-        return AzureOpenAI(
-            api_version=AZURE_OAI_API_VERSION,
-            azure_endpoint=AZURE_OAI_ENDPOINT,
-            api_key=AZURE_OAI_API_KEY,
-            timeout=HTTP_TIMEOUT_SECONDS,
-        )
-except Exception:
-    _azure_client_singleton = None
-    def get_azure_oai_client() -> AzureOpenAI:
-        global _azure_client_singleton
-        if not AZURE_OAI_API_KEY:
-            raise RuntimeError("AZURE_OAI_API_KEY não definido. Configure a variável de ambiente.")
-        if _azure_client_singleton is None:
-            _azure_client_singleton = AzureOpenAI(
-                api_version=AZURE_OAI_API_VERSION,
-                azure_endpoint=AZURE_OAI_ENDPOINT,
-                api_key=AZURE_OAI_API_KEY,
-                timeout=HTTP_TIMEOUT_SECONDS,
-            )
-        return _azure_client_singleton
-
-
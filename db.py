@@ -1,8 +1,15 @@
 # db.py — conexão, schema e execução
 
 import socket
+import hashlib
+import time
+import logging
+import threading
 import pandas as pd
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import urllib.parse
+import xml.etree.ElementTree as ET
 from textwrap import dedent
 from functools import lru_cache
 
@@ -17,7 +24,24 @@ try:
 except Exception:
     create_engine = None
 
-from config import SQL_COMMAND_TIMEOUT_SECONDS
+from config import (
+    SQL_COMMAND_TIMEOUT_SECONDS, SQL_AUTO_PARAMETERIZE,
+    QUERY_FETCH_BATCH_ROWS, QUERY_MAX_ROWS, QUERY_MAX_BYTES,
+    QUERY_COST_GUARD_ENABLED, QUERY_COST_WARN, QUERY_COST_REJECT, QUERY_COST_CAP_ROWS,
+    QUERY_PLAN_CACHE_ITEMS,
+    SQL_POOL_MAX_SIZE, SQL_POOL_CHECKOUT_TIMEOUT, SQL_POOL_MAX_LIFETIME_SECONDS, SQL_POOL_PING_AFTER_SECONDS,
+    QUERY_CACHE_ENABLED, QUERY_CACHE_MAX_ITEMS, QUERY_CACHE_MAX_ROWS,
+    QUERY_CACHE_DISK_ENABLED, QUERY_CACHE_DIR, QUERY_CACHE_DISK_MAX_FILES,
+    QUERY_CACHE_DEFAULT_TTL_SECONDS, QUERY_CACHE_TABLE_TTLS,
+    QUERY_CACHE_CHECK_MODIFIED, QUERY_CACHE_STAMP_REFRESH_SECONDS,
+    SQL_READ_POLICY, SQL_LOCK_TIMEOUT_MS,
+)
+from query_cache import QueryResultCache
+from sql_utils import (
+    normalize_sql_key, apply_top_cap, parameterize_sql, inline_params, NVarchar, apply_read_policy,
+)
+
+log = logging.getLogger("radar-ia.db")
 
 # Cache de engine — com ou sem Streamlit
 try:
@@ -89,9 +113,156 @@ def try_connect(conn_str: str):
     return conn
 
 
+# === Pool de conexões pyodbc ===
+class ConnectionPool:
+    """
+    Pool limitado de conexões pyodbc para uma connection string. A inicialização de
+    sessão (timeout/LOCK_TIMEOUT de try_connect) roda uma vez por conexão; conexões
+    ociosas há mais de ping_after são testadas com SELECT 1 e as mais velhas que
+    max_lifetime são recicladas. Sem conexão livre, o checkout espera até checkout_timeout.
+    """
+
+    def __init__(self, connect, *, max_size: int = 5, checkout_timeout: float = 10.0,
+                 max_lifetime: float = 1800.0, ping_after: float = 30.0, clock=time.monotonic):
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.checkout_timeout = float(checkout_timeout)
+        self.max_lifetime = float(max_lifetime)
+        self.ping_after = float(ping_after)
+        self._clock = clock
+        self._idle = deque()  # (conn, criada_em, devolvida_em) — LIFO: reaproveita a mais quente
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {"created": 0, "reused": 0, "recycled": 0, "ping_failed": 0, "discarded": 0, "waits": 0}
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _alive(self, conn) -> bool:
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1;")
+                cur.fetchall()
+            finally:
+                cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        deadline = self._clock() + self.checkout_timeout
+        while True:
+            with self._cond:
+                entry = None
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1  # reserva a vaga; conecta fora do lock
+                else:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        raise RuntimeError(
+                            f"Pool de conexões SQL esgotado ({self.max_size} em uso) após {self.checkout_timeout:.0f}s."
+                        )
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                    continue
+            if entry is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+                return conn, self._clock()
+
+            conn, created_at, returned_at = entry
+            now = self._clock()
+            if now - created_at > self.max_lifetime:
+                self._discard(conn, "recycled")
+                continue
+            if now - returned_at > self.ping_after and not self._alive(conn):
+                self._discard(conn, "ping_failed")
+                continue
+            with self._cond:
+                self._stats["reused"] += 1
+            return conn, created_at
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _discard(self, conn, reason: str = "discarded"):
+        self._close(conn)
+        with self._cond:
+            self._stats[reason] += 1
+        self._release_slot()
+
+    def _checkin(self, conn, created_at):
+        # encerra transação pendente; se nem o rollback funciona, a conexão está quebrada
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, self._clock()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn, created_at = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn, created_at)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {**self._stats, "size": self._size, "idle": len(self._idle), "max_size": self.max_size}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(conn_str: str) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(conn_str)
+        if pool is None:
+            pool = _pools[conn_str] = ConnectionPool(
+                lambda: try_connect(conn_str),
+                max_size=SQL_POOL_MAX_SIZE,
+                checkout_timeout=SQL_POOL_CHECKOUT_TIMEOUT,
+                max_lifetime=SQL_POOL_MAX_LIFETIME_SECONDS,
+                ping_after=SQL_POOL_PING_AFTER_SECONDS,
+            )
+        return pool
+
+def pooled_connection(conn_str: str):
+    """Context manager que empresta uma conexão do pool (devolvida ao sair do with)."""
+    return get_pool(conn_str).connection()
+
+def pool_stats(conn_str: str) -> dict:
+    return get_pool(conn_str).stats()
+
+
 def fetch_tables_and_columns_cached(conn_str: str) -> pd.DataFrame:
     """INFORMATION_SCHEMA estável e cacheável externamente (se desejar)."""
-    conn = try_connect(conn_str)
     q = dedent("""
         SELECT
             c.TABLE_SCHEMA,
@@ -105,81 +276,630 @@ def fetch_tables_and_columns_cached(conn_str: str) -> pd.DataFrame:
         WHERE t.TABLE_TYPE = 'BASE TABLE'
         ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION;
     """)
-    df = pd.read_sql(q, conn)
-    conn.close()
-    return df
+    with pooled_connection(conn_str) as conn:
+        return pd.read_sql(q, conn)
+
+# === Cache de resultados ===
+_query_cache = QueryResultCache(
+    max_items=QUERY_CACHE_MAX_ITEMS,
+    max_rows=QUERY_CACHE_MAX_ROWS,
+    cache_dir=QUERY_CACHE_DIR,
+    disk_enabled=QUERY_CACHE_DISK_ENABLED,
+    disk_max_files=QUERY_CACHE_DISK_MAX_FILES,
+    table_ttls=QUERY_CACHE_TABLE_TTLS,
+    default_ttl=QUERY_CACHE_DEFAULT_TTL_SECONDS,
+)
+_stamp_cache = {}  # (conn_str, tabela) -> (lido_em, carimbo)
+_stamp_lock = threading.Lock()
+
+def get_query_cache() -> QueryResultCache:
+    return _query_cache
+
+def _cache_scope(conn_str: str) -> str:
+    """Escopo da chave de cache: hash da string de conexão (sem guardar a senha em disco)."""
+    return hashlib.sha1((conn_str or "").encode("utf-8")).hexdigest()[:16]
 
-def run_query(conn_str: str, sql_text: str) -> pd.DataFrame:
+def query_cache_stats() -> dict:
+    """Contadores de hit/miss/evicção do cache de resultados (para dimensionamento)."""
+    return _query_cache.stats()
+
+def table_modified_stamps(conn_str: str, tables: list[str]) -> dict:
+    """
+    Carimbo da última alteração de cada tabela (última escrita registrada em
+    sys.dm_db_index_usage_stats ou modify_date do objeto). Views são resolvidas para as
+    tabelas de base (sys.sql_expression_dependencies, recursivo): o carimbo é o mais
+    recente entre elas. Memoizado por alguns segundos para não custar um round trip a
+    cada hit. Best-effort: devolve {} se não houver permissão.
+    """
+    if not tables:
+        return {}
+    now = time.time()
+    out, missing = {}, []
+    with _stamp_lock:
+        for t in tables:
+            hit = _stamp_cache.get((conn_str, t))
+            if hit and now - hit[0] < QUERY_CACHE_STAMP_REFRESH_SECONDS:
+                out[t] = hit[1]
+            else:
+                missing.append(t)
+    if not missing:
+        return out
+    try:
+        with pooled_connection(conn_str) as conn:
+            cur = conn.cursor()
+            marks = ",".join("?" for _ in missing)
+            cur.execute(dedent(f"""
+                WITH deps AS (
+                    SELECT o.name AS req_name, o.object_id, 0 AS lvl
+                    FROM sys.objects o
+                    WHERE o.name IN ({marks})
+                    UNION ALL
+                    SELECT d.req_name, e.referenced_id, d.lvl + 1
+                    FROM deps d
+                    JOIN sys.sql_expression_dependencies e ON e.referencing_id = d.object_id
+                    WHERE e.referenced_id IS NOT NULL AND d.lvl < 8
+                )
+                SELECT d.req_name,
+                       CONVERT(varchar(33), MAX(COALESCE(s.last_user_update, o.modify_date)), 126)
+                FROM deps d
+                JOIN sys.objects o ON o.object_id = d.object_id
+                LEFT JOIN (
+                    SELECT object_id, MAX(last_user_update) AS last_user_update
+                    FROM sys.dm_db_index_usage_stats
+                    WHERE database_id = DB_ID()
+                    GROUP BY object_id
+                ) s ON s.object_id = d.object_id
+                GROUP BY d.req_name;
+            """), missing)
+            rows = cur.fetchall()
+            cur.close()
+    except Exception:
+        return out
+    with _stamp_lock:
+        for name, stamp in rows:
+            key = str(name).upper()
+            for t in missing:
+                if t.upper() == key:
+                    out[t] = stamp
+                    _stamp_cache[(conn_str, t)] = (now, stamp)
+    return out
+
+# === Guarda de custo (plano estimado) ===
+_SHOWPLAN_NS = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+_plan_cache = OrderedDict()  # (conn_str, sql normalizada) -> estimativa
+_plan_lock = threading.Lock()
+
+def parse_showplan(xml_text: str) -> dict:
+    """
+    Extrai do SHOWPLAN_XML o statement mais caro: custo de subárvore, linhas estimadas e
+    tamanho médio da linha devolvida (AvgRowSize do operador raiz, em bytes).
+    """
+    root = ET.fromstring(xml_text)
+    best = {"cost": 0.0, "est_rows": 0.0, "row_size": 0.0}
+    for stmt in root.iter(f"{_SHOWPLAN_NS}StmtSimple"):
+        cost = float(stmt.get("StatementSubTreeCost") or 0)
+        if cost >= best["cost"]:
+            top = stmt.find(f"{_SHOWPLAN_NS}QueryPlan/{_SHOWPLAN_NS}RelOp")
+            best = {
+                "cost": cost,
+                "est_rows": float(stmt.get("StatementEstRows") or 0),
+                "row_size": float(top.get("AvgRowSize") or 0) if top is not None else 0.0,
+            }
+    return best
+
+def estimated_bytes(est) -> float:
+    """Bytes estimados do resultado (linhas x tamanho médio da linha), ou None sem plano."""
+    if not est or not est.get("row_size"):
+        return None
+    return est["est_rows"] * est["row_size"]
+
+def estimate_plan(conn_str: str, sql_text: str):
+    """
+    Plano estimado da SQL (sem executá-la), memoizado pela SQL normalizada.
+    Best-effort: devolve None se o SHOWPLAN falhar (ex.: sem permissão SHOWPLAN).
+    """
+    key = (conn_str, normalize_sql_key(sql_text))
+    with _plan_lock:
+        if key in _plan_cache:
+            _plan_cache.move_to_end(key)
+            return _plan_cache[key]
+    try:
+        with pooled_connection(conn_str) as conn:
+            autocommit = getattr(conn, "autocommit", False)
+            conn.autocommit = True  # SET SHOWPLAN não pode estar dentro de transação
+            cur = conn.cursor()
+            try:
+                cur.execute("SET SHOWPLAN_XML ON;")
+                try:
+                    cur.execute(sql_text)
+                    row = cur.fetchone()
+                finally:
+                    try:
+                        cur.execute("SET SHOWPLAN_XML OFF;")
+                    except Exception:
+                        conn.close()  # sessão ficaria em modo SHOWPLAN: descarta (checkin falha no rollback)
+                        raise
+            finally:
+                cur.close()
+                try:
+                    conn.autocommit = autocommit
+                except Exception:
+                    pass
+        est = parse_showplan(row[0]) if row and row[0] else None
+    except Exception:
+        return None
+    with _plan_lock:
+        _plan_cache[key] = est
+        while len(_plan_cache) > QUERY_PLAN_CACHE_ITEMS:
+            _plan_cache.popitem(last=False)
+    return est
+
+def cost_decision(sql_text: str, est) -> dict:
+    """
+    Decide o que fazer com a SQL a partir da estimativa:
+    'reject' (custo acima de QUERY_COST_REJECT), 'cap' (linhas estimadas acima de
+    QUERY_COST_CAP_ROWS: injeta TOP), 'warn' (custo acima de QUERY_COST_WARN) ou 'ok'.
     """
-    Executa a SQL e retorna um DataFrame.
-    Preferência: SQLAlchemy (evita warning do pandas). Fallback: cursor pyodbc.
-    Respeita timeouts definidos em config.
+    out = {"action": "ok", "sql": sql_text, "message": "", "cost": None, "est_rows": None}
+    if not est:
+        return out
+    cost, rows = est["cost"], est["est_rows"]
+    out.update(cost=cost, est_rows=rows)
+    if QUERY_COST_REJECT and cost > QUERY_COST_REJECT:
+        out.update(action="reject", message=(
+            f"Consulta estimada como muito pesada (custo {cost:,.0f}, ~{rows:,.0f} linhas). "
+            "Refine o período ou os filtros."
+        ))
+        return out
+    if QUERY_COST_CAP_ROWS and rows > QUERY_COST_CAP_ROWS:
+        capped = apply_top_cap(sql_text, QUERY_COST_CAP_ROWS)
+        if capped != sql_text:
+            out.update(action="cap", sql=capped, message=(
+                f"Resultado estimado em ~{rows:,.0f} linhas; limitado às primeiras {QUERY_COST_CAP_ROWS:,}."
+            ))
+            return out
+    if QUERY_COST_WARN and cost > QUERY_COST_WARN:
+        out.update(action="warn", message=f"Consulta pesada (custo estimado {cost:,.0f}); pode demorar.")
+    return out
+
+def guard_query_cost(conn_str: str, sql_text: str) -> dict:
+    """Etapa de guarda antes do run_query: estima o plano e aplica cost_decision."""
+    if not QUERY_COST_GUARD_ENABLED:
+        return cost_decision(sql_text, None)
+    return cost_decision(sql_text, estimate_plan(conn_str, sql_text))
+
+def run_query(conn_str: str, sql_text: str, use_cache: bool = True, on_batch=None,
+              timeout: float = SQL_COMMAND_TIMEOUT_SECONDS, tag: str = None, params=None,
+              query_class: str = "interactive") -> pd.DataFrame:
+    """
+    Executa a SQL e retorna um DataFrame, consultando antes o cache de resultados
+    (chave = hash da conexão + SQL normalizada com os parâmetros embutidos; TTL por tabela;
+    invalidação opcional por alteração da tabela). Sem 'params', os literais dos predicados
+    são parametrizados automaticamente (SQL_AUTO_PARAMETERIZE).
+    A leitura é feita em lotes com orçamento de linhas/bytes; df.attrs["truncated"] indica
+    corte. on_batch(lote, stream) é chamado a cada lote (ex.: mostrar a 1ª página na UI).
+    Levanta QueryTimeout após 'timeout' segundos e QueryCancelled via cancel_queries(tag).
+    query_class escolhe o LOCK_TIMEOUT (SQL_LOCK_TIMEOUT_MS); a política de leitura por
+    tabela (SQL_READ_POLICY) vale para qualquer classe.
     """
     sql_text = (sql_text or "").strip()
     if not sql_text:
         return pd.DataFrame()
+    if not (use_cache and QUERY_CACHE_ENABLED):
+        return _execute_query(conn_str, sql_text, on_batch, timeout, tag, params, query_class)
 
-    # Caminho 1: SQLAlchemy (se disponível)
-    if create_engine is not None:
+    cache_text = inline_params(sql_text, params)
+    scope = _cache_scope(conn_str)
+    stamps = None
+    if QUERY_CACHE_CHECK_MODIFIED:
+        stamps = table_modified_stamps(conn_str, _query_cache.tables_for(cache_text))
+    cached = _query_cache.get(cache_text, stamps, scope)
+    if cached is not None:
+        return cached
+    df = _execute_query(conn_str, sql_text, on_batch, timeout, tag, params, query_class)
+    if not df.attrs.get("truncated"):  # resultado parcial não vai para o cache
+        _query_cache.put(cache_text, df, stamps, scope)
+    return df
+
+def _execute_query(conn_str: str, sql_text: str, on_batch=None,
+                   timeout: float = SQL_COMMAND_TIMEOUT_SECONDS, tag: str = None, params=None,
+                   query_class: str = "interactive") -> pd.DataFrame:
+    """Executa a SQL no servidor (sem cache), respeitando orçamento de linhas/bytes e timeout."""
+    stream = QueryStream(conn_str, sql_text, timeout=timeout, tag=tag, params=params, query_class=query_class)
+    return stream.to_frame(on_batch)
+
+class QueryTimeout(RuntimeError):
+    """A consulta excedeu o tempo máximo de execução e foi cancelada no servidor."""
+
+
+class QueryLockTimeout(QueryTimeout):
+    """A consulta esperou além do LOCK_TIMEOUT por uma tabela bloqueada (ex.: carga em andamento)."""
+
+
+class QueryCancelled(RuntimeError):
+    """A consulta foi cancelada (usuário ou nova execução do Streamlit)."""
+
+
+_active_queries = {}  # tag -> set(QueryHandle)
+_active_lock = threading.Lock()
+
+class QueryHandle:
+    """
+    Alça de cancelamento de uma consulta em execução. cancel() pode ser chamado de
+    qualquer thread: envia SQLCancel pelo cursor e libera a sessão no servidor.
+    Um timer cancela automaticamente ao fim do timeout (execução + leitura).
+    """
+
+    def __init__(self, sql_text: str, timeout: float = None, tag: str = None):
+        self.sql_text = sql_text
+        self.timeout = float(timeout or 0)
+        self.tag = tag
+        self.reason = None  # None | "timeout" | "cancelled" | "lock"
+        self.started = time.monotonic()
+        self._cur = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def attach(self, cur):
+        with self._lock:
+            self._cur = cur
+            cancelled = self.reason is not None
+        if cancelled:
+            self._cancel_cursor(cur)
+
+    def start(self):
+        if self.timeout > 0:
+            self._timer = threading.Timer(self.timeout, self.cancel, args=("timeout",))
+            self._timer.daemon = True
+            self._timer.start()
+        if self.tag is not None:
+            with _active_lock:
+                _active_queries.setdefault(self.tag, set()).add(self)
+        return self
+
+    def finish(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        with self._lock:
+            self._cur = None
+        if self.tag is not None:
+            with _active_lock:
+                handles = _active_queries.get(self.tag)
+                if handles is not None:
+                    handles.discard(self)
+                    if not handles:
+                        _active_queries.pop(self.tag, None)
+
+    @staticmethod
+    def _cancel_cursor(cur):
         try:
-            engine = get_engine(conn_str)
-            with engine.connect() as econn:
-                # aplica timeout de comando via hints do driver
-                return pd.read_sql_query(sql_text, econn)
+            cur.cancel()
         except Exception:
             pass
 
-    # Caminho 2: Fallback pyodbc com fetch manual
-    conn = try_connect(conn_str)
-    cur = None
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            cur = self._cur
+        if cur is not None:
+            self._cancel_cursor(cur)
+
+    def error(self, cause: Exception = None) -> Exception:
+        """Converte a falha do driver no erro tipado correspondente (e registra a SQL)."""
+        elapsed = time.monotonic() - self.started
+        reason = self.reason or ("timeout" if _is_driver_timeout(cause) else "lock" if _is_lock_timeout(cause) else None)
+        if reason is None:
+            return cause
+        log.warning("query %s após %.1fs: %s", reason, elapsed, " ".join(self.sql_text.split()))
+        if reason == "timeout":
+            return QueryTimeout(f"Consulta excedeu {self.timeout:.0f}s e foi cancelada.")
+        if reason == "lock":
+            return QueryLockTimeout("Tabela bloqueada por outra operação (carga em andamento?); tente novamente em instantes.")
+        return QueryCancelled("Consulta cancelada.")
+
+
+def _is_driver_timeout(e: Exception) -> bool:
+    # HYT00 = query timeout do ODBC (SQL_ATTR_QUERY_TIMEOUT); HY008 = operação cancelada
+    return e is not None and "HYT00" in str(e)
+
+def _is_lock_timeout(e: Exception) -> bool:
+    # 1222 = Lock request time out period exceeded (SET LOCK_TIMEOUT)
+    return e is not None and "(1222)" in str(e)
+
+def lock_timeout_ms(query_class: str) -> int:
+    """LOCK_TIMEOUT da classe de consulta (interactive/tool/export/background)."""
+    return int(SQL_LOCK_TIMEOUT_MS.get((query_class or "").upper(), SQL_COMMAND_TIMEOUT_SECONDS * 1000))
+
+_snapshot_unavailable = set()  # conn_str cujo banco recusou SNAPSHOT (ALLOW_SNAPSHOT_ISOLATION OFF)
+
+def _set_session(cur, isolation: str = "READ COMMITTED", lock_ms: int = None):
+    """Isolamento e LOCK_TIMEOUT da próxima consulta (a conexão volta ao pool com o que ficar aqui)."""
+    if lock_ms is None:
+        lock_ms = SQL_COMMAND_TIMEOUT_SECONDS * 1000
+    cur.execute(f"SET LOCK_TIMEOUT {int(lock_ms)}; SET TRANSACTION ISOLATION LEVEL {isolation};")
+
+def _execute_in_session(cur, conn_str: str, sql_text: str, params=None, session=None):
+    """_execute precedido do SET de sessão; SNAPSHOT recusado (3952) cai para READ COMMITTED."""
+    if session is None:
+        _execute(cur, sql_text, params)
+        return
+    isolation, lock_ms = session
+    if isolation == "SNAPSHOT" and conn_str in _snapshot_unavailable:
+        isolation = "READ COMMITTED"
+    _set_session(cur, isolation, lock_ms)
     try:
-        cur = conn.cursor()
-        #cur.timeout = SQL_COMMAND_TIMEOUT_SECONDS
-        cur.execute(sql_text)
-        cols = [d[0] for d in cur.description] if cur.description else []
-        rows = cur.fetchall() if cols else []
-        df = pd.DataFrame.from_records(rows, columns=cols)
-        return df
-    finally:
+        _execute(cur, sql_text, params)
+    except Exception as e:
+        if isolation != "SNAPSHOT" or "(3952)" not in str(e):
+            raise
+        log.warning("SNAPSHOT indisponível no banco; usando READ COMMITTED")
+        _snapshot_unavailable.add(conn_str)
         try:
-            if cur is not None:
-                cur.close()
+            cur.connection.rollback()
         except Exception:
             pass
+        _set_session(cur, "READ COMMITTED", lock_ms)
+        _execute(cur, sql_text, params)
+
+def cancel_queries(tag: str) -> int:
+    """Cancela as consultas em andamento com a tag (ex.: session_id do Streamlit)."""
+    with _active_lock:
+        handles = list(_active_queries.get(tag, ()))
+    for h in handles:
+        h.cancel("cancelled")
+    return len(handles)
+
+def _set_query_timeout(dbapi_conn, seconds: float):
+    # pyodbc: Connection.timeout = SQL_ATTR_QUERY_TIMEOUT dos próximos statements
+    try:
+        dbapi_conn.timeout = int(seconds)
+    except Exception:
+        pass
+
+def _input_sizes(params) -> list:
+    """
+    Tipos declarados dos parâmetros (cursor.setinputsizes). Tamanhos fixos: o pyodbc declara
+    o tamanho do valor ('BENTO' = nvarchar(5)) e cada tamanho viraria um plano diferente.
+    """
+    sizes = []
+    for v in params:
+        if isinstance(v, NVarchar):
+            sizes.append((pyodbc.SQL_WVARCHAR, 4000, 0))
+        elif isinstance(v, str):
+            sizes.append((pyodbc.SQL_VARCHAR, 8000, 0))  # literal '...' é varchar: evita CONVERT_IMPLICIT na coluna
+        elif isinstance(v, bool) or not isinstance(v, int):
+            sizes.append(None)
+        else:
+            sizes.append((pyodbc.SQL_INTEGER if -2**31 <= v < 2**31 else pyodbc.SQL_BIGINT, 0, 0))
+    return sizes
+
+def _execute(cur, sql_text: str, params=None):
+    if not params:
+        cur.execute(sql_text)
+        return
+    if pyodbc is not None:
         try:
-            conn.close()
+            cur.setinputsizes(_input_sizes(params))
         except Exception:
-            pass
+            pass  # driver sem setinputsizes: usa a inferência padrão
+    cur.execute(sql_text, params)
+
+@contextmanager
+def _executed_cursor(conn_str: str, sql_text: str, handle: QueryHandle = None, params=None, session=None):
+    """
+    Cursor DBAPI com a SQL já executada (params ligados como '?', se houver).
+    session = (isolamento, lock_timeout_ms) aplicado antes da consulta.
+    Preferência: conexão do pool do SQLAlchemy. Fallback: pool pyodbc.
+    Com handle, o cursor fica cancelável e o timeout de comando vale nos dois caminhos.
+    """
+    timeout = handle.timeout if handle is not None else SQL_COMMAND_TIMEOUT_SECONDS
+    if create_engine is not None:
+        raw, cur = None, None
+        try:
+            raw = get_engine(conn_str).raw_connection()
+            dbapi_conn = getattr(raw, "driver_connection", None) or getattr(raw, "dbapi_connection", None) or raw
+            _set_query_timeout(dbapi_conn, timeout)
+            cur = raw.cursor()
+            if handle is not None:
+                handle.attach(cur)
+            _execute_in_session(cur, conn_str, sql_text, params, session)
+        except Exception as e:
+            for obj in (cur, raw):
+                try:
+                    if obj is not None:
+                        obj.close()
+                except Exception:
+                    pass
+            raw = None
+            # timeout/cancelamento/lock não caem no fallback (repetiriam a consulta inteira)
+            if handle is not None and (handle.reason or _is_driver_timeout(e) or _is_lock_timeout(e)):
+                raise
+        if raw is not None:
+            try:
+                yield cur
+            finally:
+                try:
+                    cur.close()
+                finally:
+                    raw.close()  # devolve ao pool do SQLAlchemy
+            return
+
+    with pooled_connection(conn_str) as conn:
+        _set_query_timeout(conn, timeout)
+        cur = conn.cursor()
+        try:
+            if handle is not None:
+                handle.attach(cur)
+            _execute_in_session(cur, conn_str, sql_text, params, session)
+            yield cur
+        finally:
+            try:
+                cur.close()
+            except Exception:
+                pass
+
+class QueryStream:
+    """
+    Leitura do resultado em lotes (fetchmany) como DataFrames, sem materializar tudo.
+    Para ao atingir max_rows ou max_bytes (aproximado, memória dos lotes) e marca
+    truncated. Iterar diretamente serve para exportações; to_frame() monta o DataFrame.
+    timeout cobre execução + leitura; tag permite cancelar via cancel_queries(tag).
+    Sem params explícitos, os literais dos predicados viram parâmetros (SQL_AUTO_PARAMETERIZE).
+    Hints/isolamento seguem SQL_READ_POLICY; o LOCK_TIMEOUT vem da query_class.
+    """
+
+    def __init__(self, conn_str: str, sql_text: str, *, batch_rows: int = QUERY_FETCH_BATCH_ROWS,
+                 max_rows: int = QUERY_MAX_ROWS, max_bytes: int = QUERY_MAX_BYTES,
+                 timeout: float = SQL_COMMAND_TIMEOUT_SECONDS, tag: str = None, params=None,
+                 query_class: str = "interactive"):
+        sql_text, isolation = apply_read_policy(sql_text, SQL_READ_POLICY)
+        self.session = (isolation, lock_timeout_ms(query_class))
+        if params is None and SQL_AUTO_PARAMETERIZE:
+            sql_text, params = parameterize_sql(sql_text)
+        self.conn_str = conn_str
+        self.sql_text = sql_text
+        self.params = tuple(params or ())
+        self.batch_rows = max(1, int(batch_rows))
+        self.max_rows = int(max_rows or 0)  # 0 = sem limite
+        self.max_bytes = int(max_bytes or 0)
+        self.handle = QueryHandle(inline_params(sql_text, self.params), timeout, tag)  # log com os valores
+        self.columns = []
+        self.rows = 0
+        self.bytes = 0
+        self.truncated = False
+
+    def cancel(self):
+        self.handle.cancel("cancelled")
+
+    def __iter__(self):
+        self.handle.start()
+        try:
+            yield from self._batches()
+        except Exception as e:
+            err = self.handle.error(e)
+            if err is e:
+                raise
+            raise err from e
+        finally:
+            self.handle.finish()
+
+    def _batches(self):
+        with _executed_cursor(self.conn_str, self.sql_text, self.handle, self.params, self.session) as cur:
+            self.columns = [d[0] for d in cur.description] if cur.description else []
+            if not self.columns:
+                return
+            exhausted = False
+            try:
+                while True:
+                    want = self.batch_rows
+                    if self.max_rows:
+                        want = min(want, self.max_rows - self.rows + 1)  # +1 detecta excedente
+                    rows = cur.fetchmany(want)
+                    if self.handle.reason:  # cancelada entre lotes
+                        raise QueryCancelled(self.handle.reason)  # convertida em __iter__
+                    if not rows:
+                        exhausted = True
+                        break
+                    if self.max_rows and self.rows + len(rows) > self.max_rows:
+                        rows = rows[: self.max_rows - self.rows]
+                        self.truncated = True
+                    if rows:
+                        batch = pd.DataFrame.from_records(rows, columns=self.columns, coerce_float=True)
+                        self.rows += len(batch)
+                        self.bytes += int(batch.memory_usage(deep=True).sum())
+                        yield batch
+                    if self.truncated:
+                        break
+                    if self.max_bytes and self.bytes >= self.max_bytes:
+                        self.truncated = cur.fetchone() is not None
+                        exhausted = not self.truncated
+                        break
+            finally:
+                if not exhausted:
+                    try:
+                        cur.cancel()  # não deixa o servidor continuar enviando linhas
+                    except Exception:
+                        pass
+
+    def to_frame(self, on_batch=None) -> pd.DataFrame:
+        batches = []
+        for batch in self:
+            batches.append(batch)
+            if on_batch is not None:
+                on_batch(batch, self)
+        if batches:
+            df = pd.concat(batches, ignore_index=True) if len(batches) > 1 else batches[0]
+        else:
+            df = pd.DataFrame(columns=self.columns)
+        df.attrs["truncated"] = self.truncated
+        df.attrs["rows_fetched"] = self.rows
+        df.attrs["bytes_fetched"] = self.bytes
+        return df
+
+def stream_query(conn_str: str, sql_text: str, **limits) -> QueryStream:
+    """Iterador de lotes para exportações/ferramentas (sem cache; limites opcionais)."""
+    return QueryStream(conn_str, (sql_text or "").strip(), **limits)
+
+def export_query_csv(conn_str: str, sql_text: str, path_or_buf, **limits) -> QueryStream:
+    """Escreve o resultado em CSV lote a lote; devolve o stream (linhas, bytes, truncated)."""
+    limits.setdefault("query_class", "export")
+    stream = stream_query(conn_str, sql_text, **limits)
+    first = True
+    for batch in stream:
+        batch.to_csv(path_or_buf, index=False, header=first, mode="w" if first else "a")
+        first = False
+    if first:
+        pd.DataFrame(columns=stream.columns).to_csv(path_or_buf, index=False)
+    return stream
 
 # === Persistência opcional do histórico ===
 def ensure_chat_table(conn_str: str):
-    conn = try_connect(conn_str)
-    cur = conn.cursor()
-    cur.execute("""
-    IF NOT EXISTS (
-        SELECT 1 FROM sys.tables t WHERE t.name = 'chat_turns'
-    )
-    CREATE TABLE dbo.chat_turns (
-        id INT IDENTITY(1,1) PRIMARY KEY,
-        ts DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
-        session_id NVARCHAR(64) NOT NULL,
-        role NVARCHAR(16) NOT NULL,
-        type NVARCHAR(16) NOT NULL,
-        content NVARCHAR(MAX) NULL,
-        summary NVARCHAR(MAX) NULL
-    );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_connection(conn_str) as conn:
+        cur = conn.cursor()
+        _set_session(cur, lock_ms=lock_timeout_ms("background"))
+        cur.execute("""
+        IF NOT EXISTS (
+            SELECT 1 FROM sys.tables t WHERE t.name = 'chat_turns'
+        )
+        CREATE TABLE dbo.chat_turns (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            ts DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+            session_id NVARCHAR(64) NOT NULL,
+            role NVARCHAR(16) NOT NULL,
+            type NVARCHAR(16) NOT NULL,
+            content NVARCHAR(MAX) NULL,
+            summary NVARCHAR(MAX) NULL
+        );
+        """)
+        conn.commit()
+        cur.close()
 
 def insert_chat_turn(conn_str: str, session_id: str, role: str, type_: str, content: str = None, summary: str = None):
-    conn = try_connect(conn_str)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO dbo.chat_turns (session_id, role, type, content, summary) VALUES (?,?,?,?,?)",
-        (session_id, role, type_, content, summary)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_connection(conn_str) as conn:
+        cur = conn.cursor()
+        _set_session(cur, lock_ms=lock_timeout_ms("background"))
+        cur.execute(
+            "INSERT INTO dbo.chat_turns (session_id, role, type, content, summary) VALUES (?,?,?,?,?)",
+            (session_id, role, type_, content, summary)
+        )
+        conn.commit()
+        cur.close()
+
+def insert_chat_turns(conn_str: str, rows: list):
+    """Insere vários turnos de uma vez: [(session_id, role, type, content, summary), ...]."""
+    if not rows:
+        return
+    with pooled_connection(conn_str) as conn:
+        cur = conn.cursor()
+        _set_session(cur, lock_ms=lock_timeout_ms("background"))
+        try:
+            cur.fast_executemany = True
+        except Exception:
+            pass
+        cur.executemany(
+            "INSERT INTO dbo.chat_turns (session_id, role, type, content, summary) VALUES (?,?,?,?,?)",
+            rows
+        )
+        conn.commit()
+        cur.close()
@@ -0,0 +1,166 @@
+# example_index.py — índice TF-IDF de n-gramas de caracteres para seleção de exemplos
+
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+NGRAM_SIZES = (3, 4)
+# exemplos novos ficam num índice delta; o principal é reconstruído quando delta/removidos crescem
+COMPACT_MIN = 256
+COMPACT_RATIO = 0.25
+
+
+def _normalize(text: str) -> str:
+    if not text:
+        return ""
+    if not text.isascii():
+        d = unicodedata.normalize("NFKD", text)
+        text = "".join(ch for ch in d if not unicodedata.combining(ch))
+    return " ".join(text.lower().split())
+
+
+def char_ngrams(text: str, sizes=NGRAM_SIZES) -> Counter:
+    """Conta n-gramas de caracteres (com borda de espaço) do texto normalizado."""
+    s = f" {_normalize(text)} "
+    grams = Counter()
+    for n in sizes:
+        grams.update(map("".join, zip(*(s[i:] for i in range(n)))))
+    return grams
+
+
+class _SparseTfidf:
+    """
+    Matriz TF-IDF esparsa com linhas L2-normalizadas, guardada por coluna (CSC em arrays
+    NumPy). O score de uma consulta é um único produto matriz-vetor restrito às colunas
+    (n-gramas) presentes na pergunta. Com 'base', o IDF soma as frequências do índice base
+    (usado pelo índice delta de exemplos adicionados depois).
+    """
+
+    def __init__(self, docs: list[str], base: "_SparseTfidf" = None):
+        counts = [char_ngrams(d) for d in docs]
+        self.vocab = {}
+        rows, cols, tfs = [], [], []
+        for r, c in enumerate(counts):
+            for g, v in c.items():
+                col = self.vocab.get(g)
+                if col is None:
+                    col = self.vocab[g] = len(self.vocab)
+                rows.append(r)
+                cols.append(col)
+                tfs.append(v)
+        self.n_rows = len(docs)
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        df = np.bincount(cols, minlength=len(self.vocab))
+        self.df = df
+        if base is None:
+            self.idf = (np.log((1 + self.n_rows) / (1 + df)) + 1.0).astype(np.float32)
+        else:
+            base_df = np.fromiter((base.doc_freq(g) for g in self.vocab), dtype=np.int64, count=len(self.vocab))
+            total = base.n_rows + self.n_rows
+            self.idf = (np.log((1 + total) / (1 + df + base_df)) + 1.0).astype(np.float32)
+        w = (1.0 + np.log(np.asarray(tfs, dtype=np.float32))) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=w * w, minlength=self.n_rows))
+        w = w / np.where(norms > 0, norms, 1.0)[rows]
+
+        order = np.argsort(cols, kind="stable")
+        self.row_idx = rows[order]
+        self.vals = w[order].astype(np.float32)
+        self.col_ptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+
+    def doc_freq(self, gram: str) -> int:
+        col = self.vocab.get(gram)
+        return 0 if col is None else int(self.df[col])
+
+    def scores(self, text: str) -> np.ndarray:
+        out = np.zeros(self.n_rows, dtype=np.float64)
+        hits = [(self.vocab[g], v) for g, v in char_ngrams(text).items() if g in self.vocab]
+        if not hits or self.n_rows == 0:
+            return out
+        q_cols = np.fromiter((c for c, _ in hits), dtype=np.int64, count=len(hits))
+        q_w = (1.0 + np.log(np.fromiter((v for _, v in hits), dtype=np.float64, count=len(hits)))) * self.idf[q_cols]
+        q_w /= np.linalg.norm(q_w)
+        starts, ends = self.col_ptr[q_cols], self.col_ptr[q_cols + 1]
+        lens = ends - starts
+        # posições de todas as postings das colunas da consulta (sem loop Python)
+        offs = np.repeat(starts - np.concatenate(([0], np.cumsum(lens)[:-1])), lens)
+        pos = np.arange(int(lens.sum())) + offs
+        weights = self.vals[pos] * np.repeat(q_w, lens)
+        return np.bincount(self.row_idx[pos], weights=weights, minlength=self.n_rows)
+
+
+class ExampleIndex:
+    """
+    Índice de recuperação sobre um pool de exemplos {"pergunta", "sql"}.
+    O score de cada exemplo é o máximo entre a similaridade com a pergunta e com a SQL
+    (mesmo critério do antigo SequenceMatcher). add()/remove() são incrementais: novos
+    exemplos vão para um índice delta pequeno e removidos viram lápides; o índice
+    principal só é reconstruído quando delta + lápides passam de COMPACT_RATIO do pool.
+    """
+
+    def __init__(self, exemplos_pool: list[dict]):
+        self.pool = list(exemplos_pool or [])
+        self._build()
+
+    def _build(self):
+        self._main_n = len(self.pool)
+        self._perguntas = _SparseTfidf([ex.get("pergunta", "") or "" for ex in self.pool])
+        self._sqls = _SparseTfidf([ex.get("sql", "") or "" for ex in self.pool])
+        self._delta = None
+        self._alive = np.ones(self._main_n, dtype=bool)
+
+    def _needs_compact(self) -> bool:
+        churn = (len(self.pool) - self._main_n) + int((~self._alive).sum())
+        return churn > max(COMPACT_MIN, COMPACT_RATIO * self._main_n)
+
+    def _compact(self):
+        self.pool = [ex for ex, ok in zip(self.pool, self._alive) if ok]
+        self._build()
+
+    def add(self, exemplos: list[dict]):
+        exemplos = list(exemplos or [])
+        if not exemplos:
+            return
+        self.pool.extend(exemplos)
+        self._alive = np.concatenate([self._alive, np.ones(len(exemplos), dtype=bool)])
+        if self._needs_compact():
+            self._compact()
+            return
+        delta = self.pool[self._main_n:]
+        self._delta = (
+            _SparseTfidf([ex.get("pergunta", "") or "" for ex in delta], base=self._perguntas),
+            _SparseTfidf([ex.get("sql", "") or "" for ex in delta], base=self._sqls),
+        )
+
+    def remove(self, predicate) -> int:
+        """Remove os exemplos para os quais predicate(ex) é verdadeiro; retorna quantos."""
+        hits = [i for i, ex in enumerate(self.pool) if self._alive[i] and predicate(ex)]
+        if hits:
+            self._alive[hits] = False
+            if self._needs_compact():
+                self._compact()
+        return len(hits)
+
+    def __len__(self):
+        return int(self._alive.sum())
+
+    def scores(self, pergunta: str) -> np.ndarray:
+        s = np.maximum(self._perguntas.scores(pergunta), self._sqls.scores(pergunta))
+        if self._delta is not None:
+            dp, ds = self._delta
+            s = np.concatenate([s, np.maximum(dp.scores(pergunta), ds.scores(pergunta))])
+        return s
+
+    def top_k(self, pergunta: str, k: int = 3) -> list[dict]:
+        n_alive = len(self)
+        if n_alive == 0:
+            return []
+        n = len(self.pool)
+        k = max(1, min(int(k or 3), n_alive))
+        s = self.scores(pergunta)
+        s[~self._alive] = -np.inf
+        cand = np.argpartition(-s, k - 1)[:k] if k < n else np.arange(n)
+        # desempate estável pela posição no pool (exemplos semente primeiro)
+        order = cand[np.lexsort((cand, -s[cand]))][:k]
+        return [self.pool[i] for i in order]
@@ -0,0 +1,151 @@
+# example_pool.py — pool de exemplos do prompt: sementes + feedback positivo
+#
+# Sementes (rules.EXEMPLOS_SQL) nunca saem. Pares pergunta/SQL com 👍 entram
+# deduplicados por pergunta normalizada (o 👍 mais recente vence); um 👎 posterior no
+# mesmo par o remove. Cada mudança incrementa 'version' e atualiza o índice sem reindexar tudo.
+
+import re
+import itertools
+import threading
+from datetime import datetime
+
+from config import (
+    POS_FILE, NEG_FILE, EXAMPLE_POOL_FROM_FEEDBACK, EXAMPLE_POOL_MAX_FEEDBACK,
+)
+from example_index import ExampleIndex
+from feedback_store import get_feedback_store
+from question_cache import normalize_question
+from rules import EXEMPLOS_SQL
+from sql_utils import normalize_sql_key, validate_sql
+
+_TXT_ENTRY = re.compile(
+    r"^\[(?P<ts>[\d\-: ]+)\]\s*\nPERGUNTA:\n(?P<q>.*?)\n\nSQL:\n(?P<sql>.*?)\n-{80}",
+    re.DOTALL | re.MULTILINE,
+)
+_POOL_KEYS = itertools.count(1)
+
+
+def read_feedback_txt(path: str, positive: bool) -> list[tuple]:
+    """Lê positives.txt/negatives.txt (formato do feedback_utils) como [(ts, pergunta, sql, positivo)]."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except OSError:
+        return []
+    out = []
+    for m in _TXT_ENTRY.finditer(text):
+        try:
+            ts = datetime.strptime(m.group("ts").strip(), "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            continue
+        out.append((ts, m.group("q").strip(), m.group("sql").strip(), positive))
+    return out
+
+
+class ExamplePool:
+    """
+    Interface de índice (top_k) para o montar_prompt. 'key' identifica o pool no cache de
+    seleção (única no processo, nunca reaproveitada); 'version' invalida as seleções.
+    """
+
+    def __init__(self, seeds: list[dict], max_feedback: int = 5000):
+        self.max_feedback = int(max_feedback)
+        self._seeds = list(seeds or [])
+        self._seed_keys = {(normalize_question(ex.get("pergunta")), normalize_sql_key(ex.get("sql"))) for ex in self._seeds}
+        self._index = ExampleIndex(self._seeds)
+        self._by_question = {}  # pergunta normalizada -> exemplo vindo de feedback
+        self._lock = threading.Lock()
+        self.key = f"pool-{next(_POOL_KEYS)}"
+        self.version = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def _accepts(self, qn: str, sk: str, sql: str) -> bool:
+        return bool(qn) and validate_sql(sql)[0] and (qn, sk) not in self._seed_keys
+
+    def _positive(self, pergunta: str, sql: str, index: bool):
+        """Atualiza o dicionário (e o índice, se index=True). Retorna True se mudou algo."""
+        qn, sk = normalize_question(pergunta), normalize_sql_key(sql)
+        if not self._accepts(qn, sk, sql):
+            return False
+        old = self._by_question.get(qn)
+        if old is not None:
+            if normalize_sql_key(old["sql"]) == sk:
+                return False
+            if index:
+                self._index.remove(lambda ex: ex is old)
+        elif len(self._by_question) >= self.max_feedback:
+            return False
+        ex = {"pergunta": pergunta.strip(), "sql": sql.strip()}
+        self._by_question[qn] = ex
+        if index:
+            self._index.add([ex])
+        return True
+
+    def _negative(self, pergunta: str, sql: str, index: bool):
+        qn = normalize_question(pergunta)
+        old = self._by_question.get(qn)
+        if old is None or normalize_sql_key(old["sql"]) != normalize_sql_key(sql):
+            return False
+        del self._by_question[qn]
+        if index:
+            self._index.remove(lambda ex: ex is old)
+        return True
+
+    def add_positive(self, pergunta: str, sql: str) -> bool:
+        with self._lock:
+            changed = self._positive(pergunta, sql, index=True)
+            self.version += changed
+        return changed
+
+    def add_negative(self, pergunta: str, sql: str) -> bool:
+        with self._lock:
+            changed = self._negative(pergunta, sql, index=True)
+            self.version += changed
+        return changed
+
+    def apply(self, events) -> int:
+        """
+        Carga em lote de [(ts, pergunta, sql, positivo)] em ordem cronológica:
+        resolve o estado final e reconstrói o índice uma única vez.
+        """
+        changed = 0
+        with self._lock:
+            for _, q, sql, positive in sorted(events, key=lambda e: e[0]):
+                changed += (self._positive if positive else self._negative)(q, sql, index=False)
+            if changed:
+                self._index = ExampleIndex(self._seeds + list(self._by_question.values()))
+                self.version += 1
+        return changed
+
+    def top_k(self, pergunta: str, k: int = 3) -> list[dict]:
+        with self._lock:
+            return self._index.top_k(pergunta, k)
+
+
+def load_feedback_events(store=None, pos_file: str = POS_FILE, neg_file: str = NEG_FILE) -> list[tuple]:
+    """
+    Eventos de feedback: registro estruturado + .txt antigos (só o que é anterior ao
+    primeiro registro estruturado, para não contar duas vezes quando a exportação está ligada).
+    """
+    events = []
+    if store is not None:
+        events = [(r["ts"], r["question"], r["sql"], r["rating"] > 0) for r in store.ratings()]
+    first_ts = events[0][0] if events else float("inf")
+    legacy = read_feedback_txt(pos_file, True) + read_feedback_txt(neg_file, False)
+    return [e for e in legacy if e[0] < first_ts] + events
+
+
+_example_pool = None
+_pool_lock = threading.Lock()
+
+def get_example_pool() -> ExamplePool:
+    global _example_pool
+    with _pool_lock:
+        if _example_pool is None:
+            pool = ExamplePool(EXEMPLOS_SQL, EXAMPLE_POOL_MAX_FEEDBACK)
+            if EXAMPLE_POOL_FROM_FEEDBACK:
+                pool.apply(load_feedback_events(get_feedback_store()))
+            _example_pool = pool
+        return _example_pool
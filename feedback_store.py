@@ -0,0 +1,150 @@
+# feedback_store.py — registro estruturado de feedback (SQLite local, escrita em buffer)
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+
+from config import (
+    FEEDBACK_DB_PATH, FEEDBACK_FLUSH_ITEMS, FEEDBACK_FLUSH_SECONDS,
+)
+from question_cache import normalize_question
+from feedback_utils import _append_feedback_txt
+
+_COLUMNS = (
+    "ts", "session_id", "question", "question_norm", "sql", "route", "rating", "latency_ms",
+    "prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens", "cache_key", "rules_version",
+)
+
+
+class FeedbackStore:
+    """
+    Feedback 👍/👎 com pergunta, pergunta normalizada, SQL, rota, latência e uso de tokens.
+    As gravações ficam em buffer e vão ao SQLite por tamanho/tempo, antes de qualquer
+    leitura e no encerramento do processo. Consulta por pergunta normalizada é indexada.
+    """
+
+    def __init__(self, path: str, flush_items: int = 20, flush_seconds: float = 30.0):
+        self.path = path
+        self.flush_items = max(1, int(flush_items))
+        self.flush_seconds = float(flush_seconds)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._buffer = []
+        self._first_buffered_at = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS feedback (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    session_id TEXT,
+                    question TEXT NOT NULL,
+                    question_norm TEXT NOT NULL,
+                    sql TEXT,
+                    route TEXT,
+                    rating INTEGER NOT NULL,
+                    latency_ms REAL,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    total_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    cache_key TEXT,
+                    rules_version TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_feedback_qnorm ON feedback (question_norm, ts)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def record(self, question: str, sql: str, positive: bool, *, route: str = "sql",
+               latency_ms: float = None, usage: dict = None, session_id: str = None,
+               cache_key: str = None, rules_version: str = None):
+        usage = usage or {}
+        row = (
+            time.time(), session_id, question or "", normalize_question(question), sql, route,
+            1 if positive else -1, latency_ms,
+            usage.get("prompt_tokens"), usage.get("completion_tokens"),
+            usage.get("total_tokens"), usage.get("cached_tokens"),
+            cache_key, rules_version,
+        )
+        with self._lock:
+            self._buffer.append(row)
+            self._first_buffered_at = self._first_buffered_at or time.monotonic()
+            due = (len(self._buffer) >= self.flush_items
+                   or time.monotonic() - self._first_buffered_at >= self.flush_seconds)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer, self._first_buffered_at = self._buffer, [], None
+            if not rows:
+                return
+            try:
+                db = self._db()
+                db.executemany(
+                    f"INSERT INTO feedback ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                    rows,
+                )
+                db.commit()
+            except sqlite3.Error:
+                self._buffer = rows + self._buffer  # tenta de novo no próximo flush
+
+    def _query(self, sql: str, params=()) -> list[dict]:
+        self.flush()
+        with self._lock:
+            try:
+                cur = self._db().execute(sql, params)
+            except sqlite3.Error:
+                return []
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, r)) for r in cur.fetchall()]
+
+    def lookup(self, question: str, limit: int = 20) -> list[dict]:
+        """Feedbacks da mesma pergunta normalizada (mais recentes primeiro)."""
+        return self._query(
+            "SELECT * FROM feedback WHERE question_norm = ? ORDER BY ts DESC LIMIT ?",
+            (normalize_question(question), int(limit)),
+        )
+
+    def summary(self, question: str) -> dict:
+        rows = self._query(
+            "SELECT SUM(rating > 0) AS up, SUM(rating < 0) AS down FROM feedback WHERE question_norm = ?",
+            (normalize_question(question),),
+        )
+        row = rows[0] if rows else {}
+        return {"up": row.get("up") or 0, "down": row.get("down") or 0}
+
+    def ratings(self) -> list[dict]:
+        """Todos os feedbacks com SQL, em ordem cronológica (ts, question, sql, rating)."""
+        return self._query(
+            "SELECT ts, question, sql, rating FROM feedback WHERE sql IS NOT NULL AND sql <> '' ORDER BY ts"
+        )
+
+    def export_text(self, pos_path: str, neg_path: str, since: float = 0.0) -> int:
+        """Exporta no formato antigo (positives.txt/negatives.txt) para compatibilidade."""
+        rows = self._query(
+            "SELECT question, sql, rating FROM feedback WHERE ts >= ? ORDER BY ts", (float(since),)
+        )
+        for r in rows:
+            _append_feedback_txt(pos_path if r["rating"] > 0 else neg_path, r["question"], r["sql"])
+        return len(rows)
+
+
+_feedback_store = None
+_store_lock = threading.Lock()
+
+def get_feedback_store() -> FeedbackStore:
+    global _feedback_store
+    with _store_lock:
+        if _feedback_store is None:
+            _feedback_store = FeedbackStore(FEEDBACK_DB_PATH, FEEDBACK_FLUSH_ITEMS, FEEDBACK_FLUSH_SECONDS)
+            atexit.register(_feedback_store.flush)
+        return _feedback_store
@@ -1,23 +1,30 @@
-# llm.py — inicialização lazy do cliente Azure
+# llm.py — prompts, extração de SQL e chamadas ao Azure OpenAI (via llm_gateway)
 from __future__ import annotations
+import re
 import time
 import random
+import threading
 import unicodedata
-from typing import Tuple, Optional, Dict, Sequence
+from collections import OrderedDict
+from typing import Tuple, Optional, Dict, List, Sequence
 from rules import PLANTAS as _PLANTAS_BASE 
 from difflib import SequenceMatcher
 from textwrap import dedent
 from functools import lru_cache
 import json, hashlib
+from example_index import ExampleIndex
 
 
 from config import (
     DEFAULT_MAX_COMPLETION_TOKENS, DEFAULT_TEMP, DEFAULT_TOP_P,
-    get_azure_oai_client, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY,
-    AZURE_OAI_API_KEY, AZURE_OAI_ENDPOINT, AZURE_OAI_DEPLOYMENT  # <- importante
+    SCHEMA_PRUNE_ENABLED, SCHEMA_PRUNE_COLUMNS, LLM_STREAM_RENDER_INTERVAL,
+    PROMPT_TOKEN_BUDGET, PROMPT_MIN_EXAMPLES,
+    AZURE_OAI_API_KEY, AZURE_OAI_ENDPOINT  # <- importante
 )
 
-_client = None  # NÃO chame get_azure_oai_client() aqui
+from llm_gateway import get_gateway
+from llm_admission import PRIORITY_CLASSIFICATION, PRIORITY_GENERATION
+from token_count import count_tokens, tokenizer_name
 
 
 def _normalize_text(text: str) -> str:
@@ -32,49 +39,70 @@ def _normalize_text(text: str) -> str:
     return stripped.lower()
 
 
-def _get_client():
-    """Cria o cliente sob demanda, só quando for realmente usar."""
-    global _client
-    if _client is None:
-        _client = get_azure_oai_client()  # lança RuntimeError se não houver credenciais
-    return _client
-
 def _usage_from_resp(resp):
     u = getattr(resp, "usage", None)
     if not u: return None
     get = (lambda k: getattr(u, k, None) or (u.get(k) if isinstance(u, dict) else 0))
+    # tokens servidos do prompt cache do provedor (prompt_tokens_details.cached_tokens)
+    details = get("prompt_tokens_details")
+    cached = (getattr(details, "cached_tokens", None) or (details.get("cached_tokens") if isinstance(details, dict) else 0)) if details else 0
     return {"prompt_tokens": get("prompt_tokens"),
             "completion_tokens": get("completion_tokens"),
-            "total_tokens": get("total_tokens")}
+            "total_tokens": get("total_tokens"),
+            "cached_tokens": cached or 0}
 
 # --- NÃO USE 'prompt' dentro de _chat_complete; receba messages prontas ---
-def _chat_complete(messages, *, temperature, top_p, max_completion_tokens):
+def _chat_complete(messages, *, temperature, top_p, max_completion_tokens, priority=PRIORITY_GENERATION):
     """
-    Executa uma completion de chat com retry. 'messages' deve ser uma lista de dicts:
+    Executa uma completion de chat pelo gateway (pool HTTP, limite de concorrência,
+    controle de cota e retry uniformes). 'messages' deve ser uma lista de dicts:
     [{"role":"system","content":"..."}, {"role":"user","content":"..."}]
     """
-    last_err = None
-    for attempt in range(1, LLM_MAX_RETRIES + 1):
-        try:
-            client = _get_client()
-            # garante que 'messages' é lista (não tupla/gerador)
-            msgs = list(messages) if isinstance(messages, (list, tuple)) else messages
-            resp = client.chat.completions.create(
-                model=AZURE_OAI_DEPLOYMENT,
-                messages=msgs,
-                temperature=temperature,
-                top_p=top_p,
-                max_completion_tokens=max_completion_tokens,
-            )
-            return resp
-        except Exception as e:
-            # erro de credencial: não adianta retry
-            if isinstance(e, RuntimeError) and "AZURE_OAI_API_KEY" in str(e):
-                raise
-            last_err = e
-            delay = LLM_RETRY_BASE_DELAY * (2 ** (attempt - 1))
-            time.sleep(delay)
-    raise last_err or RuntimeError("Falha na chamada ao modelo após retries.")
+    # garante que 'messages' é lista (não tupla/gerador)
+    msgs = list(messages) if isinstance(messages, (list, tuple)) else messages
+    return get_gateway().chat(
+        msgs, temperature=temperature, top_p=top_p, max_completion_tokens=max_completion_tokens,
+        priority=priority,
+    )
+
+def llm_admission_stats() -> dict:
+    """Fila/espera/429/circuit breaker do controle de cota do gateway."""
+    return get_gateway().stats()
+
+def _stream_should_stop(text: str) -> bool:
+    """Para de ler quando a SQL terminou: marcador '--END' ou fechamento do bloco ```."""
+    return "--END" in text or text.count("```") >= 2
+
+def _chat_stream(messages, *, temperature, top_p, max_completion_tokens, on_delta=None):
+    """
+    Versão streaming de _chat_complete: consome tokens incrementalmente, chama
+    on_delta(texto_parcial) (com throttle) e encerra a conexão assim que a SQL termina.
+    Retorna (texto, usage).
+    """
+    msgs = list(messages) if isinstance(messages, (list, tuple)) else messages
+    last_emit = [0.0]
+
+    def _emit(text):
+        if on_delta is not None and time.monotonic() - last_emit[0] >= LLM_STREAM_RENDER_INTERVAL:
+            last_emit[0] = time.monotonic()
+            on_delta(text)
+
+    text, usage_chunk, stopped = get_gateway().stream(
+        msgs, temperature=temperature, top_p=top_p, max_completion_tokens=max_completion_tokens,
+        on_delta=_emit, should_stop=_stream_should_stop,
+    )
+    if on_delta is not None and text:
+        on_delta(text)
+    usage = _usage_from_resp(usage_chunk) if usage_chunk is not None else None
+    if usage is None:
+        # encerrado antes do chunk final de usage: estimativa local
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in msgs)
+        completion = count_tokens(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion,
+                 "total_tokens": prompt_tokens + completion,
+                 "cached_tokens": 0, "estimated": True}
+    usage["stopped_early"] = stopped
+    return text, usage
 
 def call_azure_openai_completion(
     prompt: str,
@@ -82,17 +110,64 @@ def call_azure_openai_completion(
     temperature: float = DEFAULT_TEMP,
     top_p: float = DEFAULT_TOP_P,
     max_completion_tokens: int = DEFAULT_MAX_COMPLETION_TOKENS,
+    stream: bool = False,
+    on_delta=None,
 ):
+    """
+    Gera a SQL. Com stream=True lê incrementalmente e para no '--END'
+    (on_delta recebe o texto parcial para exibição).
+    """
+    messages = [
+        {"role": "system", "content": "Você é um conversor de linguagem natural para SQL Server (T-SQL)."},
+        {"role": "user", "content": prompt},
+    ]
+    if stream:
+        return _chat_stream(
+            messages, temperature=temperature, top_p=top_p,
+            max_completion_tokens=max_completion_tokens, on_delta=on_delta,
+        )
     resp = _chat_complete(
-        [
-            {"role": "system", "content": "Você é um conversor de linguagem natural para SQL Server (T-SQL)."},
-            {"role": "user", "content": prompt},
-        ],
+        messages,
         temperature=temperature, top_p=top_p, max_completion_tokens=max_completion_tokens,
     )
     text = resp.choices[0].message.content if resp.choices else ""
     return text, _usage_from_resp(resp)
 
+def start_sql_completion(
+    prompt: str,
+    *,
+    temperature: float = DEFAULT_TEMP,
+    top_p: float = DEFAULT_TOP_P,
+    max_completion_tokens: int = DEFAULT_MAX_COMPLETION_TOKENS,
+):
+    """
+    Dispara a geração de SQL em segundo plano (loop do gateway) e devolve um Future
+    que resolve para (texto, usage, segundos). Usado na execução especulativa;
+    Future.cancel() aborta a chamada HTTP.
+    """
+    messages = [
+        {"role": "system", "content": "Você é um conversor de linguagem natural para SQL Server (T-SQL)."},
+        {"role": "user", "content": prompt},
+    ]
+    gw = get_gateway()
+
+    async def _run():
+        t0 = time.perf_counter()
+        text, usage_chunk, stopped = await gw.astream(
+            messages, temperature=temperature, top_p=top_p,
+            max_completion_tokens=max_completion_tokens, should_stop=_stream_should_stop,
+        )
+        usage = _usage_from_resp(usage_chunk) if usage_chunk is not None else None
+        if usage is None:
+            prompt_tokens = count_tokens(prompt)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count_tokens(text),
+                     "total_tokens": prompt_tokens + count_tokens(text),
+                     "cached_tokens": 0, "estimated": True}
+        usage["stopped_early"] = stopped
+        return text, usage, time.perf_counter() - t0
+
+    return gw.submit(_run())
+
 
 SYSTEM_MSG_HYBRID = (
     "Você é um assistente que responde em português com explicação curta e, quando fizer sentido, "
@@ -109,17 +184,27 @@ def call_azure_openai_hybrid(
     temperature: float = DEFAULT_TEMP,
     top_p: float = DEFAULT_TOP_P,
     max_completion_tokens: int = DEFAULT_MAX_COMPLETION_TOKENS,
+    stream: bool = False,
+    on_delta=None,
 ):
-    resp = _chat_complete(
-        [
-            {"role": "system", "content": SYSTEM_MSG_HYBRID},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=temperature, top_p=top_p, max_completion_tokens=max_completion_tokens,
-    )
-    text = resp.choices[0].message.content if resp.choices else ""
+    messages = [
+        {"role": "system", "content": SYSTEM_MSG_HYBRID},
+        {"role": "user", "content": prompt},
+    ]
+    if stream:
+        text, usage = _chat_stream(
+            messages, temperature=temperature, top_p=top_p,
+            max_completion_tokens=max_completion_tokens, on_delta=on_delta,
+        )
+    else:
+        resp = _chat_complete(
+            messages,
+            temperature=temperature, top_p=top_p, max_completion_tokens=max_completion_tokens,
+        )
+        text = resp.choices[0].message.content if resp.choices else ""
+        usage = _usage_from_resp(resp)
     answer_md, sql = extract_answer_and_sql(text)  # mantém sua lógica atual
-    return answer_md, sql, _usage_from_resp(resp)
+    return answer_md, sql, usage
 
 
 
@@ -135,7 +220,7 @@ def _contains_any(haystack: str, needles: Sequence[str]) -> bool:
     return any(n in haystack for n in needles)
 
 def _sim(a: str, b: str) -> float:
-    """Similaridade simples e robusta para selecionar exemplos."""
+    """Similaridade por SequenceMatcher (scorer antigo; mantido como referência no benchmark)."""
     aa = _normalize_text(a or "")
     bb = _normalize_text(b or "")
     if not aa or not bb:
@@ -143,67 +228,90 @@ def _sim(a: str, b: str) -> float:
     return SequenceMatcher(None, aa, bb).ratio()
 
 
-def _digest_examples(exemplos_pool: list[dict]) -> str:
-    """
-    Gera um hash estável do pool de exemplos (independente da ordem de chaves).
-    Assim podemos usar cache com argumentos hashable.
-    """
-    # json.dumps com sort_keys garante consistência; ensure_ascii=False preserva PT-BR
-    payload = json.dumps(exemplos_pool or [], sort_keys=True, ensure_ascii=False)
-    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
 @lru_cache(maxsize=256)
-def _selecionar_exemplos_cached(pergunta: str, exemplos_digest: str, k_exemplos: int) -> tuple[dict, ...]:
+def _selecionar_exemplos_cached(pergunta: str, source_key: tuple, version: int, k_exemplos: int) -> tuple[dict, ...]:
     """
     Versão cacheada que recebe somente tipos hashable.
-    O conteúdo real dos exemplos é recuperado externamente via um registry simples.
-    """
-    # Recupera o pool real pelo digest (armazenado globalmente pela wrapper)
-    pool = _EXEMPLOS_REGISTRY.get(exemplos_digest, [])
-    pnorm = _normalize_text(pergunta or "")
-    scored = []
-    for ex in pool:
-        s = max(_sim(pnorm, ex.get("pergunta", "")), _sim(pnorm, ex.get("sql", "")))
-        scored.append((s, ex))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = [ex for _, ex in scored[:max(1, int(k_exemplos or 3))]]
+    O índice é recuperado pelo registry; 'version' muda quando o pool recebe feedback.
+    """
+    with _exemplos_lock:
+        source = _EXEMPLOS_REGISTRY[source_key]  # KeyError (não cacheado) se já saiu do registry
+    top = source.top_k(pergunta or "", max(1, int(k_exemplos or 3)))
     # Retorna tupla (hashable) para o cache
     return tuple(top)
 
-# Registry simples em memória para mapear digest -> lista original
-_EXEMPLOS_REGISTRY: dict[str, list[dict]] = {}
-
-
-
-def selecionar_exemplos(pergunta: str, exemplos_pool: list[dict], k_exemplos: int = 3) -> list[dict]:
+# Registry em memória (LRU): chave -> índice. ExamplePool já é o próprio índice incremental
+# (chave = pool.key); lista simples é chaveada pelo conteúdo (pergunta/SQL de cada exemplo),
+# então lista editada gera outro índice e listas iguais compartilham o mesmo.
+_EXEMPLOS_REGISTRY: "OrderedDict[tuple, object]" = OrderedDict()
+_EXEMPLOS_REGISTRY_MAX = 8
+_exemplos_lock = threading.Lock()
+
+def _example_source(exemplos_pool):
+    if hasattr(exemplos_pool, "top_k"):
+        key = ("pool", getattr(exemplos_pool, "key", None) or id(exemplos_pool))
+        source = exemplos_pool
+    else:
+        key = ("list", hash(tuple((ex.get("pergunta"), ex.get("sql")) for ex in exemplos_pool)))
+        source = None
+    with _exemplos_lock:
+        entry = _EXEMPLOS_REGISTRY.get(key)
+        if entry is not None:
+            _EXEMPLOS_REGISTRY.move_to_end(key)
+            return key, entry
+    if source is None:
+        source = ExampleIndex(list(exemplos_pool))
+    with _exemplos_lock:
+        _EXEMPLOS_REGISTRY[key] = source
+        while len(_EXEMPLOS_REGISTRY) > _EXEMPLOS_REGISTRY_MAX:
+            _EXEMPLOS_REGISTRY.popitem(last=False)
+    return key, source
+
+
+def selecionar_exemplos(pergunta: str, exemplos_pool, k_exemplos: int = 3) -> list[dict]:
     """
-    Wrapper não-cacheado: registra o pool, computa digest e delega para a versão cacheada.
-    Evita 'TypeError: unhashable type: list' no lru_cache.
+    Wrapper não-cacheado: aceita a lista de exemplos ou um ExamplePool (sementes +
+    feedback) e delega para a versão cacheada, sem re-hashear o pool a cada pergunta.
     """
-    digest = _digest_examples(exemplos_pool or [])
-    # registra uma cópia leve (evita mutações externas afetarem o cache)
-    _EXEMPLOS_REGISTRY[digest] = list(exemplos_pool or [])
-    result = _selecionar_exemplos_cached(pergunta or "", digest, int(k_exemplos or 3))
+    if not exemplos_pool:
+        return []
+    key, source = _example_source(exemplos_pool)
+    version = getattr(source, "version", 0)
+    try:
+        result = _selecionar_exemplos_cached(pergunta or "", key, version, int(k_exemplos or 3))
+    except KeyError:
+        result = source.top_k(pergunta or "", max(1, int(k_exemplos or 3)))
     return list(result)
 
 # ===========================
 # Hints dinâmicos por pergunta
 # ===========================
+def _question_signals(pergunta_usuario: str) -> dict:
+    """Sinais de palavra-chave da pergunta (compartilhados por hints e seleção de schema)."""
+    # texto bruto e normalizado
+    q_raw = (pergunta_usuario or "").strip()
+    qn = _normalize_text(q_raw)  # requer o helper _normalize_text já importado
+    return {
+        "qn": qn,
+        "area":    _contains_any(qn, [" volume", "volume ", "vol ", "m2", "área", "area"]),
+        "peso":    _contains_any(qn, [" kg", "kg ", "peso", "ton", "tonelada"]),
+        "valor":   _contains_any(qn, ["dinheiro", "valor", "faturamento", "receita", " r$", "r$"]),
+        "carteira": _contains_any(qn, ["carteira", "entrega", "data_entrega"]),
+        "otif":    _contains_any(qn, ["otif", "pontualidade", "no prazo", "completude", "in full"]),
+        "cliente": _contains_any(qn, ["cliente", "clientes"]),
+        "exclui":  _contains_any(qn, ["exclu", "sem ", "exceto", "excepto"]),
+        "plantas": [p for p in _PLANTAS_BASE if _normalize_text(p) in qn],
+    }
+
 def metric_hints_for_question(pergunta_usuario: str) -> dict:
     """
     Gera dicas de métricas/plantas com base no texto da pergunta.
     Use SEMPRE o parâmetro 'pergunta_usuario' para evitar NameError.
     """
-    # texto bruto e normalizado
-    q_raw = (pergunta_usuario or "").strip()
-    qn = _normalize_text(q_raw)  # requer o helper _normalize_text já importado
-    uses_area    = _contains_any(qn, [" volume", "volume ", "vol ", "m2", "área", "area"])
-    uses_peso    = _contains_any(qn, [" kg", "kg ", "peso", "ton", "tonelada"])
-    uses_valor   = _contains_any(qn, ["dinheiro", "valor", "faturamento", "receita", " r$", "r$"])
-    uses_cart    = _contains_any(qn, ["carteira", "entrega", "data_entrega"])
-    uses_cliente = _contains_any(qn, ["cliente", "clientes"])
-    uses_exclui  = _contains_any(qn, ["exclu", "sem ", "exceto", "excepto"])
-    plants = _PLANTAS_BASE
-    plants_hit = [p for p in plants if _normalize_text(p) in qn]
+    sig = _question_signals(pergunta_usuario)
+    uses_area, uses_peso, uses_valor = sig["area"], sig["peso"], sig["valor"]
+    uses_cart, uses_cliente, uses_exclui = sig["carteira"], sig["cliente"], sig["exclui"]
+    plants_hit = sig["plantas"]
 
     lines = []
     if uses_area:
@@ -222,19 +330,119 @@ def metric_hints_for_question(pergunta_usuario: str) -> dict:
 
 
 # ===========================
-# Montagem do prompt principal (SQL-only)
+# Seleção de schema por pergunta
 # ===========================
-# llm.py
-def montar_prompt(
+# Sinal de palavra-chave -> tabelas do SCHEMA_INFO (mesmos sinais de metric_hints_for_question)
+_SIGNAL_TABLES = {
+    "area": ("VW_DEVOLUCAO_LAB",),
+    "valor": ("VW_DEVOLUCAO_LAB", "DASH_ATUAL", "DASH_HISTORICO"),
+    "peso": ("DASH_ATUAL", "DASH_HISTORICO"),
+    "carteira": ("DASH_ATUAL", "DASH_HISTORICO"),
+    "otif": ("BI_OTIF",),
+}
+
+# Assuntos servidos por tabelas fora do SCHEMA_INFO (ex.: BI_PEDIDOS_LAB): não podar
+_SCHEMA_FALLBACK_TERMS = ["saldo", "pedido"]
+
+def _column_matches(qn: str, schema_info: Dict) -> dict:
+    """Colunas citadas pelo nome na pergunta (ignora nomes curtos/genéricos e os muito repetidos)."""
+    owners: dict[str, list[str]] = {}
+    for tabela, dados in schema_info.items():
+        for col in dados.get("colunas", {}):
+            owners.setdefault(col, []).append(tabela)
+    hits: dict[str, set] = {}
+    for col, tabelas in owners.items():
+        cn = _normalize_text(col)
+        if len(tabelas) > 2 or (len(cn) < 8 and "_" not in cn):
+            continue
+        if re.search(rf"\b({re.escape(cn)}|{re.escape(cn.replace('_', ' '))})\b", qn):
+            for t in tabelas:
+                hits.setdefault(t, set()).add(col)
+    return hits
+
+def select_schema_for_question(
     pergunta_usuario: str,
+    schema_info: Dict,
+    *,
+    prune_columns: bool = False,
+    extra_text: str = "",
+) -> Tuple[Dict, bool]:
+    """
+    Reduz o SCHEMA_INFO às tabelas (e, opcionalmente, colunas) que a pergunta provavelmente usa.
+    Retorna (schema, podado). Sem sinal suficiente, devolve o schema completo (fallback seguro).
+    'extra_text' (ex.: hints/regras) ajuda a manter colunas citadas nas regras ao podar colunas.
+    """
+    sig = _question_signals(pergunta_usuario)
+    qn = sig["qn"]
+    if _contains_any(qn, _SCHEMA_FALLBACK_TERMS):
+        return schema_info, False
+    tables = set()
+    for name, tabs in _SIGNAL_TABLES.items():
+        if sig.get(name):
+            tables.update(t for t in tabs if t in schema_info)
+    tables.update(t for t in schema_info if _normalize_text(t) in qn)
+    col_hits = _column_matches(qn, schema_info)
+    tables.update(col_hits)
+
+    if not tables or len(tables) == len(schema_info):
+        return schema_info, False
+
+    ref_text = _normalize_text(extra_text or "")
+    pruned = {}
+    for tabela, dados in schema_info.items():  # mantém a ordem original (prefixo estável)
+        if tabela not in tables:
+            continue
+        if not prune_columns:
+            pruned[tabela] = dados
+            continue
+        cols = dados.get("colunas", {})
+        keep = {
+            c: d for c, d in cols.items()
+            if c in col_hits.get(tabela, set()) or re.search(rf"\b{re.escape(_normalize_text(c))}\b", ref_text)
+        }
+        # poucas colunas reconhecidas = baixa confiança: mantém a tabela inteira
+        pruned[tabela] = {**dados, "colunas": keep if len(keep) >= 3 else cols}
+    return pruned, True
+
+
+def _schema_section_tokens(schema_info: Dict) -> int:
+    linhas = []
+    for tabela, dados in schema_info.items():
+        linhas.append(f"- {tabela}: {dados.get('descricao','')}")
+        for col, desc in dados.get("colunas", {}).items():
+            linhas.append(f"  • {col}: {desc}")
+    return count_tokens("\n".join(linhas))
+
+
+# ===========================
+# Montagem do prompt principal (SQL-only)
+# ===========================
+# Prefixo estático (regras + schema) renderizado uma vez por processo e por versão das regras.
+# Fica byte-idêntico entre perguntas para aproveitar o prompt caching do Azure OpenAI.
+_STATIC_PREFIX_CACHE: dict = {}
+
+def render_static_prefix(
     schema_info: Dict,
     regras_metricas: str,
-    exemplos_pool: List[Dict],
     dbname: str,
-    k_exemplos: int = 12,
     schema_text_db: str = "",
-    historico_text: str = "",          # <--- NOVO
+    version: Optional[str] = None,
 ) -> str:
+    """
+    Com 'version' (ex.: RULES_VERSION, que já cobre schema e regras), a chave é a versão +
+    tabelas/colunas do subconjunto, sem serializar nada; sem ela, hash do conteúdo.
+    """
+    if version is not None:
+        key = (version, dbname, schema_text_db,
+               tuple((t, tuple(d.get("colunas", {}))) for t, d in schema_info.items()))
+    else:
+        key = hashlib.sha1(
+            json.dumps([schema_info, regras_metricas, dbname, schema_text_db], sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+    cached = _STATIC_PREFIX_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     partes = [
         "Você é um conversor de Linguagem Natural para SQL Server (T-SQL).",
         "Responda APENAS com um bloco markdown contendo somente a query SQL:",
@@ -252,17 +460,6 @@ def montar_prompt(
         regras_metricas,
     ]
 
-    spec = metric_hints_for_question(pergunta_usuario)
-    if spec:
-        partes.append("\n=== AJUSTES PARA ESTA PERGUNTA ===")
-        partes.append(spec)
-
-    # <<< NOVO: entra ANTES da pergunta corrente >>>
-    if historico_text and historico_text.strip():
-        partes.append("\n=== CONTEXTO DA CONVERSA (use se necessário) ===")
-        # O histórico já vem resumido (resumos/mini CSV/SQL anteriores)
-        partes.append(historico_text)
-
     partes.append("\n=== ESQUEMA (SCHEMA_INFO) ===")
     for tabela, dados in schema_info.items():
         partes.append(f"- {tabela}: {dados.get('descricao','')}")
@@ -273,16 +470,149 @@ def montar_prompt(
         partes.append("\n=== ESQUEMA (INFORMATION_SCHEMA — resumo) ===")
         partes.append(schema_text_db)
 
-    exs = selecionar_exemplos(pergunta_usuario, exemplos_pool, k_exemplos)
-    if exs:
-        partes.append("\n=== EXEMPLOS DE FORMATO (similaridade) ===")
-        for ex in exs:
-            sql_ex = (ex["sql"] or "").rstrip().rstrip(";") + "; --END"
-            partes.append(f"Pergunta: {ex['pergunta']}\n```sql\n{sql_ex}\n```")
+    prefix = "\n".join(partes)
+    _STATIC_PREFIX_CACHE[key] = prefix
+    return prefix
+
+
+_HINTS_HEADER = "\n=== AJUSTES PARA ESTA PERGUNTA ==="
+_EXAMPLES_HEADER = "\n=== EXEMPLOS DE FORMATO (similaridade) ==="
+_HISTORY_HEADER = "\n=== CONTEXTO DA CONVERSA (use se necessário) ==="
+_ANSWER_FOOTER = "Responda apenas com o bloco ```sql ... ``` finalizando com '; --END'."
+
+
+def _fit_prompt_budget(budget: int, prefix: str, fixed_tokens: int, ex_blocks: list, hist_blocks: list,
+                       compact_prefix, min_examples: int):
+    """
+    Corta o que vale menos até caber em 'budget': exemplos além de 'min_examples' (menos
+    similares primeiro), histórico mais antigo, colunas do schema (compact_prefix) e, por
+    último, os exemplos restantes. Retorna (prefixo, exemplos, histórico, cortes).
+    """
+    ex_t = [count_tokens(b) for b in ex_blocks]
+    hist_t = [count_tokens(b) for b in hist_blocks]
+    prefix_t = count_tokens(prefix)
+    cut = {"examples": 0, "history_blocks": 0, "schema_columns": False}
+
+    def over() -> bool:
+        return prefix_t + fixed_tokens + sum(ex_t) + sum(hist_t) > budget
+
+    while over() and len(ex_t) > min_examples:
+        ex_t.pop()
+        cut["examples"] += 1
+    while over() and hist_t:
+        hist_t.pop(0)
+        cut["history_blocks"] += 1
+    if over():
+        smaller = compact_prefix()
+        if smaller and count_tokens(smaller) < prefix_t:
+            prefix, prefix_t = smaller, count_tokens(smaller)
+            cut["schema_columns"] = True
+    while over() and ex_t:
+        ex_t.pop()
+        cut["examples"] += 1
+    return prefix, ex_blocks[:len(ex_t)], hist_blocks[len(hist_blocks) - len(hist_t):], cut
+
+
+def montar_prompt(
+    pergunta_usuario: str,
+    schema_info: Dict,
+    regras_metricas: str,
+    exemplos_pool: List[Dict],
+    dbname: str,
+    k_exemplos: int = 12,
+    schema_text_db: str = "",
+    historico_text: str = "",          # <--- NOVO
+    stats: Optional[dict] = None,
+    token_budget: Optional[int] = None,
+    historico_blocks: Optional[List[str]] = None,
+    prefix_version: Optional[str] = None,
+) -> str:
+    """
+    Prompt = prefixo estático (regras, schema) + sufixo dinâmico (hints, exemplos,
+    histórico, pergunta). Nada que dependa da pergunta pode entrar no prefixo.
+    Com SCHEMA_PRUNE_ENABLED, o schema é reduzido às tabelas prováveis da pergunta
+    (o prefixo continua cacheado, um por subconjunto de tabelas; prefix_version evita
+    re-hashear schema e regras a cada pergunta).
+    O prompt inteiro respeita token_budget (padrão PROMPT_TOKEN_BUDGET; 0 desliga): ver
+    _fit_prompt_budget para a ordem dos cortes. Regras, hints e pergunta nunca são cortados.
+    Se 'stats' for passado, recebe as tabelas usadas, a economia do schema, os tokens por
+    seção e o que foi cortado.
+    O histórico entra em blocos inteiros (historico_blocks, de ChatContext.blocks); um
+    historico_text avulso é tratado como um bloco só (resumos podem ter linhas em branco).
+    """
+    spec = metric_hints_for_question(pergunta_usuario)
+    schema_used, pruned = schema_info, False
+    if SCHEMA_PRUNE_ENABLED and schema_info:
+        schema_used, pruned = select_schema_for_question(
+            pergunta_usuario, schema_info,
+            prune_columns=SCHEMA_PRUNE_COLUMNS, extra_text=regras_metricas + "\n" + spec,
+        )
+    if stats is not None:
+        stats["schema_tables"] = list(schema_used.keys())
+        stats["schema_pruned"] = pruned
+        stats["schema_tokens_saved"] = (
+            _schema_section_tokens(schema_info) - _schema_section_tokens(schema_used) if pruned else 0
+        )
+
+    prefix = render_static_prefix(schema_used, regras_metricas, dbname, schema_text_db, prefix_version)
+    ex_blocks = []
+    for ex in selecionar_exemplos(pergunta_usuario, exemplos_pool, k_exemplos):
+        sql_ex = (ex["sql"] or "").rstrip().rstrip(";") + "; --END"
+        ex_blocks.append(f"Pergunta: {ex['pergunta']}\n```sql\n{sql_ex}\n```")
+    # O histórico já vem resumido (resumos/mini CSV/SQL anteriores); o orçamento corta blocos inteiros
+    if historico_blocks is not None:
+        hist_blocks = [b for b in historico_blocks if b and b.strip()]
+    else:
+        hist_blocks = [historico_text.strip()] if historico_text and historico_text.strip() else []
+    question = f"\nPergunta do usuário: {pergunta_usuario}"
+
+    budget = PROMPT_TOKEN_BUDGET if token_budget is None else int(token_budget)
+    cut = None
+    if budget > 0:
+        def compact_prefix():
+            if not (SCHEMA_PRUNE_ENABLED and schema_info):
+                return None
+            compact, _ = select_schema_for_question(
+                pergunta_usuario, schema_info, prune_columns=True, extra_text=regras_metricas + "\n" + spec,
+            )
+            return render_static_prefix(compact, regras_metricas, dbname, version=prefix_version)
+
+        fixed = sum(count_tokens(t) for t in (_HINTS_HEADER, spec, _EXAMPLES_HEADER, _HISTORY_HEADER,
+                                              question, _ANSWER_FOOTER) if t)
+        prefix, ex_blocks, hist_blocks, cut = _fit_prompt_budget(
+            budget, prefix, fixed, ex_blocks, hist_blocks, compact_prefix, PROMPT_MIN_EXAMPLES,
+        )
 
-    partes.append(f"\nPergunta do usuário: {pergunta_usuario}")
-    partes.append("Responda apenas com o bloco ```sql ... ``` finalizando com '; --END'.")
-    return "\n".join(partes)
+    partes = [prefix]
+    if spec:
+        partes.append(_HINTS_HEADER)
+        partes.append(spec)
+    if ex_blocks:
+        partes.append(_EXAMPLES_HEADER)
+        partes.extend(ex_blocks)
+    # Histórico entra por último, logo ANTES da pergunta corrente
+    if hist_blocks:
+        partes.append(_HISTORY_HEADER)
+        partes.append("\n\n".join(hist_blocks))
+    partes.append(question)
+    partes.append(_ANSWER_FOOTER)
+    prompt = "\n".join(partes)
+
+    if stats is not None:
+        rules_t = count_tokens(regras_metricas)
+        stats["prompt_tokens"] = {
+            "regras": rules_t,
+            "schema": count_tokens(prefix) - rules_t,
+            "ajustes": count_tokens(spec),
+            "exemplos": sum(count_tokens(b) for b in ex_blocks),
+            "historico": sum(count_tokens(b) for b in hist_blocks),
+            "pergunta": count_tokens(question),
+            "total": count_tokens(prompt),
+        }
+        stats["prompt_budget"] = budget
+        stats["prompt_trimmed"] = cut
+        stats["tokenizer"] = tokenizer_name()
+    return prompt
 
 # ===========================
 # Extração do SQL da resposta do modelo
@@ -328,7 +658,7 @@ def extract_answer_and_sql(text: str) -> Tuple[str, str]:
 
 
 # === INTENT ROUTER / GENERAL CHAT ============================================
-import json, re
+import json
 from typing import Any, Dict
 
 _SQL_HEUR = [
@@ -391,13 +721,13 @@ def _classify_via_llm(q: str) -> Dict[str, Any]:
     {q}
     """)
 
-    resp = _client.chat.completions.create(
-        model=AZURE_OAI_DEPLOYMENT,
-        messages=[
+    resp = _chat_complete(
+        [
             {"role":"system","content":"Classifique e retorne APENAS JSON válido em UMA linha."},
             {"role":"user","content":prompt},
         ],
         temperature=0.1, top_p=0.9, max_completion_tokens=120,
+        priority=PRIORITY_CLASSIFICATION,  # curta e bloqueia o turno: passa na frente da geração
     )
 
     parsed = _safe_load_json_line(resp.choices[0].message.content if resp.choices else "")
@@ -420,12 +750,37 @@ def _classify_cached(q_norm: str) -> Dict[str, Any]:
     return _classify_via_llm(q_norm)
 
 
+# Rota já classificada por pergunta normalizada (espelha o lru_cache acima, que não permite consulta)
+_KNOWN_ROUTES: "OrderedDict[str, str]" = OrderedDict()
+_KNOWN_ROUTES_MAX = 512
+_known_routes_lock = threading.Lock()
+
+
+def needs_llm_classification(q: str) -> bool:
+    """
+    True quando vale especular a SQL: as heurísticas não decidem e a rota ainda não está
+    no cache de classificação (ou já está, e é 'sql').
+    """
+    qn = _norm_txt(q or "")
+    if _rule_based_guess(qn):
+        return False
+    with _known_routes_lock:
+        route = _KNOWN_ROUTES.get(qn)
+    return route is None or route == "sql"
+
+
 def classify_intent(q: str) -> Dict[str, Any]:
     """
     Classifica a pergunta do usuário em 'sql' | 'gpt' | 'tool' (com cache LRU por texto normalizado).
     """
     qn = _norm_txt(q or "")
-    return _classify_cached(qn)
+    intent = _classify_cached(qn)
+    with _known_routes_lock:
+        _KNOWN_ROUTES[qn] = (intent or {}).get("route", "sql")
+        _KNOWN_ROUTES.move_to_end(qn)
+        while len(_KNOWN_ROUTES) > _KNOWN_ROUTES_MAX:
+            _KNOWN_ROUTES.popitem(last=False)
+    return intent
 
 
 
@@ -439,9 +794,8 @@ def call_azure_openai_general(
     """
     Resposta 'texto livre' em PT-BR, objetiva.
     """
-    resp = _client.chat.completions.create(
-        model=AZURE_OAI_DEPLOYMENT,
-        messages=[
+    resp = _chat_complete(
+        [
             {"role":"system","content":"Responda em português, de forma objetiva e clara."},
             {"role":"user","content":prompt},
         ],
@@ -462,5 +816,7 @@ def call_azure_openai_general(
 
 def clear_intent_cache():
     _classify_cached.cache_clear()
+    with _known_routes_lock:
+        _KNOWN_ROUTES.clear()
 
 
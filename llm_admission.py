@@ -0,0 +1,174 @@
+# llm_admission.py — controle de admissão para a cota do Azure OpenAI (TPM/RPM)
+#
+# Token bucket por processo (tokens e requisições por minuto), fila com prioridade,
+# pausa global quando o Azure manda Retry-After e circuit breaker para falhas seguidas.
+# Roda dentro do event loop do llm_gateway (sem locks: tudo no mesmo loop).
+
+import time
+import heapq
+import asyncio
+import itertools
+
+# menor = atendido antes
+PRIORITY_CLASSIFICATION = 0
+PRIORITY_GENERATION = 1
+
+
+class CircuitOpenError(RuntimeError):
+    """Circuito aberto: falhas seguidas no Azure; chamadas são recusadas até o cooldown."""
+
+
+class AdmissionTimeout(RuntimeError):
+    """A requisição esperou na fila mais que o permitido."""
+
+
+def retry_after_seconds(e: Exception):
+    """Lê Retry-After (ms ou s) da resposta HTTP de um erro do SDK, se houver."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        *,
+        tpm: int = 0,
+        rpm: int = 0,
+        max_wait: float = 60.0,
+        breaker_failures: int = 5,
+        breaker_cooldown: float = 30.0,
+        clock=time.monotonic,
+    ):
+        self.tpm = int(tpm)  # 0 = sem limite
+        self.rpm = int(rpm)
+        self.max_wait = float(max_wait)
+        self.breaker_failures = max(1, int(breaker_failures))
+        self.breaker_cooldown = float(breaker_cooldown)
+        self._clock = clock
+        self._tokens = float(self.tpm)
+        self._requests = float(self.rpm)
+        self._last_refill = clock()
+        self._blocked_until = 0.0
+        self._fail_streak = 0
+        self._open_until = 0.0
+        self._waiters = []  # heap: ((batch, prioridade), seq, tokens, future, enfileirado_em)
+        self._seq = itertools.count()
+        self._timer = None
+        self._stats = {
+            "admitted": 0, "rejected_circuit": 0, "timeouts": 0, "throttled": 0, "reconciled_tokens": 0,
+            "wait_ms_last": 0.0, "wait_ms_max": 0.0, "wait_ms_total": 0.0,
+        }
+
+    # ---------- bucket ----------
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0.0, now - self._last_refill)
+        self._last_refill = now
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+
+    def _seconds_until(self, tokens: float) -> float:
+        need = 0.0
+        if self.tpm and self._tokens < tokens:
+            need = max(need, (tokens - self._tokens) * 60.0 / self.tpm)
+        if self.rpm and self._requests < 1:
+            need = max(need, (1 - self._requests) * 60.0 / self.rpm)
+        return need
+
+    def _schedule(self, delay: float):
+        loop = asyncio.get_running_loop()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(max(0.01, delay), self._pump)
+
+    def _pump(self):
+        self._timer = None
+        self._refill()
+        while self._waiters:
+            _, _, tokens, fut, queued_at = self._waiters[0]
+            if fut.done():  # cancelada/expirada
+                heapq.heappop(self._waiters)
+                continue
+            now = self._clock()
+            if now < self._blocked_until:
+                self._schedule(self._blocked_until - now)
+                return
+            wait = self._seconds_until(tokens)
+            if wait > 0:
+                self._schedule(wait)
+                return
+            heapq.heappop(self._waiters)
+            if self.tpm:
+                self._tokens -= tokens
+            if self.rpm:
+                self._requests -= 1
+            waited_ms = (now - queued_at) * 1000.0
+            self._stats["admitted"] += 1
+            self._stats["wait_ms_last"] = round(waited_ms, 1)
+            self._stats["wait_ms_max"] = round(max(self._stats["wait_ms_max"], waited_ms), 1)
+            self._stats["wait_ms_total"] += waited_ms
+            fut.set_result(waited_ms)
+
+    # ---------- API ----------
+    async def acquire(self, tokens: int, priority: int = PRIORITY_GENERATION, batch: bool = False) -> float:
+        """Espera a vez na fila; retorna o tempo de espera (ms)."""
+        now = self._clock()
+        if now < self._open_until:
+            self._stats["rejected_circuit"] += 1
+            raise CircuitOpenError("Azure OpenAI indisponível (circuit breaker aberto). Tente novamente em instantes.")
+        tokens = min(float(tokens), float(self.tpm)) if self.tpm else float(tokens)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, ((int(bool(batch)), int(priority)), next(self._seq), tokens, fut, now))
+        self._pump()
+        try:
+            return await asyncio.wait_for(fut, self.max_wait)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise AdmissionTimeout(f"Fila do Azure OpenAI excedeu {self.max_wait:.0f}s de espera.")
+
+    def reconcile(self, estimated: int, actual: int):
+        """Devolve ao bucket a diferença entre o que foi cobrado na admissão e o uso real."""
+        if not self.tpm:
+            return
+        charged = min(float(estimated), float(self.tpm))
+        diff = charged - float(actual)
+        self._refill()
+        self._tokens = min(float(self.tpm), self._tokens + diff)
+        self._stats["reconciled_tokens"] += round(diff)
+        if diff > 0 and self._waiters:
+            self._pump()
+
+    def on_throttled(self, retry_after: float):
+        """429: pausa todas as admissões até o Retry-After indicado pelo Azure."""
+        self._stats["throttled"] += 1
+        self._blocked_until = max(self._blocked_until, self._clock() + max(0.0, retry_after))
+        if self.tpm:
+            self._tokens = min(self._tokens, 0.0)  # cota esgotada do lado do servidor
+
+    def on_success(self):
+        self._fail_streak = 0
+        self._open_until = 0.0
+
+    def on_failure(self):
+        self._fail_streak += 1
+        if self._fail_streak >= self.breaker_failures:
+            # após o cooldown, a próxima falha reabre imediatamente (meio-aberto)
+            self._open_until = self._clock() + self.breaker_cooldown
+
+    def stats(self) -> dict:
+        out = dict(self._stats)
+        admitted = out["admitted"]
+        out["wait_ms_avg"] = round(out.pop("wait_ms_total") / admitted, 1) if admitted else 0.0
+        out["queue_depth"] = sum(1 for w in self._waiters if not w[3].done())
+        out["circuit"] = "open" if self._clock() < self._open_until else "closed"
+        out["tokens_available"] = round(self._tokens) if self.tpm else None
+        return out
@@ -0,0 +1,273 @@
+# llm_gateway.py — gateway assíncrono único para o Azure OpenAI
+#
+# Um event loop em thread própria, um AsyncAzureOpenAI com pool HTTP keep-alive compartilhado,
+# limite de concorrência e retry/timeout uniformes. O Streamlit usa a fachada síncrona
+# (chat/stream/run_many); chamadas concorrentes no mesmo turno usam submit/run_many.
+
+import queue
+import random
+import asyncio
+import threading
+import concurrent.futures
+
+from config import (
+    AZURE_OAI_ENDPOINT, AZURE_OAI_DEPLOYMENT, AZURE_OAI_API_VERSION, AZURE_OAI_API_KEY,
+    HTTP_TIMEOUT_SECONDS, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY,
+    LLM_MAX_CONCURRENCY, LLM_POOL_MAX_CONNECTIONS, LLM_POOL_MAX_KEEPALIVE,
+    LLM_QUOTA_TPM, LLM_QUOTA_RPM, LLM_ADMISSION_MAX_WAIT,
+    LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_SECONDS,
+)
+from llm_admission import (
+    AdmissionController, CircuitOpenError, AdmissionTimeout, retry_after_seconds,
+    PRIORITY_GENERATION,
+)
+from token_count import count_tokens
+
+# status HTTP em que vale repetir (demais 4xx são erro do pedido)
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _default_client_factory():
+    """Cria o cliente assíncrono com pool keep-alive (chamado dentro do loop do gateway)."""
+    if not AZURE_OAI_API_KEY:
+        raise RuntimeError("AZURE_OAI_API_KEY não definido. Configure a variável de ambiente.")
+    import httpx
+    from openai import AsyncAzureOpenAI
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+        ),
+        timeout=HTTP_TIMEOUT_SECONDS,
+    )
+    return AsyncAzureOpenAI(
+        api_version=AZURE_OAI_API_VERSION,
+        azure_endpoint=AZURE_OAI_ENDPOINT,
+        api_key=AZURE_OAI_API_KEY,
+        timeout=HTTP_TIMEOUT_SECONDS,
+        max_retries=0,  # retry fica a cargo do gateway
+        http_client=http_client,
+    )
+
+
+def _estimate_tokens(messages, max_completion_tokens) -> int:
+    """Estimativa do que a chamada consome da cota TPM (tokens do prompt + máximo de saída)."""
+    prompt = sum(count_tokens(m.get("content") or "") + 4 for m in messages if isinstance(m, dict))
+    return prompt + int(max_completion_tokens or 0)
+
+
+def _total_tokens(usage_holder):
+    """total_tokens do usage de uma resposta (ou chunk final do streaming), se houver."""
+    usage = getattr(usage_holder, "usage", None)
+    total = getattr(usage, "total_tokens", None)
+    return int(total) if isinstance(total, (int, float)) else None
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, RuntimeError) and "AZURE_OAI_API_KEY" in str(e):
+        return False
+    if isinstance(e, (CircuitOpenError, AdmissionTimeout)):
+        return False
+    status = getattr(e, "status_code", None)
+    return status is None or status in _RETRYABLE_STATUS
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        *,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        timeout: float = HTTP_TIMEOUT_SECONDS,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_base_delay: float = LLM_RETRY_BASE_DELAY,
+        model: str = AZURE_OAI_DEPLOYMENT,
+        client_factory=None,
+        admission: AdmissionController = None,
+    ):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = float(timeout)
+        self.max_retries = max(1, int(max_retries))
+        self.retry_base_delay = float(retry_base_delay)
+        self.model = model
+        self._client_factory = client_factory or _default_client_factory
+        self._client = None
+        self._sem = None
+        self._loop = None
+        self._lock = threading.Lock()
+        self.admission = admission or AdmissionController(
+            tpm=LLM_QUOTA_TPM, rpm=LLM_QUOTA_RPM, max_wait=LLM_ADMISSION_MAX_WAIT,
+            breaker_failures=LLM_BREAKER_FAILURES, breaker_cooldown=LLM_BREAKER_COOLDOWN_SECONDS,
+        )
+
+    # ---------- loop/cliente ----------
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                t = threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True)
+                t.start()
+                self._loop = loop
+            return self._loop
+
+    def _client_in_loop(self):
+        if self._client is None:
+            self._client = self._client_factory()
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _with_retry(self, make_call, timeout: float = None, *, est_tokens: int = 0,
+                          priority: int = PRIORITY_GENERATION, batch: bool = False,
+                          can_retry=None, used_tokens=None):
+        """
+        Cobra a estimativa da cota uma vez por chamada lógica; as novas tentativas só passam
+        pela fila (RPM, pausa de 429, circuito). Com sucesso, used_tokens(resultado) devolve o
+        consumo real e a diferença volta para o bucket. can_retry() False encerra os retries.
+        """
+        client = self._client_in_loop()
+        for attempt in range(1, self.max_retries + 1):
+            await self.admission.acquire(est_tokens if attempt == 1 else 0, priority, batch)
+            try:
+                async with self._sem:
+                    result = await asyncio.wait_for(make_call(client), timeout or self.timeout)
+            except Exception as e:
+                if not _is_retryable(e):
+                    raise
+                retry_after = retry_after_seconds(e)
+                throttled = getattr(e, "status_code", None) == 429  # 429 é cota, não indisponibilidade
+                if throttled:
+                    # pausa global: a próxima tentativa (e as demais da fila) esperam no acquire
+                    self.admission.on_throttled(retry_after if retry_after is not None else self.retry_base_delay)
+                else:
+                    self.admission.on_failure()
+                if attempt >= self.max_retries or (can_retry is not None and not can_retry()):
+                    raise
+                if not throttled:
+                    delay = retry_after or self.retry_base_delay * (2 ** (attempt - 1))
+                    await asyncio.sleep(delay * (0.8 + 0.4 * random.random()))
+                continue
+            self.admission.on_success()
+            actual = used_tokens(result) if used_tokens is not None else None
+            if actual is not None:
+                self.admission.reconcile(est_tokens, actual)
+            return result
+
+    # ---------- API assíncrona ----------
+    async def achat(self, messages, *, temperature, top_p, max_completion_tokens, timeout: float = None,
+                    priority: int = PRIORITY_GENERATION, batch: bool = False):
+        msgs = list(messages)
+        return await self._with_retry(
+            lambda c: c.chat.completions.create(
+                model=self.model, messages=msgs, temperature=temperature, top_p=top_p,
+                max_completion_tokens=max_completion_tokens,
+            ),
+            timeout,
+            est_tokens=_estimate_tokens(msgs, max_completion_tokens), priority=priority, batch=batch,
+            used_tokens=_total_tokens,
+        )
+
+    async def astream(self, messages, *, temperature, top_p, max_completion_tokens,
+                      on_delta=None, should_stop=None, timeout: float = None,
+                      priority: int = PRIORITY_GENERATION, batch: bool = False):
+        """
+        Lê a completion em streaming. Retorna (texto, chunk_de_usage|None, parou_cedo).
+        Retry apenas antes do primeiro token; o timeout vale para a chamada inteira.
+        """
+        msgs = list(messages)
+        parts = []
+
+        async def _consume(client):
+            stream = await client.chat.completions.create(
+                model=self.model, messages=msgs, temperature=temperature, top_p=top_p,
+                max_completion_tokens=max_completion_tokens,
+                stream=True, stream_options={"include_usage": True},
+            )
+            usage_chunk, stopped = None, False
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        usage_chunk = chunk
+                    if not getattr(chunk, "choices", None):
+                        continue
+                    delta = getattr(chunk.choices[0].delta, "content", None) or ""
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    text = "".join(parts)
+                    if on_delta is not None:
+                        on_delta(text)
+                    if should_stop is not None and should_stop(text):
+                        stopped = True
+                        break
+            finally:
+                try:
+                    await stream.close()  # libera a conexão sem esperar o resto da geração
+                except Exception:
+                    pass
+            return "".join(parts), usage_chunk, stopped
+
+        def _used_tokens(result):
+            text, usage_chunk, _ = result
+            total = _total_tokens(usage_chunk)
+            if total is None:  # parou antes do chunk de usage: conta localmente
+                total = sum(count_tokens(m.get("content") or "") for m in msgs if isinstance(m, dict))
+                total += count_tokens(text)
+            return total
+
+        try:
+            return await self._with_retry(
+                _consume, timeout,
+                est_tokens=_estimate_tokens(msgs, max_completion_tokens), priority=priority, batch=batch,
+                can_retry=lambda: not parts,  # já entregou texto: não repete a chamada
+                used_tokens=_used_tokens,
+            )
+        except Exception as e:
+            if parts:
+                raise RuntimeError("Streaming interrompido após o início da resposta.") from e
+            raise
+
+    # ---------- fachada síncrona ----------
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Agenda uma corrotina no loop do gateway; devolve um Future thread-safe."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def chat(self, messages, **kw):
+        return self.submit(self.achat(messages, **kw)).result()
+
+    def stats(self) -> dict:
+        """Profundidade da fila, tempos de espera, 429s e estado do circuit breaker."""
+        return self.admission.stats()
+
+    def run_many(self, coros) -> list:
+        """Executa várias chamadas concorrentemente (respeitando o limite) e devolve na ordem."""
+        async def _gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.submit(_gather()).result()
+
+    def stream(self, messages, *, on_delta=None, should_stop=None, **kw):
+        """
+        Streaming síncrono: os deltas chegam do loop via fila e on_delta roda na thread
+        chamadora (necessário para desenhar no Streamlit).
+        """
+        q = queue.Queue()
+        fut = self.submit(self.astream(messages, on_delta=q.put, should_stop=should_stop, **kw))
+        latest = None
+        while not (fut.done() and q.empty()):
+            try:
+                latest = q.get(timeout=0.02)
+            except queue.Empty:
+                continue
+            if on_delta is not None and q.empty():
+                on_delta(latest)
+        return fut.result()
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway() -> LLMGateway:
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
@@ -0,0 +1,227 @@
+# query_cache.py — cache de resultados do run_query (LRU em memória + Parquet em disco)
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from sql_utils import normalize_sql_key, referenced_tables
+
+
+class QueryResultCache:
+    """
+    Cache de DataFrames em dois níveis, chaveado pela SQL normalizada (+ 'scope', ex.: o
+    banco de origem, para que a mesma SQL em outra conexão não devolva o resultado errado).
+    - Nível 1: LRU em memória limitado a 'max_items' entradas.
+    - Nível 2: arquivos Parquet em 'cache_dir' (sobrevive a reinícios do Streamlit).
+    O TTL de cada entrada é o menor TTL entre as tabelas citadas na SQL; no disco, as
+    vencidas são apagadas numa varredura a cada 'disk_sweep_seconds' (além do limite de arquivos).
+    Opcionalmente guarda o carimbo de alteração das tabelas e invalida quando ele muda.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_items: int = 128,
+        max_rows: int = 50000,
+        cache_dir: str = "",
+        disk_enabled: bool = True,
+        disk_max_files: int = 512,
+        table_ttls: dict = None,
+        default_ttl: float = 600.0,
+        disk_sweep_seconds: float = 60.0,
+    ):
+        self.max_items = max(1, int(max_items))
+        self.max_rows = int(max_rows)
+        self.cache_dir = cache_dir
+        self.disk_enabled = bool(disk_enabled and cache_dir)
+        self.disk_max_files = int(disk_max_files)
+        self.table_ttls = {k.upper(): float(v) for k, v in (table_ttls or {}).items()}
+        self.default_ttl = float(default_ttl)
+        self.disk_sweep_seconds = float(disk_sweep_seconds)
+        self._last_sweep = 0.0
+        self._mem = OrderedDict()  # key -> (df, expires_at, stamps)
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits_mem": 0, "hits_disk": 0, "misses": 0, "stores": 0,
+            "evictions": 0, "expired": 0, "invalidated": 0, "skipped_large": 0,
+        }
+
+    # ---------- chaves / TTL ----------
+    @staticmethod
+    def key_for(sql_text: str, scope: str = "") -> str:
+        raw = normalize_sql_key(sql_text)
+        if scope:
+            raw = f"{scope}|{raw}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def tables_for(self, sql_text: str) -> list[str]:
+        return referenced_tables(sql_text, list(self.table_ttls.keys()))
+
+    def ttl_for(self, sql_text: str) -> float:
+        ttls = [self.table_ttls[t] for t in self.tables_for(sql_text)]
+        return min(ttls) if ttls else self.default_ttl
+
+    # ---------- API ----------
+    def get(self, sql_text: str, stamps: dict = None, scope: str = ""):
+        """Retorna uma cópia do DataFrame cacheado ou None (miss/expirado/invalidado)."""
+        key = self.key_for(sql_text, scope)
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                df, expires_at, saved = entry
+                if self._is_stale(expires_at, saved, stamps, now):
+                    self._drop(key)
+                else:
+                    self._mem.move_to_end(key)
+                    self._stats["hits_mem"] += 1
+                    return df.copy()
+
+        entry = self._disk_read(key)
+        if entry is not None:
+            df, expires_at, saved = entry
+            with self._lock:
+                if self._is_stale(expires_at, saved, stamps, now):
+                    self._drop(key)
+                else:
+                    self._mem_put(key, df, expires_at, saved)
+                    self._stats["hits_disk"] += 1
+                    return df.copy()
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, sql_text: str, df: pd.DataFrame, stamps: dict = None, scope: str = "") -> bool:
+        if df is None or not isinstance(df, pd.DataFrame):
+            return False
+        if len(df) > self.max_rows:
+            with self._lock:
+                self._stats["skipped_large"] += 1
+            return False
+        key = self.key_for(sql_text, scope)
+        expires_at = time.time() + self.ttl_for(sql_text)
+        saved = dict(stamps or {})
+        with self._lock:
+            self._mem_put(key, df.copy(), expires_at, saved)
+            self._stats["stores"] += 1
+        self._disk_write(key, df, expires_at, saved)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+        if self.disk_enabled and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats)
+            out["mem_items"] = len(self._mem)
+        lookups = out["hits_mem"] + out["hits_disk"] + out["misses"]
+        out["hit_ratio"] = round((out["hits_mem"] + out["hits_disk"]) / lookups, 4) if lookups else 0.0
+        return out
+
+    # ---------- internos ----------
+    def _is_stale(self, expires_at: float, saved: dict, stamps: dict, now: float) -> bool:
+        if now >= expires_at:
+            self._stats["expired"] += 1
+            return True
+        if stamps:
+            for t, stamp in stamps.items():
+                if t in saved and saved[t] != stamp:
+                    self._stats["invalidated"] += 1
+                    return True
+        return False
+
+    def _mem_put(self, key, df, expires_at, saved):
+        self._mem[key] = (df, expires_at, saved)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _drop(self, key):
+        self._mem.pop(key, None)
+        if self.disk_enabled:
+            for ext in (".parquet", ".json"):
+                try:
+                    os.remove(os.path.join(self.cache_dir, key + ext))
+                except Exception:
+                    pass
+
+    def _disk_read(self, key):
+        if not self.disk_enabled:
+            return None
+        data_path = os.path.join(self.cache_dir, key + ".parquet")
+        meta_path = os.path.join(self.cache_dir, key + ".json")
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            df = pd.read_parquet(data_path)
+            return df, float(meta.get("expires_at", 0)), meta.get("stamps") or {}
+        except Exception:
+            return None
+
+    def _disk_write(self, key, df, expires_at, saved):
+        if not self.disk_enabled:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            data_path = os.path.join(self.cache_dir, key + ".parquet")
+            df.to_parquet(data_path, index=False)
+            with open(os.path.join(self.cache_dir, key + ".json"), "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "stamps": saved}, f)
+            self._disk_prune()
+        except Exception:
+            # sem pyarrow/fastparquet ou disco somente leitura: segue só com a memória
+            pass
+
+    def _disk_prune(self):
+        now = time.time()
+        if now - self._last_sweep >= self.disk_sweep_seconds:
+            self._last_sweep = now
+            self._disk_sweep_expired(now)
+        files = [
+            os.path.join(self.cache_dir, n)
+            for n in os.listdir(self.cache_dir) if n.endswith(".parquet")
+        ]
+        if len(files) <= self.disk_max_files:
+            return
+        files.sort(key=lambda p: os.path.getmtime(p))
+        for path in files[: len(files) - self.disk_max_files]:
+            for p in (path, path[: -len(".parquet")] + ".json"):
+                try:
+                    os.remove(p)
+                except Exception:
+                    pass
+
+    def _disk_sweep_expired(self, now: float):
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[: -len(".json")]
+            try:
+                with open(os.path.join(self.cache_dir, name), "r", encoding="utf-8") as f:
+                    expires_at = float(json.load(f).get("expires_at", 0))
+            except Exception:
+                continue
+            if now >= expires_at:
+                for p in (name, key + ".parquet"):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, p))
+                    except Exception:
+                        pass
+                with self._lock:
+                    self._stats["expired"] += 1
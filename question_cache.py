@@ -0,0 +1,173 @@
+# question_cache.py — cache persistente pergunta -> SQL validada (SQLite local)
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from datetime import date
+
+from config import (
+    QUESTION_CACHE_PATH, QUESTION_CACHE_TTL_SECONDS, QUESTION_CACHE_REQUIRE_APPROVAL,
+)
+from sql_utils import normalize_sql_token
+
+
+def normalize_question(q: str) -> str:
+    """Minúsculas, sem acentos, sem pontuação final e com espaços colapsados."""
+    s = normalize_sql_token((q or "").strip())
+    s = re.sub(r"\s+", " ", s)
+    return s.strip(" ?!.;:")
+
+
+def rules_version(schema_info: dict, metric_rules: str, regras_gerais, exemplos_pool) -> str:
+    """Hash do que define a geração de SQL; muda quando schema/regras/exemplos mudam."""
+    payload = json.dumps(
+        [schema_info or {}, metric_rules or "", list(regras_gerais or []), exemplos_pool or []],
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+# Termos de tempo relativo: a mesma pergunta vira outra SQL a cada dia (datas literais)
+_RELATIVE_TIME = re.compile(
+    r"\b(hoje|ontem|anteontem|amanha|agora|atual|atualmente|corrente|recentes?"
+    r"|([dn]?(est|ess)[ae]|ultim[ao]s?|proxim[ao]s?|passad[ao]s?)\s+(\d+\s+)?(dias?|semanas?|mes|meses|anos?|trimestres?)"
+    r"|(dia|semana|mes|ano|trimestre)s?\s+(passad[ao]s?|atual|corrente|anterior))\b"
+)
+
+
+def relative_time_scope(question: str, today: date = None) -> str:
+    """Data de hoje se a pergunta usa tempo relativo ('hoje', 'este mês'...), senão ''."""
+    if not _RELATIVE_TIME.search(normalize_question(question)):
+        return ""
+    return (today or date.today()).isoformat()
+
+
+class QuestionSQLCache:
+    """
+    Guarda a SQL que já executou com sucesso para uma pergunta, chaveada por
+    pergunta normalizada + digest do contexto de conversa + versão das regras (+ a data do
+    dia, se a pergunta usa tempo relativo). 👍 marca a entrada como aprovada; 👎 a remove.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, require_approval: bool = False):
+        self.path = path
+        self.ttl_seconds = float(ttl_seconds)
+        self.require_approval = bool(require_approval)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._stats = {"hits": 0, "misses": 0, "stores": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS question_sql (
+                    key TEXT PRIMARY KEY,
+                    question_norm TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    rules_version TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    approved INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(question: str, history_text: str, version: str, today: date = None) -> str:
+        hist_digest = hashlib.sha1((history_text or "").strip().encode("utf-8")).hexdigest()
+        raw = f"{normalize_question(question)}|{hist_digest}|{version}"
+        scope = relative_time_scope(question, today)
+        if scope:
+            raw += f"|{scope}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def lookup(self, question: str, history_text: str, version: str, record: bool = True, today: date = None):
+        """
+        Retorna (sql, key) em caso de hit; (None, key) caso contrário.
+        record=False apenas consulta (não conta hit/miss nem atualiza a entrada).
+        """
+        key = self.key(question, history_text, version, today)
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._db()
+                row = db.execute(
+                    "SELECT sql, created_at, approved FROM question_sql WHERE key = ?", (key,)
+                ).fetchone()
+                if not record:
+                    ok = row and now - row[1] <= self.ttl_seconds and (row[2] or not self.require_approval)
+                    return (row[0] if ok else None), key
+                if row and now - row[1] <= self.ttl_seconds and (row[2] or not self.require_approval):
+                    db.execute(
+                        "UPDATE question_sql SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, key)
+                    )
+                    db.commit()
+                    self._stats["hits"] += 1
+                    return row[0], key
+                if row and now - row[1] > self.ttl_seconds:
+                    db.execute("DELETE FROM question_sql WHERE key = ?", (key,))
+                    db.commit()
+                self._stats["misses"] += 1
+        except sqlite3.Error:
+            pass
+        return None, key
+
+    def store(self, question: str, history_text: str, version: str, sql: str, today: date = None) -> str:
+        key = self.key(question, history_text, version, today)
+        if not (sql or "").strip():
+            return key
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute(
+                    """
+                    INSERT INTO question_sql (key, question_norm, sql, rules_version, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET sql = excluded.sql, created_at = excluded.created_at
+                    """,
+                    (key, normalize_question(question), sql, version, time.time()),
+                )
+                db.commit()
+                self._stats["stores"] += 1
+        except sqlite3.Error:
+            pass
+        return key
+
+    def mark_feedback(self, key: str, positive: bool):
+        if not key:
+            return
+        try:
+            with self._lock:
+                db = self._db()
+                if positive:
+                    db.execute("UPDATE question_sql SET approved = 1 WHERE key = ?", (key,))
+                else:
+                    db.execute("DELETE FROM question_sql WHERE key = ?", (key,))
+                db.commit()
+        except sqlite3.Error:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+_question_cache = None
+
+def get_question_cache() -> QuestionSQLCache:
+    global _question_cache
+    if _question_cache is None:
+        _question_cache = QuestionSQLCache(
+            QUESTION_CACHE_PATH, QUESTION_CACHE_TTL_SECONDS, QUESTION_CACHE_REQUIRE_APPROVAL
+        )
+    return _question_cache
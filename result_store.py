@@ -0,0 +1,167 @@
+# result_store.py — resultados das respostas fora do session_state (memória limitada + Parquet)
+#
+# As mensagens guardam só a chave. Os últimos resultados ficam em memória já compactados
+# (categorias para textos repetidos, float32 quando não muda o valor mostrado, inteiros
+# menores); os mais antigos vão para Parquet no diretório da sessão e voltam sob demanda.
+
+import os
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+_FLOAT_DECIMALS = 2  # precisão exibida na tabela; float32 só se preservar o valor nela
+
+
+def _frame_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def _float32_safe(s: pd.Series) -> bool:
+    values = s.to_numpy(dtype="float64", na_value=np.nan)
+    finite = values[np.isfinite(values)]
+    if not finite.size:
+        return True
+    if np.abs(finite).max() >= np.finfo(np.float32).max:
+        return False
+    back = finite.astype(np.float32).astype(np.float64)
+    return bool(np.array_equal(np.round(back, _FLOAT_DECIMALS), np.round(finite, _FLOAT_DECIMALS))
+                and np.allclose(back, finite, rtol=1e-6, atol=0))
+
+
+def compact_frame(df: pd.DataFrame, max_category_ratio: float = 0.5) -> pd.DataFrame:
+    """Cópia com tipos menores: textos repetidos -> category, float64 -> float32, int64 -> menor inteiro."""
+    out = df.copy()
+    n = len(out)
+    for col in out.columns:
+        s = out[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if s.dtype == object or pd.api.types.is_string_dtype(s.dtype):
+            if n > 1 and pd.api.types.infer_dtype(s, skipna=True) == "string" \
+                    and s.nunique(dropna=True) <= n * max_category_ratio:
+                out[col] = s.astype("category")
+        elif s.dtype == np.float64:
+            if _float32_safe(s):
+                out[col] = s.astype(np.float32)
+        elif s.dtype == np.int64:
+            out[col] = pd.to_numeric(s, downcast="integer")
+    out.attrs = dict(df.attrs)
+    return out
+
+
+class ResultStore:
+    """
+    Resultados de uma sessão do Streamlit. Mantém em memória os 'max_items' mais recentes
+    (e no máximo 'max_bytes'); o restante vai para Parquet em 'spill_dir'. Sem Parquet
+    disponível, o resultado despejado fica só com as primeiras 'fallback_rows' linhas.
+    """
+
+    def __init__(self, spill_dir: str, *, max_items: int = 3, max_bytes: int = 64 * 1024 * 1024,
+                 fallback_rows: int = 200):
+        self.spill_dir = spill_dir
+        self.max_items = max(0, int(max_items))
+        self.max_bytes = int(max_bytes or 0)  # 0 = sem limite de bytes
+        self.fallback_rows = int(fallback_rows)
+        self._mem = OrderedDict()  # chave -> (df, bytes)
+        self._spilled = set()
+        self._trimmed = {}  # chave -> primeiras linhas (quando o Parquet falhou)
+        self._lock = threading.Lock()
+        self._stats = {"stored": 0, "spilled": 0, "loaded": 0, "trimmed": 0}
+
+    def put(self, df: pd.DataFrame) -> str:
+        key = uuid.uuid4().hex
+        df = compact_frame(df)
+        with self._lock:
+            self._mem[key] = (df, _frame_bytes(df))
+            self._stats["stored"] += 1
+            self._evict()
+        return key
+
+    def get(self, key: str):
+        """DataFrame da chave (da memória ou do Parquet) ou None se não existe mais."""
+        with self._lock:
+            entry = self._mem.get(key)
+            spilled = key in self._spilled
+            head = self._trimmed.get(key)
+        if entry is not None:
+            return entry[0]
+        if head is not None:
+            return head
+        if not spilled:
+            return None
+        try:
+            df = pd.read_parquet(self._path(key))
+        except Exception:
+            return None
+        with self._lock:
+            self._stats["loaded"] += 1
+        return df
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._mem or key in self._spilled or key in self._trimmed
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(b for _, b in self._mem.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats)
+            out["mem_items"] = len(self._mem)
+            out["mem_bytes"] = sum(b for _, b in self._mem.values())
+            out["disk_items"] = len(self._spilled)
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            self._spilled.clear()
+            self._trimmed.clear()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    # ---------- internos ----------
+    def _path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, key + ".parquet")
+
+    def _evict(self):
+        total = sum(b for _, b in self._mem.values())
+        while self._mem and (len(self._mem) > self.max_items or (self.max_bytes and total > self.max_bytes)):
+            key, (df, size) = self._mem.popitem(last=False)
+            total -= size
+            if self._spill(key, df):
+                continue
+            # sem Parquet (ou disco somente leitura): guarda só o começo do resultado
+            head = df.head(self.fallback_rows).copy()
+            head.attrs = dict(df.attrs, truncated=True)
+            self._trimmed[key] = head
+            self._stats["trimmed"] += 1
+
+    def _spill(self, key: str, df: pd.DataFrame) -> bool:
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            df.to_parquet(self._path(key), index=False)
+        except Exception:
+            return False
+        self._spilled.add(key)
+        self._stats["spilled"] += 1
+        return True
+
+
+def prune_spill_dirs(root: str, max_age_seconds: float):
+    """Remove diretórios de sessões antigas (sem escrita há mais de max_age_seconds)."""
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - float(max_age_seconds)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
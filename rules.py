@@ -1,4 +1,5 @@
 from textwrap import dedent
+from datetime import date
 from functools import lru_cache
 
 
@@ -65,7 +66,7 @@ SCHEMA_INFO = {
     },
 
     "DASH_ATUAL": {
-        "descricao": "Base atual (DASH_ATUAL) — usada para consultas do mês corrente (ex.: outubro/2025)",
+        "descricao": "Base atual (DASH_ATUAL) — usada para consultas do mês corrente em diante",
         "colunas": {
             "RecordID": "Identificador interno (float)",
             "Unit": "Unidade / filial (nvarchar)",
@@ -190,7 +191,26 @@ SCHEMA_INFO = {
 }
 
 
-METRIC_RULES = dedent(f"""
+MESES_PT = [
+    "janeiro", "fevereiro", "março", "abril", "maio", "junho",
+    "julho", "agosto", "setembro", "outubro", "novembro", "dezembro",
+]
+
+
+def mes_corrente(today: date = None) -> str:
+    """Mês corrente por extenso ('outubro/2025'), calculado na hora."""
+    today = today or date.today()
+    return f"{MESES_PT[today.month - 1]}/{today.year}"
+
+
+def metric_rules(today: date = None) -> str:
+    """Regras de métricas com o mês corrente do dia (DASH_ATUAL x DASH_HISTORICO)."""
+    return _metric_rules(mes_corrente(today))
+
+
+@lru_cache(maxsize=4)
+def _metric_rules(mes_atual: str) -> str:
+    return dedent(f"""
 🚨 REGRA ABSOLUTA - TABELA BLOQUEADA:
 - A tabela XXXXX FOI REMOVIDA DO SISTEMA E NÃO EXISTE MAIS
 - QUALQUER tentativa de usar xxxxxx resultará em ERRO
@@ -208,7 +228,7 @@ METRIC_RULES = dedent(f"""
 
 TABELAS DISPONÍVEIS NO SISTEMA:
 1. VW_DEVOLUCAO_LAB - Para volume/área por planta/cidade
-2. DASH_ATUAL - Para carteira do mês corrente (outubro/2025)
+2. DASH_ATUAL - Para carteira do mês corrente ({mes_atual}) em diante
 3. DASH_HISTORICO - Para carteira de períodos históricos
 4. BI_OTIF - Para análises de pontualidade e completude de entregas
 
@@ -231,7 +251,7 @@ Regras específicas para bases DASH (DASH_ATUAL / DASH_HISTORICO):
 - **Por padrão, ao consultar DASH_ATUAL / DASH_HISTORICO NÃO removeremos automaticamente registros cancelados.**
   Ou seja: não aplicaremos filtros que excluam Status_Ordem = 'CANCELADO' / 'CANCELLED' / 'SUSPENDED' a menos que o usuário peça explicitamente.
 - Origem dos dados:
-  - Para perguntas relacionadas ao mês corrente (outubro/2025): **usar DASH_ATUAL**.
+  - Para perguntas relacionadas ao mês corrente ({mes_atual}) ou futuro: **usar DASH_ATUAL**.
   - Para perguntas sobre períodos históricos: **usar DASH_HISTORICO**.
 - Definição de carteira (DASH):
   - Carteira mensal = soma da coluna **M2_Bruto** para registros com **Data_Entrega** dentro do mês alvo.
@@ -320,7 +340,7 @@ EXEMPLOS_SEMENTE = [
      """)},
 
     # DASH-CAR-B) Carteira histórica / outros meses (usar DASH_HISTORICO) — exemplo genérico
-    {"pergunta":"Carteira (períodos fora de outubro/2025) — usar DASH_HISTORICO (intervalo semi-aberto)",
+    {"pergunta":"Carteira histórica (meses anteriores ao corrente) — usar DASH_HISTORICO (intervalo semi-aberto)",
      "sql":dedent("""
         -- Carteira histórica (exemplo genérico)
         -- Defina DATA_INICIO / DATA_FIM conforme a pergunta (DATA_FIM = primeiro dia do mês seguinte)
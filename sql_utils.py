@@ -3,13 +3,65 @@
 
 import re
 import unicodedata
-from config import DEFAULT_YEAR_IF_MISSING
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from config import DEFAULT_YEAR_IF_MISSING, SQL_SARGABLE_DATES, SQL_AUTO_PARAM_MAX
 from functools import lru_cache
+from rules import SCHEMA_INFO
 
-_BLOCKED_TOKENS = [
-    r"\bdrop\b", r"\balter\b", r"\btruncate\b", r"\bcreate\b", r"\bgrant\b", r"\brevoke\b",
-    r"\bxp_", r"\bsp_", r"\bexec\b", r"\binsert\b", r"\bupdate\b", r"\bdelete\b", r"\bmerge\b"
-]
+# Comandos bloqueados (apenas SELECT/CTE são aceitos) e prefixos de procedures de sistema
+_BLOCKED_KEYWORDS = frozenset({
+    "DROP", "ALTER", "TRUNCATE", "CREATE", "GRANT", "REVOKE", "EXEC", "EXECUTE",
+    "INSERT", "UPDATE", "DELETE", "MERGE",
+})
+_BLOCKED_PREFIXES = ("XP_", "SP_")
+
+# === Lexer T-SQL (uma passada) ===
+# Tipos: ws, comment, string, ident, qident ([x] ou "x"), number, var (@x), op
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>N?'(?:[^']|'')*'?)
+  | (?P<qident>\[(?:[^\]]|\]\])*\]?|"(?:[^"]|"")*"?)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<var>@@?[\w$#@]+)
+  | (?P<ident>[^\W\d][\w$#@]*|\#+[\w$#@]+)
+  | (?P<op><>|!=|>=|<=|!<|!>|\|\||.)
+""", re.VERBOSE | re.DOTALL)
+
+
+class LexedSQL:
+    """
+    Resultado do lexer: tipos e textos dos tokens (listas paralelas) e os conjuntos
+    derivados que as validações consultam (palavras e nomes de identificadores em maiúsculas).
+    """
+
+    __slots__ = ("kinds", "texts", "words", "names", "first_word")
+
+    def __init__(self, sql: str):
+        pairs = [(m.lastgroup, m.group()) for m in _TOKEN_RE.finditer(sql)]
+        self.kinds = [k for k, _ in pairs]
+        self.texts = [t for _, t in pairs]
+        words = {t for k, t in pairs if k == "ident"}
+        self.words = frozenset(w.upper() for w in words)
+        self.names = self.words | {t[1:-1].upper() for k, t in pairs if k == "qident"}
+        self.first_word = next(
+            (t.upper() if k == "ident" else "" for k, t in pairs if k not in ("ws", "comment")), ""
+        )
+
+    def text(self, drop=("comment",)) -> str:
+        return "".join(t for k, t in zip(self.kinds, self.texts) if k not in drop)
+
+
+@lru_cache(maxsize=256)
+def tokenize(sql: str) -> LexedSQL:
+    """Lexa a SQL numa única passada (cacheado: validações e reescritas reusam o mesmo resultado)."""
+    return LexedSQL(sql or "")
+
+
+def strip_comments(sql: str) -> str:
+    """Remove comentários -- e /* */ sem tocar em literais de string."""
+    return tokenize(sql).text()
 
 
 def normalize_sql_token(s: str) -> str:
@@ -17,50 +69,945 @@ def normalize_sql_token(s: str) -> str:
         return ""
     d = unicodedata.normalize("NFKD", s)
     return "".join(ch for ch in d if not unicodedata.combining(ch)).lower()
-def _strip_inline_comments(sql: str) -> str:
-    if not sql: return sql
-    # remove -- comentários de linha (sem quebrar string literals)
-    return re.sub(r"--.*?$", "", sql, flags=re.MULTILINE)
 
-def sql_sanity_rewrite(sql: str) -> str:
+
+def normalize_sql_key(sql: str) -> str:
+    """
+    Forma canônica da SQL para chaves de cache: remove comentários (-- e /* */),
+    colapsa espaços e baixa a caixa FORA de literais de string ('MARANGUAPE' é preservado).
+    """
     if not sql:
+        return ""
+    lx = tokenize(sql)
+    out = []
+    sep = False
+    for kind, text in zip(lx.kinds, lx.texts):
+        if kind == "ws" or kind == "comment":
+            sep = True
+            continue
+        if sep and out:
+            out.append(" ")
+        sep = False
+        out.append(text if kind == "string" else text.lower())
+    return "".join(out).rstrip(";").rstrip()
+
+
+def referenced_tables(sql_text: str, table_names) -> list[str]:
+    """Retorna (na ordem recebida) as tabelas de 'table_names' citadas como identificador na SQL."""
+    names = tokenize(sql_text or "").names
+    return [t for t in table_names or [] if t.upper() in names]
+
+# Colunas de data em que "só mês" ganha o ano padrão
+_MONTH_ONLY_COLUMNS = frozenset({"EMISSAO", "DT_ENTREGA1", "DT_ENTREGA", "DATA", "DATA_EMISSAO", "DATA_ENTREGA"})
+
+
+def _match_call(kinds, texts, i, fname):
+    """
+    Tokens significativos a partir de i formam 'FNAME ( expr )'? Retorna (a, b, após) com
+    a..b = tokens da expressão, ou None. A expressão vai até o primeiro ')' (mesmo critério
+    da antiga regex [^)]+?).
+    """
+    n = len(texts)
+    if i + 2 >= n or kinds[i] != "ident" or texts[i].upper() != fname or texts[i + 1] != "(":
+        return None
+    j = i + 2
+    while j < n and texts[j] != ")":
+        j += 1
+    if j >= n or j == i + 2:
+        return None
+    return i + 2, j - 1, j + 1
+
+
+def _match_eq_month(kinds, texts, i):
+    """'= n' com n de 1 ou 2 dígitos a partir de i? Retorna (n, índice após n) ou None."""
+    if i + 1 < len(texts) and texts[i] == "=" and kinds[i + 1] == "number" and texts[i + 1].isdigit() \
+            and len(texts[i + 1]) <= 2:
+        return int(texts[i + 1]), i + 2
+    return None
+
+
+def _significant(lx: LexedSQL):
+    """Tokens sem espaços/comentários; ws[i] guarda o espaço original que vem depois do token i."""
+    kinds, texts, ws = [], [], []
+    for kind, text in zip(lx.kinds, lx.texts):
+        if kind == "comment":
+            continue
+        if kind == "ws":
+            if ws:
+                ws[-1] += text
+            continue
+        kinds.append(kind)
+        texts.append(text)
+        ws.append("")
+    return kinds, texts, ws
+
+
+def _render(texts, ws, replace, append=None) -> str:
+    """Remonta a SQL aplicando replace {início: (após, texto)} e append {índice: texto}."""
+    append = append or {}
+    out, k = [], 0
+    while k < len(texts):
+        if k in replace:
+            end, text = replace[k]
+            out.append(text + ws[end - 1])
+            k = end
+            continue
+        out.append(texts[k])
+        if k in append:
+            out.append(append[k])
+        out.append(ws[k])
+        k += 1
+    return "".join(out).strip()
+
+
+def sql_sanity_rewrite(sql: str, schema_info: dict = None) -> str:
+    """
+    Corrige padrões conhecidos do modelo (YEAR(x)=MONTH(x)=m, mês sem ano) e, com
+    SQL_SARGABLE_DATES ligado, troca predicados de data por intervalos na coluna nua.
+    """
+    if not sql:
+        return sql
+    sql = _year_month_rewrite(sql)
+    if SQL_SARGABLE_DATES:
+        sql = sargable_date_rewrite(sql, SCHEMA_INFO if schema_info is None else schema_info)
+    return sql
+
+
+def _year_month_rewrite(sql: str) -> str:
+    lx = tokenize(sql)
+    stripped = lx.text().strip()  # sem comentários, como antes
+    if "MONTH" not in lx.words:
+        return stripped
+    kinds, texts, ws = _significant(lx)
+    yyyy = DEFAULT_YEAR_IF_MISSING
+
+    def raw(a, b):
+        return "".join(texts[k] + (ws[k] if k < b else "") for k in range(a, b + 1))
+
+    replace = {}  # índice inicial -> (índice após, texto)
+    append = {}   # índice -> texto inserido depois dele
+    years, months = set(), []
+    cands = [k for k, t in enumerate(texts) if (len(t) == 4 or len(t) == 5) and t.upper() in ("YEAR", "MONTH")]
+    skip_until = 0
+    for i in cands:
+        if i < skip_until:
+            continue
+        # Corrige padrão YEAR(x)=MONTH(x)=m  ->  YEAR(x)=YYYY AND MONTH(x)=m
+        y = _match_call(kinds, texts, i, "YEAR")
+        if y:
+            col = raw(y[0], y[1])
+            years.add(col.upper())
+            eq = y[2] < len(texts) and texts[y[2]] == "="
+            mo = _match_call(kinds, texts, y[2] + 1, "MONTH") if eq else None
+            mm = _match_eq_month(kinds, texts, mo[2]) if mo and raw(mo[0], mo[1]).upper() == col.upper() else None
+            if mm:
+                replace[i] = (mm[1], f"YEAR({col}) = {yyyy} AND MONTH({col}) = {mm[0]}")
+                skip_until = mm[1]
+            continue
+        m = _match_call(kinds, texts, i, "MONTH")
+        if m:
+            col = raw(m[0], m[1])
+            mm = _match_eq_month(kinds, texts, m[2])
+            if mm and col.upper() in _MONTH_ONLY_COLUMNS and 1 <= mm[0] <= 12:
+                months.append((col, mm[1] - 1))
+
+    # Injeta ano padrão quando só há mês em colunas frequentes (uma vez por coluna)
+    for col, last in months:
+        if col.upper() not in years:
+            append[last] = f" AND YEAR({col}) = {yyyy}"
+            years.add(col.upper())
+
+    if not replace and not append:
+        return stripped
+    return _render(texts, ws, replace, append)
+
+
+# === Predicados de data "sargable" ===
+# YEAR(c) = y [AND MONTH(c) = m] e TRY_CONVERT(date, c) <op> 'aaaa-mm-dd' viram intervalos
+# semi-abertos sobre a coluna nua (permite Index Seek). Só para colunas datetime no SCHEMA_INFO.
+# Os limites saem como 'AAAAMMDD': é o único formato que o datetime lê igual sob qualquer
+# SET LANGUAGE/DATEFORMAT (em português 'AAAA-MM-DD' é lido como ano-dia-mês).
+_PREDICATE_BEFORE = frozenset({"WHERE", "AND", "OR", "ON", "HAVING", "WHEN", "("})
+_PREDICATE_AFTER = frozenset({
+    "AND", "OR", ")", ";", "THEN", "GROUP", "ORDER", "HAVING", "UNION", "EXCEPT", "INTERSECT", "OPTION",
+})
+_SEGMENT_BREAKS = frozenset({
+    "OR", "WHERE", "ON", "HAVING", "WHEN", "THEN", "ELSE", "END", "CASE", "SELECT", "FROM", "JOIN",
+    "GROUP", "ORDER", "UNION", "EXCEPT", "INTERSECT", ",", ";",
+})
+_DATE_LITERAL = re.compile(r"^N?'(\d{4})-?(\d{2})-?(\d{2})'$", re.IGNORECASE)
+
+
+def datetime_columns(schema_info: dict, tables) -> frozenset:
+    """
+    Colunas (maiúsculas) que são datetime em alguma das tabelas citadas e não aparecem com
+    outro tipo em nenhuma delas. O tipo vem da descrição no SCHEMA_INFO ('... (datetime)').
+    """
+    dt, other = set(), set()
+    for t in tables:
+        for col, desc in ((schema_info.get(t) or {}).get("colunas") or {}).items():
+            (dt if "(datetime)" in str(desc).lower() else other).add(col.upper())
+    return frozenset(dt - other)
+
+
+def _column_ref(kinds, texts, a, b):
+    """a..b é uma coluna nua (x, [x], t.x, dbo.t.[x])? Retorna o nome em maiúsculas ou None."""
+    if (b - a) % 2:
+        return None
+    for k in range(a, b + 1):
+        if (k - a) % 2 == 0 and kinds[k] not in ("ident", "qident"):
+            return None
+        if (k - a) % 2 == 1 and texts[k] != ".":
+            return None
+    name = texts[b]
+    return (name[1:-1] if kinds[b] == "qident" else name).upper()
+
+
+def _date_call(kinds, texts, i):
+    """TRY_CONVERT/CONVERT(date, col) ou CAST(col AS date) em i? Retorna (a, b, após) da coluna."""
+    n = len(texts)
+    fn = texts[i].upper()
+    if fn in ("TRY_CONVERT", "CONVERT") and i + 5 < n and texts[i + 1] == "(" \
+            and texts[i + 2].upper() == "DATE" and texts[i + 3] == ",":
+        j = i + 4
+        while j < n and texts[j] not in (")", ","):
+            j += 1
+        if j < n and texts[j] == ")" and j > i + 4:
+            return i + 4, j - 1, j + 1
+    if fn == "CAST" and i + 4 < n and texts[i + 1] == "(":
+        j = i + 2
+        while j < n and texts[j] != ")" and texts[j].upper() != "AS":
+            j += 1
+        if j + 2 < n and texts[j].upper() == "AS" and texts[j + 1].upper() == "DATE" \
+                and texts[j + 2] == ")" and j > i + 2:
+            return i + 2, j - 1, j + 3
+    return None
+
+
+def _lit(d: date) -> str:
+    return f"'{d:%Y%m%d}'"
+
+
+def _next_month(y: int, m: int) -> date:
+    return date(y + m // 12, m % 12 + 1, 1)
+
+
+def sargable_date_rewrite(sql: str, schema_info: dict) -> str:
+    """
+    Reescreve predicados que embrulham colunas datetime em funções:
+      YEAR(c) = 2025 AND MONTH(c) = 8       -> c >= '20250801' AND c < '20250901'
+      YEAR(c) = 2025                        -> c >= '20250101' AND c < '20260101'
+      TRY_CONVERT(date, c) >= '2025-10-01'  -> c >= '20251001'  (idem <, >, <=, =)
+    Só reescreve predicados inteiros (entre WHERE/AND/OR/ON/'(' e AND/OR/')'/fim, sem NOT),
+    e junta ano e mês apenas quando estão na mesma cadeia de ANDs.
+    """
+    lx = tokenize(sql)
+    if not lx.words & {"YEAR", "TRY_CONVERT", "CONVERT", "CAST"}:
+        return sql
+    cols = datetime_columns(schema_info, referenced_tables(sql, list(schema_info))) & lx.names
+    if not cols:
+        return sql
+    kinds, texts, ws = _significant(lx)
+    n = len(texts)
+    uppers = [t.upper() for t in texts]
+
+    # segmento = cadeia de ANDs no mesmo nível de parênteses
+    segment, stack, next_id = [0] * n, [0], 1
+    for k, u in enumerate(uppers):
+        if u == "(":
+            stack.append(next_id)
+            next_id += 1
+        elif u == ")" and len(stack) > 1:
+            stack.pop()
+        elif u in _SEGMENT_BREAKS:
+            stack[-1] = next_id
+            next_id += 1
+        segment[k] = stack[-1]
+
+    def standalone(start, end):
+        before = uppers[start - 1] if start else "WHERE"
+        after = uppers[end] if end < n else ";"
+        return before in _PREDICATE_BEFORE and after in _PREDICATE_AFTER
+
+    def number(k, lo, hi):
+        if k < n and kinds[k] == "number" and texts[k].isdigit() and lo <= int(texts[k]) <= hi:
+            return int(texts[k])
+        return None
+
+    replace = {}
+    years, months = {}, {}  # (segmento, coluna) -> [(início, após, valor)]
+    for i, u in enumerate(uppers):
+        if u in ("YEAR", "MONTH"):
+            call = _match_call(kinds, texts, i, u)
+            if not call or call[2] >= n or texts[call[2]] != "=":
+                continue
+            name = _column_ref(kinds, texts, call[0], call[1])
+            value = number(call[2] + 1, 1900, 9999) if u == "YEAR" else number(call[2] + 1, 1, 12)
+            if name in cols and value is not None and standalone(i, call[2] + 2):
+                col = "".join(texts[call[0]:call[1] + 1])
+                (years if u == "YEAR" else months).setdefault((segment[i], col.upper()), []).append(
+                    (i, call[2] + 2, value, col)
+                )
+        elif u in ("TRY_CONVERT", "CONVERT", "CAST"):
+            call = _date_call(kinds, texts, i)
+            if not call or call[2] + 1 >= n:
+                continue
+            op, lit = texts[call[2]], _DATE_LITERAL.match(texts[call[2] + 1])
+            if op not in ("=", ">=", ">", "<", "<=") or not lit or \
+                    _column_ref(kinds, texts, call[0], call[1]) not in cols or not standalone(i, call[2] + 2):
+                continue
+            try:
+                d = date(*map(int, lit.groups()))
+            except ValueError:
+                continue
+            col = "".join(texts[call[0]:call[1] + 1])
+            after = d + timedelta(days=1)
+            pred = {
+                ">=": f"{col} >= {_lit(d)}",
+                ">": f"{col} >= {_lit(after)}",
+                "<": f"{col} < {_lit(d)}",
+                "<=": f"{col} < {_lit(after)}",
+                "=": f"{col} >= {_lit(d)} AND {col} < {_lit(after)}",
+            }[op]
+            replace[i] = (call[2] + 2, pred)
+
+    for key, ys in years.items():
+        ms = months.get(key, [])
+        if len(ys) == 1 and len(ms) == 1:
+            (y_at, y_end, y, col), (m_at, m_end, m, _) = ys[0], ms[0]
+            replace[y_at] = (y_end, f"{col} >= {_lit(date(y, m, 1))}")
+            replace[m_at] = (m_end, f"{col} < {_lit(_next_month(y, m))}")
+            continue
+        for y_at, y_end, y, col in ys:
+            replace[y_at] = (y_end, f"{col} >= {_lit(date(y, 1, 1))} AND {col} < {_lit(date(y + 1, 1, 1))}")
+
+    if not replace:
+        return sql
+    return _render(texts, ws, replace)
+
+def apply_top_cap(sql: str, n: int) -> str:
+    """
+    Injeta TOP (n) no SELECT externo quando não há TOP. Só reescreve SELECT simples
+    (sem CTE e sem UNION/EXCEPT/INTERSECT, onde o TOP mudaria o sentido); caso contrário
+    devolve a SQL como veio.
+    """
+    lx = tokenize(strip_comments(sql or "").strip())
+    if n <= 0 or lx.first_word != "SELECT" or lx.words & {"UNION", "EXCEPT", "INTERSECT"}:
+        return sql
+    sig = [k for k, kind in enumerate(lx.kinds) if kind != "ws"]
+    head = 1
+    if head < len(sig) and lx.texts[sig[head]].upper() in ("DISTINCT", "ALL"):
+        head += 1
+    if head < len(sig) and lx.texts[sig[head]].upper() == "TOP":
+        return sql
+    cut = sig[head] if head < len(sig) else len(lx.texts)
+    return "".join(lx.texts[:cut]) + f"TOP ({int(n)}) " + "".join(lx.texts[cut:])
+
+# === Roteamento DASH_ATUAL / DASH_HISTORICO ===
+# DASH_ATUAL guarda o mês corrente em diante; DASH_HISTORICO, os meses anteriores. O intervalo
+# de Data_Entrega da consulta decide a tabela (ou as duas, via UNION ALL) — calculado na hora.
+DASH_ATUAL, DASH_HISTORICO = "DASH_ATUAL", "DASH_HISTORICO"
+DASH_DATE_COLUMN = "Data_Entrega"
+_ROUTE_DATE = re.compile(r"^N?'(\d{4})-?(\d{2})-?(\d{2})(?:[ T](\d{2}):?(\d{2})?[\d:.]*)?'$", re.IGNORECASE)
+_CLAUSE_END = frozenset({"GROUP", "ORDER", "HAVING", "UNION", "EXCEPT", "INTERSECT", "OPTION", ";"})
+_NOT_ALIAS = frozenset({
+    "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER", "ON", "GROUP", "ORDER",
+    "HAVING", "UNION", "EXCEPT", "INTERSECT", "OPTION", "WITH",
+})
+
+
+def current_month_start(today: date = None) -> date:
+    today = today or date.today()
+    return date(today.year, today.month, 1)
+
+
+def dash_table_for(lo: date = None, hi: date = None, today: date = None):
+    """
+    Tabela DASH para Data_Entrega em [lo, hi) (limites opcionais): DASH_HISTORICO se termina
+    antes do mês corrente, DASH_ATUAL se começa nele ou depois, None se atravessa os dois.
+    """
+    cm = current_month_start(today)
+    if hi is not None and hi <= cm:
+        return DASH_HISTORICO
+    if lo is not None and lo >= cm:
+        return DASH_ATUAL
+    return None
+
+
+def _route_date(text: str):
+    """Literal de data -> (data, tem_hora) ou None."""
+    m = _ROUTE_DATE.match(text)
+    if not m:
+        return None
+    try:
+        d = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    except ValueError:
+        return None
+    return d, bool(m.group(4)) and (m.group(4), m.group(5) or "00") != ("00", "00")
+
+
+def _date_range(kinds, texts, start: int, end: int, depth: list):
+    """
+    Limites [lo, hi) de Data_Entrega nos predicados da cláusula texts[start:end] no nível
+    depth[start]. Conservador: None se houver OR no nível, NOT em qualquer ponto ou alguma
+    referência a Data_Entrega que não seja 'coluna op literal' / 'coluna BETWEEN a AND b'
+    no nível (função, parênteses, IN, <>, literal à esquerda...).
+    """
+    d0, lo, hi = depth[start], None, None
+    col = DASH_DATE_COLUMN.upper()
+
+    def name(k):
+        return (texts[k][1:-1] if kinds[k] == "qident" else texts[k]).upper()
+
+    for o in range(start, end):
+        up = texts[o].upper()
+        if up == "NOT" or (up == "OR" and depth[o] == d0):
+            return None
+        if kinds[o] not in ("ident", "qident") or name(o) != col or (o + 1 < end and texts[o + 1] == "."):
+            continue
+        op = texts[o + 1].upper() if o + 1 < end else ""
+        p = o - 2 if o - 2 >= start and texts[o - 1] == "." else o
+        if depth[o] != d0 or (p > start and kinds[p - 1] == "op"):
+            return None  # dentro de função/parênteses ou do lado direito de um operador
+        if op == "BETWEEN":
+            a = _route_date(texts[o + 2]) if o + 2 < end else None
+            b = _route_date(texts[o + 4]) if o + 4 < end and texts[o + 3].upper() == "AND" else None
+            if not (a and b):
+                return None
+            lo = a[0] if lo is None else max(lo, a[0])
+            top = b[0] + timedelta(days=1)
+            hi = top if hi is None else min(hi, top)
+            continue
+        lit = _route_date(texts[o + 2]) if o + 2 < end else None
+        if op not in ("=", ">=", ">", "<", "<=") or not lit:
+            return None
+        d, has_time = lit
+        if op in ("=", ">=", ">"):
+            lo = d if lo is None else max(lo, d)
+        if op in ("=", "<=") or (op == "<" and has_time):
+            top = d + timedelta(days=1)
+            hi = top if hi is None else min(hi, top)
+        elif op == "<":
+            hi = d if hi is None else min(hi, d)
+    return lo, hi
+
+
+def route_dash_tables(sql: str, today: date = None, schema_info: dict = None) -> str:
+    """
+    Pós-geração: lê o intervalo de Data_Entrega do WHERE da consulta que usa DASH_ATUAL ou
+    DASH_HISTORICO e troca a tabela conforme o mês corrente. Se o intervalo atravessa o
+    início do mês corrente, a tabela vira uma derivada UNION ALL das duas, cortada nessa data,
+    com as colunas comuns listadas (schema_info, padrão SCHEMA_INFO) na mesma ordem.
+    Só age com exatamente uma referência DASH em FROM/JOIN e intervalo conhecido (_date_range).
+    """
+    lx = tokenize(sql or "")
+    if not lx.names & {DASH_ATUAL, DASH_HISTORICO}:
+        return sql
+    kinds, texts, ws = _significant(lx)
+    n = len(texts)
+    uppers = [(t[1:-1] if k == "qident" else t).upper() for k, t in zip(kinds, texts)]
+    depth, d = [0] * n, 0
+    for k, u in enumerate(uppers):
+        if texts[k] == ")" and kinds[k] == "op":
+            d -= 1
+        depth[k] = d
+        if texts[k] == "(" and kinds[k] == "op":
+            d += 1
+
+    # referência em FROM/JOIN: [schema .] tabela
+    refs = []
+    for k, u in enumerate(uppers):
+        if u in (DASH_ATUAL, DASH_HISTORICO) and kinds[k] in ("ident", "qident"):
+            start = k - 2 if k >= 2 and texts[k - 1] == "." else k
+            if start and uppers[start - 1] in ("FROM", "JOIN"):
+                refs.append((start, k))
+    if len(refs) != 1:
+        return sql
+    start, t = refs[0]
+
+    # WHERE do mesmo nível da tabela
+    where, end = None, n
+    for k in range(t + 1, n):
+        if depth[k] < depth[t]:
+            end = k
+            break
+        if depth[k] != depth[t]:
+            continue
+        if where is None and uppers[k] == "WHERE":
+            where = k
+        elif where is not None and uppers[k] in _CLAUSE_END:
+            end = k
+            break
+    if where is None:
+        return sql
+    bounds = _date_range(kinds, texts, where + 1, end, depth)
+    if bounds is None or bounds == (None, None):
         return sql
-    s = _strip_inline_comments(sql).strip()
-
-    # Corrige padrão YEAR(x)=MONTH(x)=m  ->  YEAR(x)=YYYY AND MONTH(x)=m
-    pat = re.compile(r"YEAR\(\s*(?P<c>[^)]+?)\s*\)\s*=\s*MONTH\(\s*(?P=c)\s*\)\s*=\s*(?P<m>\d{1,2})", re.IGNORECASE)
-    if pat.search(s):
-        yyyy = DEFAULT_YEAR_IF_MISSING
-        s = pat.sub(lambda m: f"YEAR({m.group('c')}) = {yyyy} AND MONTH({m.group('c')}) = {int(m.group('m'))}", s)
-
-    # Injeta ano padrão quando só há mês em colunas frequentes
-    for col in ["EMISSAO","DT_ENTREGA1","DT_ENTREGA","DATA","DATA_EMISSAO","Data_Entrega"]:
-        if re.search(rf"YEAR\(\s*{col}\s*\)", s, flags=re.IGNORECASE):
-            continue
-        mm = re.search(rf"(MONTH\(\s*{col}\s*\)\s*=\s*(\d{{1,2}}))", s, flags=re.IGNORECASE)
-        if mm:
-            mnum = int(mm.group(2))
-            if 1 <= mnum <= 12:
-                yyyy = DEFAULT_YEAR_IF_MISSING
-                s = s.replace(mm.group(1), f"{mm.group(1)} AND YEAR({col}) = {yyyy}")
-    return s
+    target = dash_table_for(*bounds, today=today)
+    old = uppers[t]
+
+    if target is not None:
+        if target == old:
+            return sql
+        # renomeia a tabela e qualificadores 'DASH_X.coluna'
+        replace = {}
+        for k, u in enumerate(uppers):
+            if u == old and kinds[k] in ("ident", "qident") and (k == t or (k + 1 < n and texts[k + 1] == ".")):
+                replace[k] = (k + 1, f"[{target}]" if kinds[k] == "qident" else target)
+        return _render(texts, ws, replace)
+
+    # atravessa o mês corrente: derivada UNION ALL (hint da tabela vai para dentro)
+    after = t + 1
+    hint = ""
+    if after + 1 < n and uppers[after] == "WITH" and texts[after + 1] == "(":
+        close = after + 1
+        while close < n and not (texts[close] == ")" and depth[close] == depth[after]):
+            close += 1
+        hint = " " + "".join(texts[k] + (ws[k] if k < close else "") for k in range(after, close + 1))
+        after = close + 1
+    alias = texts[t] if kinds[t] == "ident" else f"[{old}]"
+    if after < n and uppers[after] == "AS" and after + 1 < n:
+        alias, after = texts[after + 1], after + 2
+    elif after < n and kinds[after] in ("ident", "qident") and uppers[after] not in _NOT_ALIAS:
+        alias, after = texts[after], after + 1
+    schema_info = SCHEMA_INFO if schema_info is None else schema_info
+    hist_cols = set((schema_info.get(DASH_HISTORICO) or {}).get("colunas", {}))
+    cols = [c for c in (schema_info.get(DASH_ATUAL) or {}).get("colunas", {}) if c in hist_cols]
+    if DASH_DATE_COLUMN not in cols:
+        return sql  # sem as colunas das duas tabelas não dá para montar o UNION com segurança
+    select = "SELECT " + ", ".join(_quote_column(c) for c in cols)
+    schema = "".join(texts[start:t])
+    cut = _lit(current_month_start(today))
+    derived = (
+        f"({select} FROM {schema}{DASH_HISTORICO}{hint} WHERE {DASH_DATE_COLUMN} < {cut} "
+        f"UNION ALL {select} FROM {schema}{DASH_ATUAL}{hint} WHERE {DASH_DATE_COLUMN} >= {cut}) AS {alias}"
+    )
+    return _render(texts, ws, {start: (after, derived)})
+
+
+# === Projeção: SELECT * final vira colunas explícitas ===
+# Só a projeção final trafega pelo ODBC (colunas não usadas em CTEs/derivadas o otimizador já
+# descarta). Um SELECT * final sobre tabela do SCHEMA_INFO — direto ou via CTE/derivada que só
+# repassa colunas — vira a lista de colunas citadas na pergunta/SQL, completada até o limite.
+_FROM_END = frozenset({"WHERE", "GROUP", "ORDER", "HAVING", "UNION", "EXCEPT", "INTERSECT", "OPTION", ";"})
+_ALL_COLUMNS_HINTS = ("todas as colunas", "todos os campos", "todas colunas", "todos campos", "select *")
+_PLAIN_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class _Tree:
+    """Tokens significativos com profundidade de parênteses e pares ( )."""
+
+    def __init__(self, lx: LexedSQL):
+        self.kinds, self.texts, self.ws = _significant(lx)
+        self.n = len(self.texts)
+        self.uppers = [(t[1:-1] if k == "qident" else t).upper() for k, t in zip(self.kinds, self.texts)]
+        self.depth, self.match, self.parent = [0] * self.n, {}, [-1] * self.n
+        stack = []
+        for k, (kind, text) in enumerate(zip(self.kinds, self.texts)):
+            if kind == "op" and text == ")" and stack:
+                self.match[stack.pop()] = k
+            self.depth[k] = len(stack)
+            self.parent[k] = stack[-1] if stack else -1
+            if kind == "op" and text == "(":
+                stack.append(k)
+
+    def is_name(self, k) -> bool:
+        return 0 <= k < self.n and self.kinds[k] in ("ident", "qident")
+
+    def select_parts(self, s: int):
+        """SELECT em s -> (distinct, início da lista, FROM, fim do FROM) ou None."""
+        u, d, i = self.uppers, self.depth[s], s + 1
+        distinct = i < self.n and u[i] == "DISTINCT"
+        if i < self.n and u[i] in ("DISTINCT", "ALL"):
+            i += 1
+        if i < self.n and u[i] == "TOP":
+            i += 1
+            i = self.match.get(i, i) + 1
+            if i < self.n and u[i] == "PERCENT":
+                i += 1
+            if i + 1 < self.n and u[i] == "WITH" and u[i + 1] == "TIES":
+                i += 2
+        f = i
+        while f < self.n and self.depth[f] >= d and not (self.depth[f] == d and u[f] == "FROM"):
+            f += 1
+        if f >= self.n or self.depth[f] != d:
+            return None
+        e = f + 1
+        while e < self.n and self.depth[e] >= d and not (self.depth[e] == d and u[e] in _FROM_END):
+            e += 1
+        return distinct, i, f, e
+
+    def items(self, a: int, b: int) -> list:
+        """Itens da lista de seleção texts[a:b] separados por vírgulas do mesmo nível."""
+        out, start = [], a
+        for k in range(a, b):
+            if self.texts[k] == "," and self.depth[k] == self.depth[a]:
+                out.append((start, k))
+                start = k + 1
+        out.append((start, b))
+        return out
+
+    def single_source(self, f: int, e: int):
+        """FROM com uma única fonte: ('table', nome) | ('group', '(' da derivada) | ('name', cte)."""
+        k, u = f + 1, self.uppers
+        if k < self.n and self.texts[k] == "(":
+            src, k = ("group", k), self.match.get(k, self.n) + 1
+        elif self.is_name(k):
+            if self.is_name(k + 2) and self.texts[k + 1] == ".":
+                k += 2
+            src, k = ("name", u[k]), k + 1
+            if k + 1 < e and u[k] == "WITH" and self.texts[k + 1] == "(":
+                k = self.match.get(k + 1, self.n) + 1
+        else:
+            return None
+        if k < e and u[k] == "AS":
+            k += 2
+        elif k < e and self.is_name(k) and u[k] not in _NOT_ALIAS:
+            k += 1
+        return src if k == e else None
+
+    def main_select(self, a: int, b: int, union: bool = False):
+        """
+        SELECT do nível de texts[a:b]. Com UNION/EXCEPT/INTERSECT no nível: o primeiro ramo
+        (que nomeia as colunas) se union=True, senão None.
+        """
+        d = self.depth[a]
+        sel = [k for k in range(a, b) if self.depth[k] == d and self.uppers[k] == "SELECT"]
+        if not sel:
+            return None
+        if any(self.depth[k] == d and self.uppers[k] in ("UNION", "EXCEPT", "INTERSECT") for k in range(a, b)):
+            return sel[0] if union else None
+        return sel[-1]
+
+    def ctes(self) -> dict:
+        """nome da CTE -> '(' do corpo (WITH nome AS ( ... ), ...)."""
+        out, u = {}, self.uppers
+        if not self.n or u[0] != "WITH":
+            return out
+        k = 1
+        while k + 2 < self.n and self.is_name(k) and u[k + 1] == "AS" and self.texts[k + 2] == "(":
+            out[u[k]] = k + 2
+            k = self.match.get(k + 2, self.n) + 1
+            if k < self.n and self.texts[k] == ",":
+                k += 1
+            else:
+                break
+        return out
+
+
+def _quote_column(col: str) -> str:
+    return col if _PLAIN_NAME.match(col) else "[" + col.replace("]", "]]") + "]"
+
+
+def _output_columns(tree: _Tree, s: int, schema_info: dict, ctes: dict, seen=()):
+    """Colunas de saída do SELECT em s (nomes como no schema), ou None se não dá para saber."""
+    parts = tree.select_parts(s)
+    if not parts:
+        return None
+    _, a, f, e = parts
+    items = tree.items(a, f)
+    if len(items) == 1 and tree.texts[items[0][1] - 1] == "*" and items[0][1] - items[0][0] in (1, 3):
+        src = tree.single_source(f, e)
+        if src is None:
+            return None
+        if src[0] == "group":
+            inner = tree.main_select(src[1] + 1, tree.match.get(src[1], tree.n), union=True)
+            return None if inner is None else _output_columns(tree, inner, schema_info, ctes, seen)
+        name = src[1]
+        if name in ctes and name not in seen:
+            o = ctes[name]
+            inner = tree.main_select(o + 1, tree.match.get(o, tree.n), union=True)
+            return None if inner is None else _output_columns(tree, inner, schema_info, ctes, seen + (name,))
+        table = {t.upper(): t for t in schema_info}.get(name)
+        return list((schema_info[table].get("colunas") or {}).keys()) if table else None
+    cols = []
+    for i, j in items:
+        if j - i >= 2 and tree.uppers[j - 2] == "AS" and tree.is_name(j - 1):
+            cols.append(tree.texts[j - 1].strip("[]"))
+        elif _column_ref(tree.kinds, tree.texts, i, j - 1):
+            cols.append(tree.texts[j - 1].strip("[]"))
+        else:
+            return None
+    return cols
+
+
+def _mentioned(col: str, desc: str, question: str, words: set) -> bool:
+    """Coluna citada na pergunta pelo nome (ou parte dele) ou por palavra da descrição."""
+    name = normalize_sql_token(col)
+    if name in question or any(len(part) >= 4 and part in question for part in re.split(r"[^a-z0-9]+", name)):
+        return True
+    return bool(words & set(re.findall(r"[a-z0-9]{5,}", normalize_sql_token(desc))))
+
+
+def project_star_columns(sql: str, schema_info: dict, question: str = "", max_columns: int = 12) -> dict:
+    """
+    Troca o SELECT * final por colunas explícitas: as citadas na pergunta e no restante da
+    SQL primeiro, depois as demais na ordem do schema até max_columns. Não mexe com
+    DISTINCT, UNION, fontes múltiplas/desconhecidas ou quando a pergunta pede todas as colunas.
+    Retorna {"sql", "columns_before", "columns_after"} (contagens 0 quando não reescreve).
+    """
+    out = {"sql": sql, "columns_before": 0, "columns_after": 0}
+    lx = tokenize(sql or "")
+    q = normalize_sql_token(question or "")
+    if "*" not in lx.texts or any(h in q for h in _ALL_COLUMNS_HINTS):
+        return out
+    tree = _Tree(lx)
+    s = tree.main_select(0, tree.n)
+    parts = tree.select_parts(s) if s is not None else None
+    if not parts or parts[0]:
+        return out
+    _, a, f, _ = parts
+    items = tree.items(a, f)
+    if len(items) != 1 or tree.texts[items[0][1] - 1] != "*":
+        return out
+    cols = _output_columns(tree, s, schema_info, tree.ctes())
+    if not cols or len(cols) <= max_columns:
+        return out
+    referenced = {tree.uppers[k] for k in range(tree.n) if tree.is_name(k) and not a <= k < f}
+    descs = {c.upper(): d for t in schema_info.values() for c, d in (t.get("colunas") or {}).items()}
+    words = set(re.findall(r"[a-z0-9]{5,}", q))
+    first = [c for c in cols if c.upper() in referenced or _mentioned(c, str(descs.get(c.upper(), "")), q, words)]
+    rest = [c for c in cols if c not in first]
+    chosen = set(first + rest[:max(0, max_columns - len(first))])
+    keep = [c for c in cols if c in chosen]  # ordem original do schema
+    star_at, star_end = items[0]
+    prefix = "".join(tree.texts[star_at:star_end - 1])  # 'alias.' de alias.*
+    listing = ", ".join(prefix + _quote_column(c) for c in keep)
+    out.update(
+        sql=_render(tree.texts, tree.ws, {star_at: (star_end, listing)}),
+        columns_before=len(cols), columns_after=len(keep),
+    )
+    return out
+
+
+# === Política de leitura por tabela ===
+# nolock: garante WITH (NOLOCK) em toda referência; snapshot: tira hints de leitura suja e pede
+# SNAPSHOT ao executor; default: tira hints de leitura suja (READ COMMITTED). Tabela fora do
+# mapa fica como o modelo escreveu.
+READ_POLICIES = ("nolock", "snapshot", "default")
+_DIRTY_HINTS = frozenset({"NOLOCK", "READUNCOMMITTED"})
+
+
+_FROM_LIST_STOP = frozenset({"SELECT", "WHERE", "GROUP", "ORDER", "HAVING", "SET", "VALUES", "ON"})
+
+
+def _in_from_list(tree: _Tree, start: int) -> bool:
+    """Tabela em start vem de FROM/JOIN, inclusive 'FROM a, b' (vírgula no mesmo nível do FROM)."""
+    if start <= 0:
+        return False
+    prev = tree.uppers[start - 1]
+    if prev in ("FROM", "JOIN"):
+        return True
+    if tree.texts[start - 1] != ",":
+        return False
+    d = tree.depth[start]
+    for j in range(start - 2, -1, -1):
+        if tree.depth[j] < d:
+            return False
+        if tree.depth[j] == d and tree.kinds[j] != "op":
+            if tree.uppers[j] == "FROM":
+                return True
+            if tree.uppers[j] in _FROM_LIST_STOP:
+                return False
+    return False
+
+
+def _table_hint(tree: _Tree, t: int):
+    """
+    Referência à tabela em t: (último token de tabela/alias, hint) com hint =
+    (início, fim exclusivo, [(a, b) de cada hint]) ou None. Pula '[AS] alias' antes do WITH.
+    """
+    k = t + 1
+    if k < tree.n and tree.uppers[k] == "AS" and tree.is_name(k + 1):
+        k += 2
+    elif tree.is_name(k) and tree.uppers[k] not in _NOT_ALIAS:
+        k += 1
+    last = k - 1
+    if k < tree.n and tree.uppers[k] == "WITH" and k + 1 < tree.n and tree.texts[k + 1] == "(":
+        o = k + 1
+    elif k < tree.n and tree.texts[k] == "(" and k + 1 < tree.n and tree.uppers[k + 1] in _DIRTY_HINTS:
+        o = k  # sintaxe antiga: FROM t (NOLOCK)
+    else:
+        return last, None
+    c = tree.match.get(o)
+    if c is None:
+        return last, None
+    return last, (k, c + 1, tree.items(o + 1, c) if c > o + 1 else [])
+
+
+def apply_read_policy(sql: str, policies: dict) -> tuple:
+    """
+    Aplica a política de leitura de cada tabela referenciada em FROM/JOIN (e listas com vírgula).
+    Retorna (sql, isolamento): 'SNAPSHOT' se alguma tabela pede snapshot, senão 'READ COMMITTED'.
+    """
+    lx = tokenize(sql or "")
+    policies = {k.upper(): v for k, v in (policies or {}).items()}
+    wanted = lx.names & set(policies)
+    if not wanted:
+        return sql, "READ COMMITTED"
+    tree = _Tree(lx)
+    u, texts = tree.uppers, tree.texts
+    replace, append, isolation = {}, {}, "READ COMMITTED"
+    for t in range(tree.n):
+        if u[t] not in wanted or not tree.is_name(t) or (t + 1 < tree.n and texts[t + 1] == "."):
+            continue
+        start = t - 2 if t >= 2 and texts[t - 1] == "." else t
+        if not _in_from_list(tree, start):
+            continue
+        policy = policies[u[t]]
+        last, hint = _table_hint(tree, t)
+        if policy == "nolock":
+            if hint is None:
+                append[last] = " WITH (NOLOCK)"
+            elif not any(u[a] in _DIRTY_HINTS for a, _ in hint[2]):
+                _, end, items = hint
+                append[end - 2] = ", NOLOCK" if items else "NOLOCK"
+            continue
+        if policy == "snapshot":
+            isolation = "SNAPSHOT"
+        if hint is None:
+            continue
+        k, end, items = hint
+        keep = [(a, b) for a, b in items if u[a] not in _DIRTY_HINTS]
+        if len(keep) == len(items):
+            continue
+        if keep:
+            replace[k] = (end, "WITH (" + ", ".join("".join(texts[a:b]) for a, b in keep) + ")")
+        else:
+            replace[last] = (end, texts[last])  # o hint some inteiro, junto com o espaço antes dele
+    if not replace and not append:
+        return sql, isolation
+    return _render(texts, tree.ws, replace, append), isolation
+
+
+# === Auto-parametrização ===
+# Literais de predicados (WHERE/ON) viram marcadores '?' ligados pelo driver, para o SQL Server
+# reaproveitar o plano entre perguntas de mesmo formato (outra planta, outro mês).
+class NVarchar(str):
+    """String vinda de um literal N'...': é ligada como nvarchar (as demais, como varchar)."""
+
+
+_PREDICATE_CLAUSES = frozenset({"WHERE", "ON"})
+_OTHER_CLAUSES = frozenset({
+    "SELECT", "FROM", "JOIN", "APPLY", "GROUP", "ORDER", "HAVING", "UNION", "EXCEPT", "INTERSECT",
+    "OPTION", "INTO", "OVER", "PARTITION",
+})
+# Dentro destas chamadas números são tamanho/precisão/estilo e precisam ficar literais
+_LITERAL_NUMBER_CALLS = frozenset({
+    "CONVERT", "TRY_CONVERT", "CAST", "TRY_CAST", "VARCHAR", "NVARCHAR", "CHAR", "NCHAR",
+    "DECIMAL", "NUMERIC", "BINARY", "VARBINARY", "DATETIME2", "DATETIMEOFFSET", "TIME", "FLOAT",
+})
+# Funções de data: nenhum literal dentro delas vira parâmetro (o SQL Server recusa variável int
+# em vários argumentos, ex.: DATEADD(MONTH, DATEDIFF(MONTH, 0, GETDATE()), 0) -> erro 8116)
+_LITERAL_CALLS = frozenset({
+    "DATEADD", "DATEDIFF", "DATEDIFF_BIG", "DATEPART", "DATENAME", "DATETRUNC", "DATE_BUCKET",
+    "EOMONTH", "DATEFROMPARTS", "DATETIMEFROMPARTS", "DATETIME2FROMPARTS", "SMALLDATETIMEFROMPARTS",
+    "TIMEFROMPARTS", "DATETIMEOFFSETFROMPARTS",
+})
+_MAX_PARAM_CHARS = 4000
+
+
+def _literal_value(kind: str, text: str):
+    """Valor Python do literal (ou None se não for seguro ligar como parâmetro)."""
+    if kind == "string":
+        n = text[:1] in ("N", "n")
+        body = text[2:-1] if n else text[1:-1]
+        if len(text) < (3 if n else 2) or not text.endswith("'") or len(body) > _MAX_PARAM_CHARS:
+            return None
+        body = body.replace("''", "'")
+        return NVarchar(body) if n else body
+    if text.isdigit():
+        return int(text)
+    if "e" in text.lower():
+        return float(text)
+    return Decimal(text)
+
+
+def parameterize_sql(sql: str) -> tuple:
+    """
+    Troca literais de string/número/data dos predicados WHERE/ON por '?' e devolve
+    (sql, params). Literais da projeção, GROUP BY/ORDER BY, TOP e tamanhos/estilos de
+    CONVERT/CAST, argumentos de funções de data e o caractere de ESCAPE ficam como estão.
+    SQL que já tem '?' volta inalterada.
+    """
+    lx = tokenize(sql or "")
+    if "?" in lx.texts:
+        return sql, ()
+    texts = list(lx.texts)
+    params = []
+    clause = [None]  # cláusula corrente por nível de parênteses
+    literal_numbers = [False]
+    literal_all = [False]  # dentro de função de data
+    prev = ""
+    for k, (kind, text) in enumerate(zip(lx.kinds, lx.texts)):
+        if kind in ("ws", "comment"):
+            continue
+        u = text.upper() if kind == "ident" else text
+        if u == "(":
+            clause.append(clause[-1])
+            literal_numbers.append(literal_numbers[-1] or prev in _LITERAL_NUMBER_CALLS)
+            literal_all.append(literal_all[-1] or prev in _LITERAL_CALLS)
+        elif u == ")" and len(clause) > 1:
+            clause.pop()
+            literal_numbers.pop()
+            literal_all.pop()
+        elif kind == "ident" and (u in _PREDICATE_CLAUSES or u in _OTHER_CLAUSES):
+            clause[-1] = u
+        elif kind in ("string", "number") and clause[-1] in _PREDICATE_CLAUSES \
+                and len(params) < SQL_AUTO_PARAM_MAX:
+            glued = k + 1 < len(lx.kinds) and lx.kinds[k + 1] == "ident"  # ex.: 0x1F
+            inline = literal_all[-1] or prev == "ESCAPE" or (kind == "number" and (literal_numbers[-1] or glued))
+            if not inline:
+                value = _literal_value(kind, text)
+                if value is not None:
+                    params.append(value)
+                    texts[k] = "?"
+        prev = u
+    if not params:
+        return sql, ()
+    return "".join(texts), tuple(params)
+
+
+def _sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    if isinstance(value, datetime):
+        return f"'{value:%Y%m%d %H:%M:%S}'"
+    if isinstance(value, date):
+        return f"'{value:%Y%m%d}'"
+    text = str(value).replace("'", "''")
+    return f"N'{text}'" if isinstance(value, NVarchar) else f"'{text}'"
+
+
+def inline_params(sql: str, params) -> str:
+    """Inverso do parameterize_sql: recoloca os valores como literais (chave de cache e logs)."""
+    if not params:
+        return sql
+    lx = tokenize(sql or "")
+    values = iter(params)
+    texts = [
+        _sql_literal(next(values, None)) if kind == "op" and text == "?" else text
+        for kind, text in zip(lx.kinds, lx.texts)
+    ]
+    return "".join(texts)
+
 
 def validate_sql(sql_text: str) -> (bool, str):
     if not sql_text:
         return False, "SQL vazio."
-    lowered = f" {sql_text.lower()} "
-    if not re.match(r"^\s*(select|with)\b", sql_text, flags=re.IGNORECASE):
+    lx = tokenize(sql_text)
+    if lx.first_word not in ("SELECT", "WITH"):
         return False, "A consulta não parece um SELECT/CTE."
-    if any(re.search(tok, lowered) for tok in _BLOCKED_TOKENS):
+    if lx.words & _BLOCKED_KEYWORDS or any(w.startswith(_BLOCKED_PREFIXES) for w in lx.words):
         return False, "Comando não permitido detectado (apenas SELECT/CTE são aceitos)."
     return True, "ok"
 
 def validate_known_tables(sql_text: str, schema_info: dict) -> (bool, str):
-    known_tables = set(schema_info.keys())
-    mentioned = set()
-    for t in known_tables:
-        if re.search(rf"(?i)\b{re.escape(t)}\b", sql_text or ""):
-            mentioned.add(t)
+    mentioned = referenced_tables(sql_text, list(schema_info.keys()))
     if not mentioned:
         return False, "Nenhuma tabela conhecida do SCHEMA_INFO foi referenciada."
     return True, "ok"
@@ -69,10 +1016,8 @@ def validate_known_tables(sql_text: str, schema_info: dict) -> (bool, str):
 _BLOCKED_TABLES = []  # se quiser bloquear algo explicitamente, adicione aqui
 
 def validate_blocked_tables(sql_text: str) -> (bool, str):
-    s = (sql_text or "").upper()
-    for t in _BLOCKED_TABLES:
-        if f" {t.upper()} " in f" {s} ":
-            return False, f"Tabela {t} está bloqueada."
+    for t in referenced_tables(sql_text, _BLOCKED_TABLES):
+        return False, f"Tabela {t} está bloqueada."
     return True, "ok"
 
 def enforce_new_plants_sql(sql_text: str, user_question: str) -> str:
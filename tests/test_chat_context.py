@@ -0,0 +1,47 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+import pandas as pd
+
+from chat_context import ChatContext
+
+
+def _tokens(s):
+    return max(1, int(len(s) / 4)) if s else 0
+
+
+def test_context_keeps_last_two_user_turns_masked_sample_and_last_sql():
+    ctx = ChatContext(_tokens)
+    df = pd.DataFrame({"NOME_CLI": ["ACME LTDA", "BETA SA", "GAMA"], "CIDADE": ["BENTO", "BENTO", "PIRAPETINGA"],
+                       "AREA": [1.5, 2.0, 3.0]})
+    ctx.add({"role": "user", "content": "pergunta antiga"})
+    ctx.add({"role": "assistant", "type": "sql", "content": "SELECT 1"})
+    ctx.add({"role": "user", "content": "volume por cliente"})
+    ctx.add({"role": "assistant", "type": "sql", "content": "SELECT NOME_CLI, CIDADE, AREA FROM T"})
+    ctx.add({"role": "assistant", "type": "dataframe", "summary": "3 clientes."}, df)
+    ctx.add({"role": "user", "content": "e em bento?"})
+
+    out = ctx.build(2000)
+    blocks = out.split("\n\n")
+
+    assert blocks[0] == "Usuário: volume por cliente"
+    assert blocks[1].startswith("Assistente: Assistente:\nresumo=3 clientes.\nAmostra CSV (até 2 linhas):\nNOME_CLI,CIDADE,AREA\n")
+    assert "ACME" not in out and "NOME_CLI_***" in out and ",BENTO,1.5" in out and "GAMA" not in out
+    assert blocks[2] == "Usuário: e em bento?"
+    assert blocks[3].endswith("SELECT NOME_CLI, CIDADE, AREA FROM T\n```")
+    assert "pergunta antiga" not in out
+
+    assert ctx.build(5) == "Usuário: e em bento?"  # o que não cabe fica de fora, sem cortar o bloco
@@ -0,0 +1,231 @@
+import contextlib
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+import pytest
+
+from db import ConnectionPool
+
+
+class _FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, *args):
+        if self.conn.broken:
+            raise RuntimeError("link failure")
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class _FakeConn:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def rollback(self):
+        if self.broken:
+            raise RuntimeError("link failure")
+
+    def close(self):
+        self.closed = True
+
+
+def _pool(**kw):
+    clock = [0.0]
+    created = []
+
+    def connect():
+        created.append(_FakeConn())
+        return created[-1]
+
+    pool = ConnectionPool(connect, clock=lambda: clock[0], **kw)
+    return pool, created, clock
+
+
+def test_pool_reuses_connections_and_pings_idle_ones():
+    pool, created, clock = _pool(max_size=2, ping_after=30, max_lifetime=1000)
+    with pool.connection() as c1:
+        pass
+    with pool.connection() as c2:
+        assert c2 is c1
+    created[0].broken = True
+    clock[0] = 60.0  # ociosa além de ping_after: SELECT 1 falha e a conexão é trocada
+    with pool.connection() as c3:
+        assert c3 is not c1 and c1.closed
+    clock[0] = 2000.0  # além de max_lifetime: reciclada sem ping
+    with pool.connection() as c4:
+        assert c4 is not c3
+    stats = pool.stats()
+    assert stats["created"] == 3 and stats["ping_failed"] == 1 and stats["recycled"] == 1
+    assert stats["size"] == 1
+
+
+def test_pool_checkout_times_out_when_exhausted():
+    pool, _, _ = _pool(max_size=1, checkout_timeout=0)
+    with pool.connection():
+        with pytest.raises(RuntimeError, match="esgotado"):
+            with pool.connection():
+                pass
+    with pool.connection():  # vaga devolvida
+        pass
+
+
+class _RowsCursor:
+    description = [("ID",), ("VALOR",)]
+
+    def __init__(self, n):
+        self._rows = [(i, float(i)) for i in range(n)]
+        self.cancelled = False
+
+    def fetchmany(self, k):
+        out, self._rows = self._rows[:k], self._rows[k:]
+        return out
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def test_query_stream_enforces_row_budget_in_batches(monkeypatch):
+    import contextlib
+    import db
+
+    cur = _RowsCursor(25)
+    monkeypatch.setattr(db, "_executed_cursor", lambda conn_str, sql, handle=None, params=None, session=None: contextlib.nullcontext(cur))
+    seen = []
+
+    df = db.QueryStream("dsn", "SELECT ID, VALOR FROM T", batch_rows=4, max_rows=10, max_bytes=0).to_frame(
+        lambda batch, stream: seen.append(len(batch))
+    )
+
+    assert list(df["ID"]) == list(range(10))
+    assert df.attrs["truncated"] and cur.cancelled
+    assert seen == [4, 4, 2]
+
+    cur = _RowsCursor(25)
+    full = db.QueryStream("dsn", "q", batch_rows=4, max_rows=25, max_bytes=0).to_frame()
+    assert len(full) == 25 and not full.attrs["truncated"] and not cur.cancelled
+
+
+_PLAN = """<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan"><BatchSequence><Batch>
+<Statements><StmtSimple StatementText="SELECT" StatementSubTreeCost="812.5" StatementEstRows="4500000">
+<QueryPlan><RelOp AvgRowSize="120" EstimateRows="4500000"/></QueryPlan></StmtSimple></Statements>
+</Batch></BatchSequence></ShowPlanXML>"""
+
+
+def test_cost_decision_caps_large_results_and_rejects_expensive_plans(monkeypatch):
+    import db
+
+    est = db.parse_showplan(_PLAN)
+    assert est == {"cost": 812.5, "est_rows": 4500000.0, "row_size": 120.0}
+    assert db.estimated_bytes(est) == 540000000.0
+
+    monkeypatch.setattr(db, "QUERY_COST_REJECT", 1000.0)
+    monkeypatch.setattr(db, "QUERY_COST_CAP_ROWS", 1000)
+    capped = db.cost_decision("SELECT EMISSAO FROM DASH_HISTORICO", est)
+    assert capped["action"] == "cap" and capped["sql"].startswith("SELECT TOP (1000) ")
+
+    monkeypatch.setattr(db, "QUERY_COST_REJECT", 500.0)
+    assert db.cost_decision("SELECT EMISSAO FROM DASH_HISTORICO", est)["action"] == "reject"
+    assert db.cost_decision("SELECT 1", None)["action"] == "ok"
+
+
+def test_query_stream_timeout_cancels_cursor(monkeypatch):
+    import contextlib
+    import threading
+    import db
+
+    class _SlowCursor(_RowsCursor):
+        def __init__(self):
+            super().__init__(10)
+            self._released = threading.Event()
+
+        def fetchmany(self, k):
+            self._released.wait(5)  # bloqueia como um fetch lento no servidor
+            return super().fetchmany(k)
+
+        def cancel(self):
+            self.cancelled = True
+            self._released.set()
+
+    cur = _SlowCursor()
+
+    @contextlib.contextmanager
+    def _fake(conn_str, sql, handle=None, params=None, session=None):
+        handle.attach(cur)
+        yield cur
+
+    monkeypatch.setattr(db, "_executed_cursor", _fake)
+    with pytest.raises(db.QueryTimeout):
+        db.QueryStream("dsn", "SELECT * FROM DASH_HISTORICO", timeout=0.05, tag="s1").to_frame()
+    assert cur.cancelled and "s1" not in db._active_queries
+
+
+def test_query_stream_binds_predicate_literals_as_parameters(monkeypatch):
+    import contextlib
+    import db
+
+    calls = []
+
+    class _ParamCursor(_RowsCursor):
+        def setinputsizes(self, sizes):
+            calls.append(("sizes", sizes))
+
+        def execute(self, sql, *args):
+            calls.append(("execute", sql, args))
+
+    cur = _ParamCursor(1)
+
+    @contextlib.contextmanager
+    def _fake(conn_str, sql, handle=None, params=None, session=None):
+        db._execute(cur, sql, params)
+        yield cur
+
+    monkeypatch.setattr(db, "_executed_cursor", _fake)
+    db.QueryStream("dsn", "SELECT ID FROM T WHERE CIDADE = 'BENTO' AND MES = 8").to_frame()
+
+    assert calls[-1] == ("execute", "SELECT ID FROM T WHERE CIDADE = ? AND MES = ?", (("BENTO", 8),))
+
+
+def test_query_stream_sets_session_and_maps_lock_timeout(monkeypatch):
+    import db
+
+    calls = []
+
+    class _LockedCursor(_RowsCursor):
+        def execute(self, sql, *args):
+            calls.append(sql)
+            if not sql.startswith("SET "):
+                raise RuntimeError("[42000] Lock request time out period exceeded. (1222) (SQLExecDirectW)")
+
+    cur = _LockedCursor(0)
+    monkeypatch.setattr(db, "create_engine", None)
+    monkeypatch.setattr(db, "pooled_connection", lambda conn_str: contextlib.nullcontext(types.SimpleNamespace(cursor=lambda: cur)))
+    monkeypatch.setattr(db, "SQL_READ_POLICY", {"BI_OTIF": "snapshot"})
+    monkeypatch.setattr(db, "SQL_LOCK_TIMEOUT_MS", {"EXPORT": 30000})
+    with pytest.raises(db.QueryLockTimeout):
+        db.QueryStream("dsn", "SELECT * FROM BI_OTIF WITH (NOLOCK)", query_class="export", params=()).to_frame()
+    assert calls == ["SET LOCK_TIMEOUT 30000; SET TRANSACTION ISOLATION LEVEL SNAPSHOT;", "SELECT * FROM BI_OTIF"]
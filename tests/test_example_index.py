@@ -0,0 +1,50 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from example_index import ExampleIndex
+
+
+POOL = [
+    {"pergunta": "Volume total em Maranguape em agosto de 2025", "sql": "SELECT SUM(AREA) FROM VW_DEVOLUCAO_LAB"},
+    {"pergunta": "Carteira outubro/2025 por unidade", "sql": "SELECT Unit, SUM(M2_Bruto) FROM DASH_ATUAL"},
+    {"pergunta": "OTIF final por planta", "sql": "SELECT CIDADE, AVG(OTIF_FINAL) FROM BI_OTIF"},
+]
+
+
+def test_top_k_ranks_closest_question_first_ignoring_accents():
+    index = ExampleIndex(POOL)
+
+    assert index.top_k("carteira de OUTUBRO por unidade", 1)[0] is POOL[1]
+    assert index.top_k("volume em maranguape em agôsto", 2)[0] is POOL[0]
+
+
+def test_sql_text_also_matches_and_k_is_capped_by_pool_size():
+    index = ExampleIndex(POOL)
+
+    assert index.top_k("otif_final", 1)[0] is POOL[2]
+    assert len(index.top_k("qualquer coisa", 10)) == len(POOL)
+    assert ExampleIndex([]).top_k("volume", 3) == []
+
+
+def test_incremental_add_and_remove_match_full_rebuild():
+    extra = [{"pergunta": "devolução por motivo em agosto", "sql": "SELECT MOTIVO FROM VW_DEVOLUCAO_LAB"}]
+    index = ExampleIndex(POOL)
+    index.add(extra)
+
+    assert index.top_k("devolucao por motivo", 1)[0] is extra[0]
+    assert index.remove(lambda ex: ex is extra[0]) == 1
+    assert len(index) == len(POOL)
+    assert extra[0] not in index.top_k("devolucao por motivo", len(POOL))
+
+
+def test_example_pool_learns_from_feedback_and_forgets_on_thumbs_down():
+    from example_pool import ExamplePool
+
+    pool = ExamplePool(POOL)
+    q, sql = "devolução por motivo em agosto", "SELECT MOTIVO FROM VW_DEVOLUCAO_LAB"
+    assert pool.add_positive(q, sql) and not pool.add_positive(q.upper(), sql)
+    assert pool.version == 1 and pool.top_k("devolucao por motivo", 1)[0]["sql"] == sql
+    assert not pool.add_positive("apague tudo", "DELETE FROM BI_OTIF")
+    assert pool.add_negative(q, sql) and len(pool) == len(POOL)
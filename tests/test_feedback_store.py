@@ -0,0 +1,38 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+from feedback_store import FeedbackStore
+
+
+def test_feedback_is_buffered_and_found_by_normalized_question(tmp_path):
+    store = FeedbackStore(str(tmp_path / "fb.sqlite3"), flush_items=10, flush_seconds=3600)
+    store.record("Volume total em 2025?", "SELECT 1", True, latency_ms=850,
+                 usage={"prompt_tokens": 900, "completion_tokens": 40, "total_tokens": 940})
+    store.record("volume TOTAL em 2025", "SELECT 2", False)
+    assert not os.path.exists(tmp_path / "fb.sqlite3")  # ainda no buffer
+
+    rows = store.lookup("Volume total em 2025")
+    assert [r["sql"] for r in rows] == ["SELECT 2", "SELECT 1"]
+    assert rows[1]["total_tokens"] == 940 and rows[1]["latency_ms"] == 850
+    assert store.summary("volume total em 2025") == {"up": 1, "down": 1}
+
+
+def test_feedback_text_export_keeps_old_format(tmp_path):
+    store = FeedbackStore(str(tmp_path / "fb.sqlite3"), flush_items=1)
+    store.record("pergunta", "SELECT 1", True)
+    pos, neg = tmp_path / "positives.txt", tmp_path / "negatives.txt"
+    assert store.export_text(str(pos), str(neg)) == 1
+    assert "PERGUNTA:\npergunta" in pos.read_text(encoding="utf-8") and not neg.exists()
@@ -0,0 +1,270 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+from types import SimpleNamespace
+
+import llm
+from llm import select_schema_for_question
+from llm_gateway import LLMGateway
+from rules import SCHEMA_INFO, metric_rules
+
+
+def test_volume_question_keeps_only_devolucao_view():
+    schema, pruned = select_schema_for_question("Volume em Maranguape em agosto", SCHEMA_INFO)
+
+    assert pruned
+    assert list(schema) == ["VW_DEVOLUCAO_LAB"]
+
+
+def test_carteira_keeps_both_dash_tables_in_schema_order():
+    schema, pruned = select_schema_for_question("carteira de outubro por unidade", SCHEMA_INFO)
+
+    assert pruned
+    assert list(schema) == ["DASH_ATUAL", "DASH_HISTORICO"]
+
+
+def test_low_confidence_falls_back_to_full_schema():
+    for q in ("e em setembro?", "saldo de pedidos por planta"):
+        schema, pruned = select_schema_for_question(q, SCHEMA_INFO)
+        assert not pruned
+        assert schema is SCHEMA_INFO
+
+
+def test_column_pruning_keeps_columns_named_in_rules():
+    schema, _ = select_schema_for_question(
+        "volume em bento", SCHEMA_INFO, prune_columns=True, extra_text=metric_rules()
+    )
+
+    cols = schema["VW_DEVOLUCAO_LAB"]["colunas"]
+    assert {"AREA", "DATA_EMISSAO", "GRUPO_PRODUTO"} <= set(cols)
+    assert "PRECO_M2" not in cols
+
+
+class _FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.consumed = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def _gen(self):
+        for piece in self.pieces:
+            self.consumed += 1
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+    async def close(self):
+        self.closed = True
+
+
+def _fake_gateway(create):
+    async def _create(**kw):
+        return create(**kw)
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=_create)))
+    return LLMGateway(client_factory=lambda: client, retry_base_delay=0)
+
+
+def test_streaming_completion_stops_at_end_marker(monkeypatch):
+    stream = _FakeStream(["```sql\nSELECT CIDADE", " FROM VW_DEVOLUCAO_LAB", "; --END", "\n```", " texto extra"])
+    monkeypatch.setattr(llm, "get_gateway", lambda: _fake_gateway(lambda **kw: stream))
+    partials = []
+
+    text, usage = llm.call_azure_openai_completion("pergunta", stream=True, on_delta=partials.append)
+
+    assert llm.extract_sql(text) == "SELECT CIDADE FROM VW_DEVOLUCAO_LAB"
+    assert stream.consumed == 3 and stream.closed
+    assert usage["stopped_early"] and partials[-1] == text
+
+
+def test_gateway_retries_transient_errors_but_not_bad_requests():
+    class _Err(Exception):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    calls = []
+
+    def _create(**kw):
+        calls.append(kw)
+        if len(calls) == 1:
+            raise _Err(503)
+        return SimpleNamespace(choices=[], usage=None)
+
+    assert _fake_gateway(_create).chat([], temperature=0, top_p=1, max_completion_tokens=1).choices == []
+    assert len(calls) == 2
+
+    def _bad(**kw):
+        calls.append(kw)
+        raise _Err(400)
+
+    calls.clear()
+    try:
+        _fake_gateway(_bad).chat([], temperature=0, top_p=1, max_completion_tokens=1)
+    except _Err:
+        pass
+    assert len(calls) == 1
+
+
+def test_gateway_charges_admission_once_and_credits_back_actual_usage():
+    from llm_admission import AdmissionController
+
+    adm = AdmissionController(tpm=10000, clock=lambda: 0.0)
+    acquired = []
+    real_acquire = adm.acquire
+
+    async def _acquire(tokens, *a, **kw):
+        acquired.append(tokens)
+        return await real_acquire(tokens, *a, **kw)
+
+    adm.acquire = _acquire
+
+    class _Err(Exception):
+        status_code = 503
+
+    calls = []
+
+    def _create(**kw):
+        calls.append(kw)
+        if len(calls) == 1:
+            raise _Err()
+        return SimpleNamespace(choices=[], usage=SimpleNamespace(total_tokens=120))
+
+    gw = _fake_gateway(_create)
+    gw.admission = adm
+    gw.chat([{"role": "user", "content": "volume por planta"}], temperature=0, top_p=1, max_completion_tokens=2000)
+
+    assert acquired[0] > 2000 and acquired[1:] == [0]
+    assert adm.stats()["tokens_available"] == 10000 - 120
+
+    # falha no meio do streaming: não repete, não passa de novo pela fila e encadeia a causa
+    class _Broken(_FakeStream):
+        async def _gen(self):
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content="SELECT"))])
+            raise _Err()
+
+    calls.clear()
+    acquired.clear()
+    gw = _fake_gateway(lambda **kw: calls.append(kw) or _Broken([]))
+    gw.admission = adm
+    try:
+        gw.stream([{"role": "user", "content": "x"}], temperature=0, top_p=1, max_completion_tokens=10)
+        raised = None
+    except RuntimeError as e:
+        raised = e
+    assert raised is not None and isinstance(raised.__cause__, _Err)
+    assert len(calls) == 1 and len(acquired) == 1
+
+
+def test_admission_serves_classification_first_and_opens_circuit():
+    import asyncio
+    from llm_admission import AdmissionController, CircuitOpenError, PRIORITY_CLASSIFICATION
+
+    async def _run():
+        adm = AdmissionController(tpm=6000, breaker_failures=2, breaker_cooldown=60)
+        await adm.acquire(6000)  # esgota o bucket
+        order = []
+
+        async def _req(name, priority):
+            await adm.acquire(5, priority)
+            order.append(name)
+
+        await asyncio.gather(_req("geracao", 1), _req("classificacao", PRIORITY_CLASSIFICATION))
+        adm.on_failure()
+        adm.on_failure()
+        try:
+            await adm.acquire(1)
+            opened = False
+        except CircuitOpenError:
+            opened = True
+        return order, opened, adm.stats()
+
+    order, opened, stats = asyncio.run(_run())
+    assert order == ["classificacao", "geracao"]
+    assert opened and stats["circuit"] == "open" and stats["rejected_circuit"] == 1
+
+
+def test_prompt_budget_trims_extra_examples_then_oldest_history():
+    from rules import EXEMPLOS_SQL
+    from token_count import count_tokens
+
+    rules = metric_rules()
+    hist = [f"Usuário: pergunta antiga {i} sobre volume por planta" for i in range(5)]
+    hist.append("Assistente:\nresumo=12 linhas.\n\n_Mostrando 12 de 40 colunas._")  # bloco com linha em branco
+    q = "Volume em Maranguape em agosto"
+    full_stats, stats = {}, {}
+    full = llm.montar_prompt(q, SCHEMA_INFO, rules, EXEMPLOS_SQL, "BI", 6, historico_blocks=hist,
+                             stats=full_stats, token_budget=0)
+    assert full_stats["prompt_trimmed"] is None and full_stats["prompt_tokens"]["total"] == count_tokens(full)
+
+    budget = full_stats["prompt_tokens"]["total"] - full_stats["prompt_tokens"]["exemplos"] // 2
+    prompt = llm.montar_prompt(q, SCHEMA_INFO, rules, EXEMPLOS_SQL, "BI", 6, historico_blocks=hist,
+                               stats=stats, token_budget=budget)
+    assert stats["prompt_trimmed"]["examples"] > 0 and stats["prompt_trimmed"]["history_blocks"] == 0
+    assert stats["prompt_tokens"]["total"] <= budget and hist[-1] in prompt
+
+    tight = llm.montar_prompt(q, SCHEMA_INFO, rules, EXEMPLOS_SQL, "BI", 6, historico_blocks=hist,
+                              stats=stats, token_budget=budget // 2)
+    assert stats["prompt_trimmed"]["history_blocks"] > 0
+    assert rules in tight and tight.rstrip().endswith("'; --END'.") and q in tight
+
+
+def test_token_estimate_without_tokenizer_counts_pieces():
+    from token_count import estimate_tokens
+
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("SELECT SUM(AREA) FROM VW_DEVOLUCAO_LAB") == 14
+    assert estimate_tokens("2025") == 2 and estimate_tokens("produção") == 2
+
+
+def test_speculation_skipped_when_cached_route_is_not_sql(monkeypatch):
+    llm.clear_intent_cache()
+    monkeypatch.setattr(llm, "_classify_via_llm", lambda qn: {"route": "gpt", "tool": None, "args": {}})
+    q = "qual a sua opinião sobre o trimestre"
+
+    assert llm.needs_llm_classification(q)
+    assert llm.classify_intent(q)["route"] == "gpt"
+    assert not llm.needs_llm_classification(q)
+
+    llm.clear_intent_cache()
+    assert llm.needs_llm_classification(q)
+
+
+def test_static_prefix_is_memoized_by_version(monkeypatch):
+    rules = metric_rules()
+    subset = {t: SCHEMA_INFO[t] for t in list(SCHEMA_INFO)[:1]}
+    first = llm.render_static_prefix(subset, rules, "BI", version="v-test")
+
+    def _no_hash(*a, **kw):
+        raise AssertionError("prefixo re-serializado")
+
+    monkeypatch.setattr(llm.json, "dumps", _no_hash)
+    again = llm.render_static_prefix(dict(subset), rules, "BI", version="v-test")
+
+    assert again is first
+
+
+def test_example_selection_follows_list_content_and_registry_is_capped():
+    pool = [{"pergunta": "volume por planta", "sql": "SELECT 1"},
+            {"pergunta": "otif por cliente", "sql": "SELECT 2"}]
+    assert llm.selecionar_exemplos("otif por cliente", pool, 1)[0]["sql"] == "SELECT 2"
+
+    pool[1] = {"pergunta": "otif por cliente", "sql": "SELECT 3"}  # editada, mesmo tamanho
+    assert llm.selecionar_exemplos("otif por cliente", pool, 1)[0]["sql"] == "SELECT 3"
+
+    for i in range(20):
+        llm.selecionar_exemplos("x", [{"pergunta": f"p{i}", "sql": "SELECT 1"}], 1)
+    assert len(llm._EXEMPLOS_REGISTRY) <= llm._EXEMPLOS_REGISTRY_MAX
@@ -0,0 +1,96 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+import pandas as pd
+
+from query_cache import QueryResultCache
+
+
+def _cache(**kw):
+    kw.setdefault("disk_enabled", False)
+    kw.setdefault("table_ttls", {"DASH_HISTORICO": 3600, "DASH_ATUAL": 60})
+    return QueryResultCache(**kw)
+
+
+def test_hit_ignores_comments_whitespace_and_keyword_case():
+    cache = _cache()
+    df = pd.DataFrame({"CIDADE": ["MARANGUAPE"], "AREA": [10.0]})
+    cache.put("SELECT CIDADE, SUM(AREA) AS AREA FROM VW_DEVOLUCAO_LAB -- volume\nGROUP BY CIDADE;", df)
+
+    hit = cache.get("select cidade,  sum(area) as area\nfrom vw_devolucao_lab group by cidade")
+
+    assert hit is not None and hit.equals(df)
+    assert cache.stats()["hits_mem"] == 1
+
+
+def test_string_literals_are_part_of_the_key():
+    cache = _cache()
+    cache.put("SELECT 1 FROM DASH_ATUAL WHERE Unit = 'BENTO'", pd.DataFrame({"x": [1]}))
+
+    assert cache.get("SELECT 1 FROM DASH_ATUAL WHERE Unit = 'bento'") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl_uses_shortest_table_and_lru_evicts_oldest():
+    cache = _cache(max_items=1)
+    assert cache.ttl_for("SELECT * FROM DASH_HISTORICO UNION ALL SELECT * FROM DASH_ATUAL") == 60
+    assert cache.ttl_for("SELECT * FROM BI_OTIF") == cache.default_ttl
+
+    cache.put("SELECT 1 FROM DASH_ATUAL", pd.DataFrame({"x": [1]}))
+    cache.put("SELECT 2 FROM DASH_ATUAL", pd.DataFrame({"x": [2]}))
+
+    assert cache.get("SELECT 1 FROM DASH_ATUAL") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_changed_table_stamp_invalidates_entry():
+    cache = _cache()
+    sql = "SELECT SUM(M2_Bruto) FROM DASH_ATUAL"
+    cache.put(sql, pd.DataFrame({"x": [1]}), stamps={"DASH_ATUAL": "2025-10-01T08:00:00"})
+
+    assert cache.get(sql, stamps={"DASH_ATUAL": "2025-10-01T08:00:00"}) is not None
+    assert cache.get(sql, stamps={"DASH_ATUAL": "2025-10-01T09:30:00"}) is None
+    assert cache.stats()["invalidated"] == 1
+
+
+def test_disk_tier_survives_new_instance(tmp_path):
+    sql = "SELECT CIDADE FROM VW_DEVOLUCAO_LAB"
+    df = pd.DataFrame({"CIDADE": ["BENTO", "UBERABA"]})
+    _cache(disk_enabled=True, cache_dir=str(tmp_path)).put(sql, df)
+
+    cache = _cache(disk_enabled=True, cache_dir=str(tmp_path))
+    hit = cache.get(sql)
+
+    assert hit is not None and hit.equals(df)
+    assert cache.stats()["hits_disk"] == 1
+
+
+def test_scope_separates_same_sql_on_different_connections():
+    cache = _cache()
+    sql = "SELECT CIDADE FROM VW_DEVOLUCAO_LAB"
+    cache.put(sql, pd.DataFrame({"CIDADE": ["BENTO"]}), scope="prod")
+
+    assert cache.get(sql, scope="homolog") is None
+    assert cache.get(sql, scope="prod") is not None
+
+
+def test_disk_sweep_removes_expired_files(tmp_path):
+    cache = _cache(disk_enabled=True, cache_dir=str(tmp_path), default_ttl=0, disk_sweep_seconds=0)
+    cache.put("SELECT 1 FROM BI_OTIF", pd.DataFrame({"x": [1]}))  # TTL 0: já vencida
+    cache.put("SELECT 2 FROM DASH_ATUAL", pd.DataFrame({"x": [2]}))  # o put varre o disco
+
+    key = cache.key_for("SELECT 2 FROM DASH_ATUAL")
+    assert sorted(os.listdir(tmp_path)) == [key + ".json", key + ".parquet"]
@@ -0,0 +1,60 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+from question_cache import QuestionSQLCache
+
+
+SQL = "SELECT CIDADE, SUM(AREA) FROM VW_DEVOLUCAO_LAB GROUP BY CIDADE"
+
+
+def test_repeated_question_hits_regardless_of_accents_and_case(tmp_path):
+    cache = QuestionSQLCache(str(tmp_path / "q.sqlite3"), ttl_seconds=3600)
+    cache.store("Volume em Maranguape em agosto?", "", "v1", SQL)
+
+    sql, _ = cache.lookup("  volume em MARANGUAPE em agósto ", "", "v1")
+
+    assert sql == SQL
+
+
+def test_history_and_rules_version_are_part_of_the_key(tmp_path):
+    cache = QuestionSQLCache(str(tmp_path / "q.sqlite3"), ttl_seconds=3600)
+    cache.store("e em setembro?", "Usuário: volume em Bento", "v1", SQL)
+
+    assert cache.lookup("e em setembro?", "Usuário: volume em Uberaba", "v1")[0] is None
+    assert cache.lookup("e em setembro?", "Usuário: volume em Bento", "v2")[0] is None
+
+
+def test_approval_and_negative_feedback(tmp_path):
+    cache = QuestionSQLCache(str(tmp_path / "q.sqlite3"), ttl_seconds=3600, require_approval=True)
+    key = cache.store("carteira outubro", "", "v1", SQL)
+
+    assert cache.lookup("carteira outubro", "", "v1")[0] is None
+    cache.mark_feedback(key, positive=True)
+    assert cache.lookup("carteira outubro", "", "v1")[0] == SQL
+    cache.mark_feedback(key, positive=False)
+    assert cache.lookup("carteira outubro", "", "v1")[0] is None
+
+
+def test_relative_time_questions_are_keyed_by_day(tmp_path):
+    from datetime import date
+
+    cache = QuestionSQLCache(str(tmp_path / "q.sqlite3"), ttl_seconds=3600)
+    cache.store("carteira deste mês", "", "v1", SQL, today=date(2026, 10, 15))
+    cache.store("volume em agosto de 2025", "", "v1", SQL, today=date(2026, 10, 15))
+
+    assert cache.lookup("carteira deste mes", "", "v1", today=date(2026, 10, 15))[0] == SQL
+    assert cache.lookup("carteira deste mes", "", "v1", today=date(2026, 10, 16))[0] is None
+    assert cache.lookup("volume em agosto de 2025", "", "v1", today=date(2026, 10, 16))[0] == SQL
@@ -0,0 +1,64 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+import numpy as np
+import pandas as pd
+
+from result_store import ResultStore, compact_frame
+
+
+def _frame(n=1000):
+    return pd.DataFrame({
+        "CIDADE": ["BENTO", "MARANGUAPE", "PIRAPETINGA", "PORTO FELIZ"] * (n // 4),
+        "NOME_CLI": [f"CLIENTE {i}" for i in range(n)],
+        "AREA": np.arange(n) * 0.25,
+        "VALOR": np.arange(n) * 123456.789 + 0.01,
+        "QTD": np.arange(n, dtype=np.int64),
+    })
+
+
+def test_compact_frame_downcasts_without_changing_shown_values():
+    df = _frame()
+    out = compact_frame(df)
+
+    assert out["CIDADE"].dtype == "category" and out["NOME_CLI"].dtype == df["NOME_CLI"].dtype
+    assert out["AREA"].dtype == np.float32 and out["VALOR"].dtype == np.float64  # float32 perderia centavos
+    assert out["QTD"].dtype == np.int16
+    assert out.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    pd.testing.assert_frame_equal(out.astype(df.dtypes.to_dict()), df)
+
+
+def test_store_keeps_recent_results_in_memory_and_spills_older_ones(tmp_path):
+    store = ResultStore(str(tmp_path / "s1"), max_items=2, max_bytes=0)
+    keys = [store.put(_frame(40).assign(QTD=i)) for i in range(4)]
+
+    stats = store.stats()
+    assert stats["mem_items"] == 2 and stats["disk_items"] == 2
+    assert store.get(keys[0])["QTD"].iloc[0] == 0 and store.stats()["loaded"] == 1
+    assert store.get(keys[3])["CIDADE"].dtype == "category"
+
+    store.clear()
+    assert store.get(keys[0]) is None and not os.path.exists(tmp_path / "s1")
+
+
+def test_store_keeps_only_the_first_rows_when_spill_fails(tmp_path, monkeypatch):
+    store = ResultStore(str(tmp_path / "s2"), max_items=1, fallback_rows=5)
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", lambda *a, **k: (_ for _ in ()).throw(ImportError("pyarrow")))
+    first = store.put(_frame(40))
+    store.put(_frame(40))
+
+    head = store.get(first)
+    assert len(head) == 5 and head.attrs["truncated"]
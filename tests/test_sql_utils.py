@@ -15,7 +15,7 @@ mock_openai.AzureOpenAI = _DummyAzureOpenAI
 sys.modules.setdefault("openai", mock_openai)
 
 from config import DEFAULT_YEAR_IF_MISSING
-from sql_utils import sql_sanity_rewrite
+from sql_utils import normalize_sql_key, sql_sanity_rewrite
 
 
 def test_sql_sanity_rewrite_adds_year_for_data_entrega_month():
@@ -26,3 +26,168 @@ def test_sql_sanity_rewrite_adds_year_for_data_entrega_month():
     expected_year_clause = f"YEAR(Data_Entrega) = {DEFAULT_YEAR_IF_MISSING}"
     assert expected_year_clause in rewritten_sql
     assert "MONTH(Data_Entrega) = 5" in rewritten_sql
+
+
+def test_normalize_sql_key_folds_case_outside_literals_and_drops_comments():
+    sql = "SELECT  Unit -- unidade\nFROM DASH_ATUAL /* bloco */ WHERE Unit = 'Porto  Feliz';"
+
+    assert normalize_sql_key(sql) == "select unit from dash_atual where unit = 'Porto  Feliz'"
+
+
+def test_apply_top_cap_only_rewrites_simple_selects():
+    from sql_utils import apply_top_cap
+
+    assert apply_top_cap("SELECT DISTINCT CIDADE FROM VW_DEVOLUCAO_LAB", 100) == (
+        "SELECT DISTINCT TOP (100) CIDADE FROM VW_DEVOLUCAO_LAB"
+    )
+    assert apply_top_cap("SELECT TOP 5 * FROM BI_OTIF", 100) == "SELECT TOP 5 * FROM BI_OTIF"
+    union = "SELECT A FROM T1 UNION ALL SELECT A FROM T2"
+    assert apply_top_cap(union, 100) == union
+    cte = "WITH x AS (SELECT 1 AS A) SELECT A FROM x"
+    assert apply_top_cap(cte, 100) == cte
+
+
+def test_validation_ignores_literals_and_comments_but_blocks_statements():
+    from sql_utils import referenced_tables, validate_sql
+
+    assert validate_sql("-- revisão\nselect 'drop table' AS obs from BI_OTIF /* exec */")[0]
+    assert not validate_sql("SELECT 1; DROP TABLE BI_OTIF")[0]
+    assert not validate_sql("SELECT * FROM x; EXECUTE sp_who")[0]
+    sql = "select * from dbo.[DASH_ATUAL] d -- BI_OTIF"
+    assert referenced_tables(sql, ["BI_OTIF", "DASH_ATUAL"]) == ["DASH_ATUAL"]
+
+
+def test_sargable_rewrite_turns_date_functions_into_ranges_on_datetime_columns():
+    sql = (
+        "SELECT SUM(AREA) FROM VW_DEVOLUCAO_LAB WHERE MONTH(DATA_EMISSAO) = 12 "
+        "AND YEAR(DATA_EMISSAO) = 2024 AND TIPO IN ('VENDA','DEVOLUCAO')"
+    )
+    assert sql_sanity_rewrite(sql) == (
+        "SELECT SUM(AREA) FROM VW_DEVOLUCAO_LAB WHERE DATA_EMISSAO < '20250101' "
+        "AND DATA_EMISSAO >= '20241201' AND TIPO IN ('VENDA','DEVOLUCAO')"
+    )
+
+    dash = "SELECT * FROM dbo.DASH_ATUAL WHERE TRY_CONVERT(date, Data_Entrega) <= '2025-10-31'"
+    assert sql_sanity_rewrite(dash).endswith("WHERE Data_Entrega < '20251101'")
+
+    # sem tipo datetime conhecido, em projeções ou sob NOT: nada muda
+    assert "YEAR(DT_ENTREG)" in sql_sanity_rewrite("SELECT * FROM BI_OTIF WHERE YEAR(DT_ENTREG) = 2025")
+    kept = "SELECT YEAR(Data) AS ANO FROM DASH_ATUAL WHERE NOT YEAR(Data) = 2024"
+    assert sql_sanity_rewrite(kept) == kept
+
+
+def test_parameterize_sql_lifts_predicate_literals_only():
+    from sql_utils import NVarchar, inline_params, parameterize_sql
+
+    sql = (
+        "SELECT TOP 10 CONVERT(varchar(7), DATA_EMISSAO, 120) AS MES, 'x' AS K FROM VW_DEVOLUCAO_LAB "
+        "WHERE CIDADE = N'São' AND AREA > 1.5 AND TIPO IN ('VENDA','DEVOLUCAO') ORDER BY 1"
+    )
+    lifted, params = parameterize_sql(sql)
+
+    assert lifted == (
+        "SELECT TOP 10 CONVERT(varchar(7), DATA_EMISSAO, 120) AS MES, 'x' AS K FROM VW_DEVOLUCAO_LAB "
+        "WHERE CIDADE = ? AND AREA > ? AND TIPO IN (?,?) ORDER BY 1"
+    )
+    assert isinstance(params[0], NVarchar) and params[2:] == ("VENDA", "DEVOLUCAO")
+    assert normalize_sql_key(inline_params(lifted, params)) == normalize_sql_key(sql)
+
+
+def test_parameterize_sql_keeps_date_function_and_escape_literals_inline():
+    from sql_utils import parameterize_sql
+
+    sql = (
+        "SELECT Unit FROM DASH_ATUAL WHERE Data_Entrega >= DATEADD(MONTH, DATEDIFF(MONTH, 0, GETDATE()), 0) "
+        "AND Unit = 'BENTO' AND Cliente LIKE '%10!%%' ESCAPE '!'"
+    )
+    lifted, params = parameterize_sql(sql)
+
+    assert lifted == (
+        "SELECT Unit FROM DASH_ATUAL WHERE Data_Entrega >= DATEADD(MONTH, DATEDIFF(MONTH, 0, GETDATE()), 0) "
+        "AND Unit = ? AND Cliente LIKE ? ESCAPE '!'"
+    )
+    assert params == ("BENTO", "%10!%%")
+
+
+def test_route_dash_tables_picks_table_by_data_entrega_range():
+    from datetime import date
+
+    from sql_utils import route_dash_tables
+
+    today = date(2026, 10, 16)
+    past = "SELECT SUM(M2_Bruto) FROM dbo.DASH_ATUAL WITH (NOLOCK) WHERE Data_Entrega >= '20260801' AND Data_Entrega < '20260901'"
+    assert route_dash_tables(past, today) == past.replace("DASH_ATUAL", "DASH_HISTORICO")
+
+    current = "SELECT SUM(M2_Bruto) FROM DASH_ATUAL WHERE Data_Entrega >= '20261001'"
+    assert route_dash_tables(current, today) == current
+
+    spans = "SELECT SUM(d.M2_Bruto) FROM DASH_HISTORICO d WHERE d.Data_Entrega BETWEEN '2026-09-01' AND '2026-10-31'"
+    schema = {
+        "DASH_ATUAL": {"colunas": {"Unit": "", "Data_Entrega": "", "M2_Bruto": ""}},
+        "DASH_HISTORICO": {"colunas": {"Unit": "", "Data_Entrega": "", "M2_Bruto": ""}},
+    }
+    assert route_dash_tables(spans, today, schema) == (
+        "SELECT SUM(d.M2_Bruto) FROM (SELECT Unit, Data_Entrega, M2_Bruto FROM DASH_HISTORICO WHERE Data_Entrega < '20261001' "
+        "UNION ALL SELECT Unit, Data_Entrega, M2_Bruto FROM DASH_ATUAL WHERE Data_Entrega >= '20261001') AS d "
+        "WHERE d.Data_Entrega BETWEEN '2026-09-01' AND '2026-10-31'"
+    )
+    assert "SELECT *" not in route_dash_tables(spans, today)
+
+    for unknown in (
+        "SELECT * FROM DASH_ATUAL WHERE Data_Entrega < '20260901' OR Unit = 'X'",
+        "SELECT * FROM DASH_HISTORICO WHERE NOT Data_Entrega >= '2025-10-01'",
+        "SELECT * FROM DASH_HISTORICO WHERE Data_Entrega >= '20261001' AND Data_Entrega <> '20261002'",
+        "SELECT * FROM DASH_ATUAL WHERE Data_Entrega < '20260901' AND Data_Entrega IN (SELECT x FROM T)",
+        "SELECT * FROM DASH_ATUAL WHERE '20260901' > Data_Entrega",
+    ):
+        assert route_dash_tables(unknown, today) == unknown
+
+
+def test_project_star_columns_keeps_cited_columns_and_caps_the_rest():
+    from rules import SCHEMA_INFO
+    from sql_utils import project_star_columns
+
+    sql = "WITH c AS (SELECT * FROM dbo.DASH_ATUAL WITH (NOLOCK)) SELECT TOP 50 c.* FROM c WHERE c.Unit = 'BENTO'"
+    out = project_star_columns(sql, SCHEMA_INFO, "pedidos em bento por vendedor", max_columns=4)
+
+    assert out["columns_before"] == len(SCHEMA_INFO["DASH_ATUAL"]["colunas"]) and out["columns_after"] == 4
+    assert out["sql"].startswith("WITH c AS (SELECT * FROM dbo.DASH_ATUAL WITH (NOLOCK)) SELECT TOP 50 c.RecordID, c.Unit,")
+    assert "c.Vendedor" in out["sql"]
+
+    for untouched in ("SELECT DISTINCT * FROM DASH_ATUAL", "SELECT * FROM DASH_ATUAL a JOIN BI_OTIF b ON a.Unit = b.CIDADE"):
+        assert project_star_columns(untouched, SCHEMA_INFO, "")["sql"] == untouched
+    assert project_star_columns("SELECT * FROM DASH_ATUAL", SCHEMA_INFO, "todas as colunas")["columns_after"] == 0
+
+
+def test_apply_read_policy_adds_or_strips_dirty_read_hints_per_table():
+    from sql_utils import apply_read_policy
+
+    policy = {"DASH_ATUAL": "nolock", "BI_OTIF": "snapshot", "VW_DEVOLUCAO_LAB": "default"}
+    sql, iso = apply_read_policy(
+        "SELECT * FROM dbo.DASH_ATUAL d JOIN BI_OTIF WITH (NOLOCK) o ON d.Unit = o.CIDADE", policy
+    )
+    assert sql == "SELECT * FROM dbo.DASH_ATUAL d WITH (NOLOCK) JOIN BI_OTIF o ON d.Unit = o.CIDADE"
+    assert iso == "SNAPSHOT"
+
+    sql, iso = apply_read_policy("SELECT * FROM VW_DEVOLUCAO_LAB WITH (NOLOCK, INDEX(ix)) v", policy)
+    assert sql == "SELECT * FROM VW_DEVOLUCAO_LAB WITH (INDEX(ix)) v" and iso == "READ COMMITTED"
+    assert apply_read_policy("SELECT * FROM DASH_ATUAL (NOLOCK)", policy)[0] == "SELECT * FROM DASH_ATUAL (NOLOCK)"
+    assert apply_read_policy("SELECT * FROM BI_PEDIDOS_LAB", policy)[0] == "SELECT * FROM BI_PEDIDOS_LAB"
+
+
+def test_apply_read_policy_handles_aliases_existing_hints_and_comma_joins():
+    from sql_utils import apply_read_policy
+
+    policy = {"BI_PEDIDOS_LAB": "nolock", "DASH_ATUAL": "nolock", "BI_OTIF": "default"}
+    aliased = "SELECT PED.UNIDADE FROM BI_PEDIDOS_LAB PED WITH (NOLOCK) WHERE PED.SALDO > 0"
+    assert apply_read_policy(aliased, policy)[0] == aliased
+    assert apply_read_policy("SELECT * FROM DASH_ATUAL AS d WHERE d.Unit = 'X'", policy)[0] == (
+        "SELECT * FROM DASH_ATUAL AS d WITH (NOLOCK) WHERE d.Unit = 'X'"
+    )
+    assert apply_read_policy("SELECT * FROM T JOIN BI_OTIF b WITH (INDEX(ix1), NOLOCK) ON T.id = b.id", policy)[0] == (
+        "SELECT * FROM T JOIN BI_OTIF b WITH (INDEX(ix1)) ON T.id = b.id"
+    )
+    assert apply_read_policy("SELECT * FROM BI_OTIF o, DASH_ATUAL d, BI_PEDIDOS_LAB WHERE o.x = d.x", policy)[0] == (
+        "SELECT * FROM BI_OTIF o, DASH_ATUAL d WITH (NOLOCK), BI_PEDIDOS_LAB WITH (NOLOCK) WHERE o.x = d.x"
+    )
+    assert apply_read_policy("SELECT DASH_ATUAL, x FROM T", policy)[0] == "SELECT DASH_ATUAL, x FROM T"
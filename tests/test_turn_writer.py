@@ -0,0 +1,44 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+mock_openai = types.ModuleType("openai")
+
+
+class _DummyAzureOpenAI:  # pragma: no cover - stub for config import
+    pass
+
+
+mock_openai.AzureOpenAI = _DummyAzureOpenAI
+sys.modules.setdefault("openai", mock_openai)
+
+from turn_writer import ChatTurnWriter
+
+
+def test_writer_batches_rows_and_ensures_table_once():
+    ensured, batches = [], []
+    writer = ChatTurnWriter(ensured.append, lambda cs, rows: batches.append(list(rows)),
+                            batch_size=3, flush_seconds=60)
+
+    for i in range(4):
+        assert writer.enqueue("dsn", "s1", "user", "text", f"pergunta {i}")
+    assert writer.flush(timeout=5)
+
+    assert ensured == ["dsn"]
+    assert [len(b) for b in batches] == [3, 1]
+    assert batches[0][0] == ("s1", "user", "text", "pergunta 0", None)
+    writer.close()
+    assert writer.stats()["written"] == 4
+
+
+def test_writer_failure_does_not_raise_to_caller():
+    def _boom(cs, rows):
+        raise RuntimeError("sem conexão")
+
+    writer = ChatTurnWriter(lambda cs: None, _boom, batch_size=1, flush_seconds=60)
+    assert writer.enqueue("dsn", "s1", "user", "text", "x")
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert writer.stats()["failed"] == 1
@@ -0,0 +1,65 @@
+# token_count.py — contagem de tokens local para orçar o prompt
+#
+# Com tiktoken instalado (e o arquivo BPE no cache: sem rede, aponte TIKTOKEN_CACHE_DIR para
+# a pasta com o .tiktoken), conta com o tokenizador do modelo. Sem ele, estima por pedaços
+# (palavras / pontuação), bem mais próximo do real que len/4 em SQL e em português.
+# Contagens são memorizadas: seções estáticas (prefixo, exemplos) custam um lookup.
+
+import re
+import logging
+import threading
+from functools import lru_cache
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+from config import TOKENIZER_ENCODING, TOKEN_COUNT_CACHE_ITEMS
+
+log = logging.getLogger("radar-ia.tokens")
+
+_PIECES = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_", re.UNICODE)
+_encoding = None  # None = não carregado; False = indisponível
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                _encoding = False
+                if tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                    except Exception as e:
+                        log.warning("tokenizador %s indisponível (%s); usando estimativa", TOKENIZER_ENCODING, e)
+    return _encoding or None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa sem tokenizador: palavras longas quebram a cada ~4 letras, números a cada 3 dígitos."""
+    n = 0
+    for piece in _PIECES.findall(text or ""):
+        if piece[0].isdigit():
+            n += (len(piece) + 2) // 3
+        elif piece[0].isalpha():
+            n += (len(piece) + 3) // 4
+        else:
+            n += 1
+    return n
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_ITEMS)
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def tokenizer_name() -> str:
+    return f"tiktoken:{TOKENIZER_ENCODING}" if _get_encoding() is not None else "estimativa"
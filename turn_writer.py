@@ -0,0 +1,128 @@
+# turn_writer.py — gravação em background do histórico (dbo.chat_turns)
+#
+# O turno do usuário só enfileira; uma thread drena a fila em lotes (fast_executemany),
+# garante a tabela uma vez por connection string e descarrega no encerramento do processo.
+
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from config import TURN_WRITER_BATCH_SIZE, TURN_WRITER_FLUSH_SECONDS, TURN_WRITER_MAX_QUEUE
+from db import ensure_chat_table, insert_chat_turns
+
+log = logging.getLogger("radar-ia.turns")
+
+
+class ChatTurnWriter:
+    """Fila em memória + thread que grava em lote (por tamanho ou tempo desde o 1º pendente)."""
+
+    def __init__(self, ensure_table, insert_batch, *, batch_size: int = 50,
+                 flush_seconds: float = 2.0, max_queue: int = 10000):
+        self._ensure_table = ensure_table  # (conn_str) -> None
+        self._insert_batch = insert_batch  # (conn_str, [(session_id, role, type, content, summary)]) -> None
+        self.batch_size = max(1, int(batch_size))
+        self.flush_seconds = float(flush_seconds)
+        self._q = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._ready = set()  # conn_strs com tabela garantida
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="chat-turn-writer", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, conn_str: str, session_id: str, role: str, type_: str,
+                content: str = None, summary: str = None) -> bool:
+        """Não bloqueia: com a fila cheia o registro é descartado (e contado)."""
+        if not conn_str:
+            return False
+        self._ensure_thread()
+        try:
+            self._q.put_nowait(("row", conn_str, (session_id, role, type_, content, summary)))
+        except queue.Full:
+            self._stats["dropped"] += 1
+            return False
+        self._stats["enqueued"] += 1
+        return True
+
+    def _write(self, pending: dict):
+        for conn_str, rows in pending.items():
+            try:
+                if conn_str not in self._ready:
+                    self._ensure_table(conn_str)
+                    self._ready.add(conn_str)
+                self._insert_batch(conn_str, rows)
+                self._stats["written"] += len(rows)
+                self._stats["batches"] += 1
+            except Exception as e:
+                self._stats["failed"] += len(rows)
+                log.warning("chat_turns: falha ao gravar %d registros: %s", len(rows), e)
+        pending.clear()
+
+    def _run(self):
+        pending, count, first_at = {}, 0, None
+        while True:
+            timeout = None if first_at is None else max(0.0, first_at + self.flush_seconds - time.monotonic())
+            try:
+                item = self._q.get(timeout=timeout)
+            except queue.Empty:
+                item = ("tick",)
+            kind = item[0]
+            if kind == "row":
+                _, conn_str, row = item
+                pending.setdefault(conn_str, []).append(row)
+                count += 1
+                first_at = first_at or time.monotonic()
+            due = first_at is not None and time.monotonic() - first_at >= self.flush_seconds
+            if kind in ("flush", "stop") or count >= self.batch_size or due:
+                self._write(pending)
+                count, first_at = 0, None
+            if kind == "flush":
+                item[1].set()
+            elif kind == "stop":
+                return
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Grava tudo o que está na fila (bloqueia até 'timeout')."""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self._q.put(("flush", done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        """Descarrega a fila e encerra a thread (registrado no atexit)."""
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._q.put(("stop",), timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {**self._stats, "queued": self._q.qsize()}
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_turn_writer() -> ChatTurnWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ChatTurnWriter(
+                ensure_chat_table, insert_chat_turns,
+                batch_size=TURN_WRITER_BATCH_SIZE,
+                flush_seconds=TURN_WRITER_FLUSH_SECONDS,
+                max_queue=TURN_WRITER_MAX_QUEUE,
+            )
+            atexit.register(_writer.close)
+        return _writer